@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# The modules import each other by name, like main.py run from verizon/ does.
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "verizon"
+    ),
+)
+
+from utils import vrz_command  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def config_home(tmp_path, monkeypatch):
+    """A user config of its own for every test, with the identity commits need."""
+    home = tmp_path / "config"
+    (home / "vrz").mkdir(parents=True)
+    (home / "vrz" / "config").write_text(
+        "[user]\nname = Test\nemail = test@example.com\n"
+    )
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(home))
+    return home
+
+
+def vrz(cwd, *args, check=True):
+    """Run `vrz args` in cwd, in a process of its own. Return its stdout."""
+    proc = subprocess.run(vrz_command(*args), cwd=cwd, capture_output=True, text=True)
+    if check and proc.returncode != 0:
+        raise AssertionError(
+            f"vrz {' '.join(args)} exited with {proc.returncode}:\n{proc.stderr}"
+        )
+    return proc.stdout
+
+
+def fetch_commit(repo, src, files):
+    """Commit files, {name: content}, in a new repository at src, and fetch it into repo, where its objects land in a pack of their own. Return the commit's sha."""
+    src.mkdir()
+    vrz(src, "init", ".")
+    for name, content in files.items():
+        (src / name).write_text(content)
+    vrz(src, "add", *files)
+    vrz(src, "commit", "-m", "fetched")
+    vrz(repo, "fetch", f"pipe:{src}")
+    return vrz(src, "rev-parse", "HEAD").strip()
+
+
+def fast_import(path, stream):
+    """Run `vrz fast-import` in path on stream, which writes a pack of its own."""
+    subprocess.run(
+        vrz_command("fast-import"),
+        cwd=path,
+        input=stream,
+        check=True,
+        capture_output=True,
+    )
+
+
+def shared_indexes(repo):
+    """The shared index files of repo, see index_write."""
+    return sorted(
+        name for name in os.listdir(repo / ".vrz") if name.startswith("sharedindex.")
+    )
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """A repository with one commit, of a.txt and d/b.txt."""
+    path = tmp_path / "repo"
+    (path / "d").mkdir(parents=True)
+    vrz(path, "init", ".")
+    (path / "a.txt").write_text("hello\n")
+    (path / "d" / "b.txt").write_text("world\n")
+    vrz(path, "add", "a.txt", "d/b.txt")
+    vrz(path, "commit", "-m", "first")
+    return path
+
+
+@pytest.fixture
+def split_repo(repo):
+    """repo with a split index, and 50 more files committed."""
+    with open(repo / ".vrz" / "config", "a") as f:
+        f.write("[index]\nsplitindex = true\n")
+    # Enough files for a change to a few of them to stay in the delta.
+    names = [f"f{i:02}.txt" for i in range(50)]
+    for name in names:
+        (repo / name).write_text(f"{name}\n")
+    vrz(repo, "add", *names)
+    vrz(repo, "commit", "-m", "files")
+    return repo
@@ -0,0 +1,32 @@
+import asyncio
+import os
+
+from conftest import fetch_commit
+from async_utils import VerizonAsyncRepository
+from classes import VerizonRepository
+from class_utils import packs_load
+
+
+def test_concurrent_first_reads(repo, tmp_path):
+    # Objects in packs, with the repo fixture's still loose.
+    for i in range(3):
+        fetch_commit(repo, tmp_path / f"src{i}", {"f.txt": f"{i}\n"})
+    shas = [
+        pack.sha(i)
+        for pack in packs_load(VerizonRepository(str(repo)))
+        for i in range(pack.count)
+    ]
+    objects = repo / ".vrz" / "objects"
+    shas += [
+        d + f
+        for d in os.listdir(objects)
+        if len(d) == 2
+        for f in os.listdir(objects / d)
+    ]
+
+    async def read_all():
+        async with VerizonAsyncRepository(str(repo), max_workers=8) as shared:
+            return await asyncio.gather(*(shared.read_raw(sha) for sha in shas))
+
+    for _ in range(200):
+        assert None not in asyncio.run(read_all())
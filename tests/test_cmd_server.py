@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+from conftest import vrz
+
+VERIZON = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "verizon"
+)
+
+
+def test_commands_import_lazily():
+    # What main, cmd_parser and cmd_fns import is what every command, served or not, pays for.
+    proc = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, main, cmd_parser, cmd_fns; print(' '.join(sys.modules))",
+        ],
+        cwd=VERIZON,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    loaded = set(proc.stdout.split())
+    for name in [
+        "other_utils",
+        "sparse_utils",
+        "diff_utils",
+        "rename_utils",
+        "lock_utils",
+        "fsmonitor_utils",
+    ]:
+        assert name not in loaded
+
+
+def test_bench(repo):
+    out = vrz(repo, "cmd-server", "bench")
+    lines = out.splitlines()
+    assert lines[0].startswith("import main: ")
+    assert lines[1].startswith("import main, cmd_parser, cmd_fns, other_utils")
+    assert float(lines[1].split(": ")[1].split("ms")[0]) > float(
+        lines[0].split(": ")[1].split("ms")[0]
+    )
+    assert [line.split(":")[0] for line in lines[2:]] == ["rev-parse HEAD", "status"]
@@ -0,0 +1,76 @@
+import io
+import random
+
+import pytest
+
+from diff_utils import diff_lines, diff_print_unified
+
+
+def lines(text):
+    return "".join(line + "\n" for line in text.split()).encode()
+
+
+def unified(a, b, context=3):
+    out = io.BytesIO()
+    diff_print_unified(out, *diff_lines(a, b), context=context)
+    return out.getvalue()
+
+
+# The hunks git diff --histogram prints for the same contents, its hunk header function context aside.
+@pytest.mark.parametrize(
+    "a, b, expected",
+    [
+        (
+            lines("a b c d e f g h i j"),
+            lines("a B c d e f g h i j k"),
+            b"@@ -1,5 +1,5 @@\n a\n-b\n+B\n c\n d\n e\n@@ -8,3 +8,4 @@\n h\n i\n j\n+k\n",
+        ),
+        (
+            lines("a b c d e f g h i j"),
+            lines("a b c X d e f g h i j"),
+            b"@@ -1,6 +1,7 @@\n a\n b\n c\n+X\n d\n e\n f\n",
+        ),
+        # Edits 6 lines apart share their context, they're one hunk.
+        (
+            lines("1 2 3 4 5 6 7 8 9"),
+            lines("1 x 3 4 5 6 7 8 y"),
+            b"@@ -1,9 +1,9 @@\n 1\n-2\n+x\n 3\n 4\n 5\n 6\n 7\n 8\n-9\n+y\n",
+        ),
+        (
+            b"a\nb\nc\n",
+            b"a\nb\nc",
+            b"@@ -1,3 +1,3 @@\n a\n b\n-c\n+c\n\\ No newline at end of file\n",
+        ),
+        (b"", b"x\n", b"@@ -0,0 +1 @@\n+x\n"),
+        (b"x\n", b"", b"@@ -1 +0,0 @@\n-x\n"),
+        (b"same\n", b"same\n", b""),
+    ],
+)
+def test_unified_hunks(a, b, expected):
+    assert unified(a, b) == expected
+
+
+def test_edits_turn_a_into_b():
+    rng = random.Random(0)
+    for _ in range(500):
+        a = [rng.choice(b"abcde") for _ in range(rng.randint(0, 30))]
+        b = list(a)
+        for _ in range(rng.randint(0, 6)):
+            i = rng.randint(0, len(b))
+            if rng.random() < 0.5:
+                b.insert(i, rng.choice(b"abcdefxyz"))
+            elif b:
+                del b[min(i, len(b) - 1)]
+        a_lines, b_lines, edits = diff_lines(
+            b"".join(bytes([c]) + b"\n" for c in a),
+            b"".join(bytes([c]) + b"\n" for c in b),
+        )
+
+        result = list()
+        ai = 0
+        for a0, a1, b0, b1 in edits:
+            assert ai <= a0 <= a1 and b0 <= b1
+            result += a_lines[ai:a0] + b_lines[b0:b1]
+            ai = a1
+        result += a_lines[ai:]
+        assert result == b_lines
@@ -0,0 +1,95 @@
+from conftest import fast_import, vrz
+from classes import VerizonRepository
+from class_utils import object_read
+from commit_graph_utils import commit_parents
+from other_utils import ref_resolve
+
+STREAM = b"""blob
+mark :1
+data 6
+hello
+
+blob
+mark :2
+data <<END
+multi
+line
+END
+
+commit refs/heads/imported
+mark :10
+author A U <a@x> 1000 +0100
+committer C O <c@x> 1000 +0100
+data 5
+root
+
+M 100644 :1 a.txt
+M 100644 :2 "dir/with space.txt"
+M 100755 inline run.sh
+data 8
+echo hi
+
+commit refs/heads/imported
+mark :11
+committer C O <c@x> 2000 +0000
+data 7
+rename
+from :10
+R "dir/with space.txt" moved/b.txt
+C a.txt dir/copy.txt
+D run.sh
+
+commit refs/heads/side
+mark :12
+committer C O <c@x> 3000 +0000
+data 5
+side
+
+from :10
+M 100644 :1 side.txt
+
+commit refs/heads/imported
+committer C O <c@x> 4000 +0000
+data 6
+merge
+
+from :11
+merge :12
+M 100644 inline a.txt
+data 4
+new
+
+done
+"""
+
+
+def test_marks_and_renames(repo):
+    fast_import(repo, STREAM)
+
+    # The blob shas are those git fast-import gives the same stream.
+    assert vrz(repo, "ls-tree", "-r", "imported") == (
+        "100644 blob 3e757656cf36eca53338e520d134963a44f793f8\ta.txt\n"
+        "100644 blob ce013625030ba8dba906f756967f9e9ca394464a\tdir/copy.txt\n"
+        "100644 blob 622511ed6041deb2b084a943deb505c2942b3354\tmoved/b.txt\n"
+    )
+    assert vrz(repo, "ls-tree", "-r", "side") == (
+        "100644 blob ce013625030ba8dba906f756967f9e9ca394464a\ta.txt\n"
+        "100644 blob 622511ed6041deb2b084a943deb505c2942b3354\tdir/with space.txt\n"
+        "100755 blob 8b2fe5434fec16870a71cd8b272c7fcf6d352536\trun.sh\n"
+        "100644 blob ce013625030ba8dba906f756967f9e9ca394464a\tside.txt\n"
+    )
+
+    repo = VerizonRepository(str(repo))
+    merge = object_read(repo, ref_resolve(repo, "refs/heads/imported"))
+    side = ref_resolve(repo, "refs/heads/side")
+    renamed, merged = commit_parents(merge)
+    assert merged == side
+    renamed = object_read(repo, renamed)
+    assert renamed.kvlm[None] == b"rename\n"
+    # Both branches start from the commit of mark :10.
+    assert commit_parents(renamed) == commit_parents(object_read(repo, side))
+    root = object_read(repo, commit_parents(renamed)[0])
+    assert (root.kvlm[b"author"], commit_parents(root)) == (
+        b"A U <a@x> 1000 +0100",
+        list(),
+    )
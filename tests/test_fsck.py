@@ -0,0 +1,55 @@
+import hashlib
+import os
+import zlib
+
+from conftest import vrz
+from classes import VerizonRepository
+from fsck_utils import fsck
+
+
+def loose_path(repo, sha):
+    return os.path.join(repo.vrzdir, "objects", sha[:2], sha[2:])
+
+
+def test_clean(repo):
+    assert list(fsck(VerizonRepository(str(repo)), jobs=1)) == list()
+
+
+def test_corrupted_loose_object(repo):
+    repo = VerizonRepository(str(repo))
+    hello = hashlib.sha1(b"blob 6\x00hello\n").hexdigest()
+    world = hashlib.sha1(b"blob 6\x00world\n").hexdigest()
+    os.chmod(loose_path(repo, hello), 0o644)
+    with open(loose_path(repo, hello), "wb") as f:
+        f.write(zlib.compress(b"blob 6\x00HELLO\n"))
+    bad = hashlib.sha1(b"blob 6\x00HELLO\n").hexdigest()
+    os.chmod(loose_path(repo, world), 0o644)
+    with open(loose_path(repo, world), "wb") as f:
+        f.write(zlib.compress(b"blob 6\x00world\n")[:10])
+
+    problems = {sha: (kind, message) for kind, sha, message in fsck(repo, jobs=1)}
+    assert problems.pop(hello) == (
+        "error",
+        f"blob {hello}: hash mismatch, the content hashes to {bad}",
+    )
+    kind, message = problems.pop(world)
+    assert kind == "error"
+    assert message.startswith(
+        f"object {world}: unreadable in {loose_path(repo, world)}"
+    )
+    # Unreadable, it's reported once, not as missing from its tree too.
+    assert problems == dict()
+
+
+def test_missing_tree(repo):
+    d = next(
+        line.split()[2]
+        for line in vrz(repo, "ls-tree", "HEAD").splitlines()
+        if line.endswith("\td")
+    )
+    repo = VerizonRepository(str(repo))
+    os.unlink(loose_path(repo, d))
+
+    problems = list(fsck(repo, jobs=1))
+    assert [(kind, sha) for kind, sha, _ in problems] == [("missing", d)]
+    assert problems[0][2].startswith(f"missing tree {d}, from tree ")
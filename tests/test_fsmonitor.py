@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from conftest import shared_indexes, vrz
+from class_utils import index_read
+from utils import repo_find
+
+
+@pytest.fixture
+def daemon(repo):
+    vrz(repo, "fsmonitor", "start")
+    yield repo
+    vrz(repo, "fsmonitor", "stop", check=False)
+
+
+def test_start_answers(daemon):
+    assert (
+        vrz(daemon, "fsmonitor", "status")
+        == f"The fsmonitor daemon is watching {daemon}\n"
+    )
+    with pytest.raises(AssertionError, match="already running"):
+        vrz(daemon, "fsmonitor", "start")
+
+
+def test_status_through_daemon(daemon):
+    vrz(daemon, "status")
+    # The daemon answered: status recorded its token, for the next one to ask what changed since.
+    token, _ = index_read(repo_find(daemon)).fsmonitor
+    assert token
+
+    (daemon / "d" / "b.txt").write_text("changed\n")
+    (daemon / "new.txt").write_text("new\n")
+    out = vrz(daemon, "status")
+    assert "modified: d/b.txt" in out
+    assert "new.txt" in out
+    assert index_read(repo_find(daemon)).fsmonitor[0] != token
+
+
+def test_stop(daemon):
+    vrz(daemon, "fsmonitor", "stop")
+    assert (
+        vrz(daemon, "fsmonitor", "status", check=False)
+        == "The fsmonitor daemon isn't running\n"
+    )
+
+
+def test_refresh_writes_delta_only(split_repo):
+    vrz(split_repo, "fsmonitor", "start")
+    try:
+        vrz(split_repo, "status")
+        shared = shared_indexes(split_repo)
+        size = os.path.getsize(split_repo / ".vrz" / "index")
+
+        # Touched, not changed: status refreshes the entry's stat.
+        os.utime(split_repo / "f11.txt", ns=(10**9, 10**9))
+        assert "f11.txt" not in vrz(split_repo, "status")
+        index = index_read(repo_find(split_repo))
+        assert next(e for e in index.entries if e.name == "f11.txt").mtime == (1, 0)
+
+        assert shared_indexes(split_repo) == shared
+        assert os.path.getsize(split_repo / ".vrz" / "index") < size + 200
+    finally:
+        vrz(split_repo, "fsmonitor", "stop", check=False)
@@ -0,0 +1,30 @@
+import re
+
+import pytest
+
+from conftest import vrz
+from grep_utils import regex_literal
+
+
+@pytest.mark.parametrize(
+    "pattern, flags, literal",
+    [
+        ("hello", 0, b"hello"),
+        ("a+hello.*", 0, b"hello"),
+        ("hello", re.IGNORECASE, None),
+        ("(?i)hello", 0, None),
+        ("(?i:he)llo", 0, b"llo"),
+        ("(", 0, None),
+    ],
+)
+def test_regex_literal(pattern, flags, literal):
+    assert regex_literal(pattern, flags) == literal
+
+
+def test_inline_ignore_case(repo):
+    (repo / "h.txt").write_text("Say Hello\n")
+    vrz(repo, "add", "h.txt")
+    assert vrz(repo, "grep", "(?i)hello") == "a.txt:hello\nh.txt:Say Hello\n"
+    assert (
+        vrz(repo, "grep", "--cached", "(?i)HELLO") == "a.txt:hello\nh.txt:Say Hello\n"
+    )
@@ -0,0 +1,79 @@
+import os
+
+from conftest import shared_indexes, vrz
+from class_utils import index_read, index_write
+from other_utils import index_entry_from_stat
+from utils import repo_find
+
+CLEAN_STATUS = "On branch master.\nChanges to be committed.\n\nChanges not staged for commit:\n\nUntracked Files: \n"
+
+
+def ls_files(repo):
+    return vrz(repo, "ls-files").splitlines()
+
+
+def test_split_index_round_trip(split_repo):
+    repo = split_repo
+    shared = shared_indexes(repo)
+    assert len(shared) == 1
+    names = ls_files(repo)
+    assert len(names) == 52
+
+    # Modified, added, then deleted: the index file holds the changes only.
+    (repo / "f07.txt").write_text("changed\n")
+    (repo / "new.txt").write_text("new\n")
+    vrz(repo, "add", "f07.txt", "new.txt")
+    vrz(repo, "rm", "f03.txt")
+    assert shared_indexes(repo) == shared
+    names = [n for n in names if n not in ["f03.txt", "f07.txt"]] + [
+        "f07.txt",
+        "new.txt",
+    ]
+    assert ls_files(repo) == names
+    status = vrz(repo, "status")
+    assert "modified: f07.txt" in status.split("Changes not staged")[0]
+    assert "f07.txt" not in status.split("Changes not staged")[1]
+
+    # Modified again, as well as one not changed before: add -u sets the entries where they are.
+    (repo / "f07.txt").write_text("again\n")
+    (repo / "f40.txt").write_text("changed\n")
+    vrz(repo, "add", "-u")
+    assert shared_indexes(repo) == shared
+    assert ls_files(repo) == names
+    vrz(repo, "commit", "-m", "changes")
+    assert vrz(repo, "status") == CLEAN_STATUS
+
+
+def test_entry_replaced_in_place(split_repo):
+    repo = split_repo
+    shared = shared_indexes(repo)
+    before = os.path.getsize(repo / ".vrz" / "index")
+    names = ls_files(repo)
+
+    # The same content with a new mtime, the entry set where it was.
+    os.utime(repo / "f11.txt", ns=(10**9, 10**9))
+    r = repo_find(repo)
+    index = index_read(r)
+    i = names.index("f11.txt")
+    entry = index.entries[i]
+    index.entries[i] = index_entry_from_stat(
+        entry.name, entry.sha, os.stat(repo / "f11.txt")
+    )
+    index_write(r, index)
+
+    assert shared_indexes(repo) == shared
+    assert os.path.getsize(repo / ".vrz" / "index") < before + 200
+    assert ls_files(repo) == names
+    assert index_read(r).entries[i].mtime == (1, 0)
+
+
+def test_stat_refresh_writes_delta_only(split_repo):
+    repo = split_repo
+    shared = shared_indexes(repo)
+    before = os.path.getsize(repo / ".vrz" / "index")
+
+    # The same content with a new mtime: add -u only refreshes the entry's stat.
+    os.utime(repo / "f11.txt", ns=(1, 1))
+    vrz(repo, "add", "-u")
+    assert shared_indexes(repo) == shared
+    assert os.path.getsize(repo / ".vrz" / "index") < before + 200
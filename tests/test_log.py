@@ -0,0 +1,23 @@
+from conftest import vrz
+
+
+def log_messages(out):
+    return [line.split(" ", 1)[1] for line in out.splitlines()]
+
+
+def test_log_pathspec(repo):
+    (repo / "d" / "b.txt").write_text("again\n")
+    vrz(repo, "add", "d/b.txt")
+    vrz(repo, "commit", "-m", "second")
+
+    assert log_messages(vrz(repo, "log", "--", ".")) == ["second", "first"]
+    assert log_messages(vrz(repo, "log", "--", "a.txt")) == ["first"]
+    # Relative to the current directory, like git.
+    assert log_messages(vrz(repo / "d", "log", "--", "b.txt")) == ["second", "first"]
+    assert log_messages(vrz(repo / "d", "log", "--", "../a.txt")) == ["first"]
+    assert log_messages(vrz(repo / "d", "log", "--", ".")) == ["second", "first"]
+
+
+def test_log_pathspec_unborn(tmp_path):
+    vrz(tmp_path, "init", ".")
+    assert vrz(tmp_path, "log", "--", "a.txt") == ""
@@ -0,0 +1,85 @@
+import merge_base_utils
+from conftest import vrz
+from classes import VerizonCommit, VerizonRepository, VerizonTree
+from class_utils import object_write
+from merge_base_utils import is_ancestor, merge_base
+from other_utils import ref_create
+
+# A criss-cross: b and c both merged into d and e, which have them both as best common ancestors. The parents of each commit, in commit order.
+CRISS_CROSS = {
+    "a": [],
+    "b": ["a"],
+    "c": ["a"],
+    "d": ["b", "c"],
+    "e": ["c", "b"],
+    "f": ["d"],
+}
+
+
+def criss_cross(path):
+    vrz(path, "init", ".")
+    repo = VerizonRepository(str(path))
+    tree = object_write(VerizonTree(), repo)
+
+    shas = dict()
+    for time, (name, parents) in enumerate(CRISS_CROSS.items(), 1):
+        commit = VerizonCommit()
+        commit.kvlm[b"tree"] = tree.encode("ascii")
+        if parents:
+            commit.kvlm[b"parent"] = [shas[p].encode("ascii") for p in parents]
+        commit.kvlm[b"author"] = commit.kvlm[
+            b"committer"
+        ] = f"T <t@x> {time} +0000".encode("ascii")
+        commit.kvlm[None] = name.encode("ascii")
+        shas[name] = object_write(commit, repo)
+        ref_create(repo, f"heads/{name}", shas[name])
+    return shas
+
+
+def test_criss_cross(tmp_path):
+    shas = criss_cross(tmp_path)
+    names = {sha: name for name, sha in shas.items()}
+
+    def bases(*commits, all=False):
+        args = ["merge-base"] + (["--all"] if all else []) + list(commits)
+        return sorted(names[sha] for sha in vrz(tmp_path, *args).split())
+
+    assert bases("d", "e", all=True) == ["b", "c"]
+    assert bases("f", "e", all=True) == ["b", "c"]
+    # The most recent of the two.
+    assert bases("d", "e") == ["c"]
+    assert bases("b", "c", all=True) == ["a"]
+    assert bases("f", "d", all=True) == ["d"]
+
+    vrz(tmp_path, "merge-base", "--is-ancestor", "a", "f")
+    vrz(tmp_path, "merge-base", "--is-ancestor", "c", "f")
+    assert vrz(tmp_path, "merge-base", "--is-ancestor", "e", "f", check=False) == ""
+
+    # The same answers from the commit-graph.
+    vrz(tmp_path, "commit-graph", "write")
+    assert bases("d", "e", all=True) == ["b", "c"]
+    assert bases("f", "e", all=True) == ["b", "c"]
+
+
+def test_commit_table_cached(tmp_path, monkeypatch):
+    shas = criss_cross(tmp_path)
+    loads = list()
+    load = merge_base_utils.commit_table_load
+    monkeypatch.setattr(
+        merge_base_utils,
+        "commit_table_load",
+        lambda repo: loads.append(1) or load(repo),
+    )
+
+    repo = VerizonRepository(str(tmp_path))
+    assert is_ancestor(repo, shas["a"], shas["f"])
+    assert not is_ancestor(repo, shas["e"], shas["f"])
+    assert sorted(merge_base(repo, shas["d"], [shas["e"]], find_all=True)) == sorted(
+        [shas["b"], shas["c"]]
+    )
+    assert len(loads) == 1
+
+    # A new commit-graph, a new table.
+    vrz(tmp_path, "commit-graph", "write")
+    assert is_ancestor(repo, shas["b"], shas["f"])
+    assert len(loads) == 2
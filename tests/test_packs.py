@@ -0,0 +1,111 @@
+import hashlib
+import threading
+
+import pack_utils
+from conftest import fetch_commit, vrz
+from bitmap_utils import repo_bitmap
+from classes import VerizonRepository
+from class_utils import object_read_raw, object_sets, object_stores, packs_load
+from pack_utils import objects_missing, repack
+
+
+def test_concurrent_first_reads(repo, tmp_path):
+    # Several packs, and no loose copies of what's in them: a pack each fetch.
+    for i in range(4):
+        fetch_commit(repo, tmp_path / f"src{i}", {"f.txt": f"{i}\n"})
+    packs = packs_load(VerizonRepository(str(repo)))
+    assert len(packs) > 1
+    shas = [pack.sha(i) for pack in packs for i in range(pack.count)]
+
+    misses = list()
+    for _ in range(50):
+        # Every thread's read is the first of a repository they share.
+        shared = VerizonRepository(str(repo))
+        barrier = threading.Barrier(8)
+
+        def read(sha):
+            barrier.wait()
+            if object_read_raw(shared, sha) is None:
+                misses.append(sha)
+
+        threads = [
+            threading.Thread(target=read, args=(shas[-1 - k],)) for k in range(8)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    assert misses == list()
+
+
+def test_repack_delete_then_read(repo):
+    # Read before the new objects are written and packed: its object set and its log offset are from then.
+    shared = VerizonRepository(str(repo))
+    store = object_stores(shared)[0]
+    object_sets(shared)
+
+    (repo / "n.txt").write_text("new\n")
+    vrz(repo, "add", "n.txt")
+    vrz(repo, "commit", "-m", "second")
+    sha = hashlib.sha1(b"blob 4\x00new\n").hexdigest()
+
+    # Read before the repack, by another repository.
+    other = VerizonRepository(str(repo))
+    assert object_read_raw(other, sha) == (b"blob", b"new\n")
+    packs_load(other)
+
+    repack(shared, delete=True)
+    assert not (repo / ".vrz" / "objects" / sha[:2] / sha[2:]).exists()
+    # The loose objects deleted aren't logged into the new object set again.
+    assert sha not in object_sets(shared)[store]
+    assert sha not in object_sets(VerizonRepository(str(repo)))[store]
+
+    assert object_read_raw(shared, sha) == (b"blob", b"new\n")
+    # The other one still lists the loose copy: it's read from the new pack instead.
+    assert object_read_raw(other, sha) == (b"blob", b"new\n")
+
+
+def commits(repo, branch, start, end, parent):
+    """Commit start to end - 1 on branch, which starts at parent: each adds a file and changes top.txt. Return the last one."""
+    (repo / ".vrz" / "refs" / "heads" / branch).write_text(parent + "\n")
+    (repo / ".vrz" / "HEAD").write_text(f"ref: refs/heads/{branch}\n")
+    for i in range(start, end):
+        (repo / f"d{i % 3}").mkdir(exist_ok=True)
+        (repo / f"d{i % 3}" / f"f{i}.txt").write_text(f"{i}\n")
+        (repo / "top.txt").write_text(f"{i}\n")
+        vrz(repo, "add", f"d{i % 3}/f{i}.txt", "top.txt")
+        vrz(repo, "commit", "-m", "c")
+    return vrz(repo, "rev-parse", branch).strip()
+
+
+def test_bitmap_objects_missing_matches_walk(repo, monkeypatch):
+    first = vrz(repo, "rev-parse", "HEAD").strip()
+    old = commits(repo, "old", 0, 12, first)
+    vrz(repo, "repack", "--write-bitmap", "-d")
+    # New commits, loose, the bitmaps don't cover.
+    new = commits(repo, "new", 12, 15, old)
+    # Back to the files of first, for side to share only those with the others.
+    vrz(repo, "rm", "top.txt", *[f"d{i % 3}/f{i}.txt" for i in range(15)])
+    side = commits(repo, "side", 15, 17, first)
+
+    bitmapped = VerizonRepository(str(repo))
+    assert repo_bitmap(bitmapped) is not None
+    cases = [
+        ([new], [old]),
+        ([new], [first]),
+        ([new, side], [old]),
+        ([old], list()),
+        ([side], [new]),
+        ([new], ["0" * 40]),
+    ]
+    found = [objects_missing(bitmapped, wants, haves) for wants, haves in cases]
+
+    monkeypatch.setattr(
+        pack_utils, "bitmap_objects_missing", lambda repo, wants, haves: None
+    )
+    walked = VerizonRepository(str(repo))
+    for (wants, haves), shas in zip(cases, found):
+        expected = objects_missing(walked, wants, haves)
+        assert len(expected) == len(set(expected))
+        assert sorted(shas) == sorted(expected)
@@ -0,0 +1,79 @@
+import os
+import threading
+
+import pytest
+
+from classes import VerizonRepository
+from other_utils import ref_resolve, refs_update
+
+
+def sha(n):
+    return f"{n:040x}"
+
+
+def test_concurrent_updates_lose_nothing(repo):
+    repo = VerizonRepository(str(repo))
+    refs_update(repo, [("refs/heads/counter", None, sha(0))])
+    barrier = threading.Barrier(8)
+    conflicts = list()
+
+    def increment():
+        barrier.wait()
+        for _ in range(10):
+            # Compare and swap until the value read is still the one there.
+            while True:
+                current = ref_resolve(repo, "refs/heads/counter")
+                try:
+                    refs_update(
+                        repo,
+                        [("refs/heads/counter", current, sha(int(current, 16) + 1))],
+                    )
+                    break
+                except Exception as e:
+                    assert "expected" in str(e)
+                    conflicts.append(current)
+
+    threads = [threading.Thread(target=increment) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert ref_resolve(repo, "refs/heads/counter") == sha(80)
+    assert not [
+        name
+        for name in os.listdir(os.path.join(repo.vrzdir, "refs", "heads"))
+        if name.endswith(".lock")
+    ]
+    assert not os.listdir(os.path.join(repo.vrzdir, "refs", "heads")) == [
+        "counter.lock"
+    ]
+
+
+def test_conflict_updates_nothing(repo):
+    repo = VerizonRepository(str(repo))
+    refs_update(repo, [("refs/heads/a", None, sha(1)), ("refs/heads/b", None, sha(2))])
+
+    # b isn't at what's expected: a stays where it was too.
+    with pytest.raises(
+        Exception, match=f"Ref refs/heads/b is at {sha(2)}, expected {sha(3)}"
+    ):
+        refs_update(
+            repo, [("refs/heads/a", sha(1), sha(4)), ("refs/heads/b", sha(3), None)]
+        )
+    assert (ref_resolve(repo, "refs/heads/a"), ref_resolve(repo, "refs/heads/b")) == (
+        sha(1),
+        sha(2),
+    )
+
+    # A ref which must not exist yet.
+    with pytest.raises(Exception, match="is at"):
+        refs_update(repo, [("refs/heads/a", None, sha(5))])
+
+    refs_update(
+        repo, [("refs/heads/a", sha(1), None), ("refs/heads/b", sha(2), sha(6))]
+    )
+    assert (ref_resolve(repo, "refs/heads/a"), ref_resolve(repo, "refs/heads/b")) == (
+        None,
+        sha(6),
+    )
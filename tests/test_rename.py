@@ -0,0 +1,46 @@
+import zlib
+
+import rename_utils
+from classes import VerizonBlob, VerizonDiffPair, VerizonRepository
+from class_utils import object_write
+from rename_utils import detect_renames, sketch_compute
+
+
+def test_sketch_skips_blank_lines():
+    sketch, count = sketch_compute(b"a\n\n  \nb\n\t\n")
+    assert count == 2
+    assert zlib.crc32(b"") not in sketch
+    assert sketch_compute(b"\n\n") == (frozenset(), 0)
+
+
+def test_common_lines_make_no_candidates(repo, monkeypatch):
+    repo = VerizonRepository(str(repo))
+    # Files of a blank line and a license header each, then lines of their own.
+    header = b"# Copyright\n# License\n\n"
+    deleted = list()
+    for i in range(50):
+        data = header + b"".join(b"line %d of file %d\n" % (j, i) for j in range(20))
+        deleted.append(
+            VerizonDiffPair(
+                f"old{i}.txt", None, object_write(VerizonBlob(data), repo), None
+            )
+        )
+    renamed = (
+        header + b"".join(b"line %d of file 7\n" % j for j in range(18)) + b"one more\n"
+    )
+    added = VerizonDiffPair(
+        None, "new.txt", None, object_write(VerizonBlob(renamed), repo)
+    )
+
+    compared = list()
+    similarity = rename_utils.sketch_similarity
+    monkeypatch.setattr(
+        rename_utils,
+        "sketch_similarity",
+        lambda a, b: compared.append(1) or similarity(a, b),
+    )
+
+    pairs = detect_renames(repo, deleted + [added])
+    renames = [p for p in pairs if p.status == "renamed"]
+    assert [(p.old_path, p.new_path) for p in renames] == [("old7.txt", "new.txt")]
+    assert len(compared) == 1
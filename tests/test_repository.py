@@ -0,0 +1,22 @@
+import hashlib
+
+from conftest import fetch_commit, vrz
+from repository_utils import VerizonCachedRepository
+
+
+def test_cached_repository_sees_store_changes(repo, tmp_path):
+    world = hashlib.sha1(b"blob 6\x00world\n").hexdigest()
+    with VerizonCachedRepository(str(repo)) as cached:
+        head = cached.resolve("HEAD")
+        assert cached.read_raw(world) == (b"blob", b"world\n")
+        # Looked for in the packs: there are none yet.
+        assert cached.read_raw("0" * 40) is None
+
+        # Another process packs the loose objects, then writes a pack of its own.
+        vrz(repo, "repack", "-d")
+        fetch_commit(repo, tmp_path / "src", {"i.txt": "imported\n"})
+        imported = hashlib.sha1(b"blob 9\x00imported\n").hexdigest()
+
+        assert cached.read_raw(imported) == (b"blob", b"imported\n")
+        assert cached.read(head).fmt == b"commit"
+        assert [sha for sha, _ in cached.walk_commits("HEAD")] == [head]
@@ -0,0 +1,88 @@
+import asyncio
+import hashlib
+import os
+
+from conftest import fetch_commit, vrz
+from server_utils import http_response_read, server_start
+
+
+async def request(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode("ascii"))
+    await writer.drain()
+    try:
+        return await http_response_read(reader)
+    finally:
+        writer.close()
+
+
+def test_pack_aborted_frees_worker(repo):
+    # Enough objects of incompressible data for the pack to fill the queue and the socket buffers.
+    names = [f"big{i}.bin" for i in range(64)]
+    for name in names:
+        (repo / name).write_bytes(os.urandom(128 * 1024))
+    vrz(repo, "add", *names)
+    vrz(repo, "commit", "-m", "big")
+    head = vrz(repo, "rev-parse", "HEAD").strip()
+
+    async def scenario():
+        # A single worker: if the aborted pack kept it, nothing else would be served.
+        server = await server_start({"repo": str(repo)}, "127.0.0.1", 0, workers=1)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            for _ in range(3):
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(
+                    f"GET /repo/pack?want={head} HTTP/1.1\r\n\r\n".encode("ascii")
+                )
+                await writer.drain()
+                await reader.readexactly(64 * 1024)
+                writer.transport.abort()
+
+            status, _, body = await asyncio.wait_for(request(port, "/repo/refs"), 10)
+            assert status == 200
+            assert f"{head} HEAD\n".encode("ascii") in body
+
+    asyncio.run(scenario())
+
+
+def test_repository_reopened_after_repack(repo, tmp_path):
+    world = hashlib.sha1(b"blob 6\x00world\n").hexdigest()
+    unknown = "0" * 40
+
+    async def scenario():
+        server = await server_start({"repo": str(repo)}, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            head = (await request(port, "/repo/refs"))[2].split()[0].decode("ascii")
+            # Read once: the packs and object sets are loaded.
+            assert (await request(port, f"/repo/objects/{unknown}"))[0] == 404
+
+            # Packs and deletes what the server has read the object sets of.
+            (repo / "n.txt").write_text("new\n")
+            vrz(repo, "add", "n.txt")
+            vrz(repo, "commit", "-m", "second")
+            vrz(repo, "repack", "-d")
+            new = hashlib.sha1(b"blob 4\x00new\n").hexdigest()
+            # And a pack of its own, of objects never loose, like a push or a fetch writes.
+            fetch_commit(repo, tmp_path / "src", {"i.txt": "imported\n"})
+            imported = hashlib.sha1(b"blob 9\x00imported\n").hexdigest()
+
+            for sha, content in [
+                (imported, b"imported\n"),
+                (world, b"world\n"),
+                (new, b"new\n"),
+            ]:
+                status, headers, body = await request(port, f"/repo/objects/{sha}")
+                assert (status, headers["x-object-type"], body) == (
+                    200,
+                    "blob",
+                    content,
+                )
+
+            status, _, _ = await request(port, f"/repo/pack?want={head}&have={unknown}")
+            assert status == 200
+            status, _, _ = await request(port, f"/repo/pack?want={unknown}")
+            assert status == 404
+
+    asyncio.run(scenario())
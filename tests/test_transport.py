@@ -0,0 +1,55 @@
+from conftest import vrz
+
+
+def fetched(path):
+    """The sha of each branch of the last fetch of a url, from FETCH_HEAD."""
+    with open(path / ".vrz" / "FETCH_HEAD") as f:
+        return [line.split("\t")[0] for line in f]
+
+
+def assert_same_tree(src, dst, commit):
+    """dst has every tree and blob of commit, the same as src."""
+    listing = vrz(src, "ls-tree", "-r", commit)
+    assert vrz(dst, "ls-tree", "-r", commit) == listing
+    for line in listing.splitlines():
+        sha = line.split()[2]
+        assert vrz(dst, "cat-file", "blob", sha) == vrz(src, "cat-file", "blob", sha)
+
+
+def test_fetch_over_pipe(repo, tmp_path):
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    vrz(dst, "init", ".")
+
+    vrz(dst, "fetch", f"pipe:{repo}")
+    head = vrz(repo, "rev-parse", "HEAD").strip()
+    assert fetched(dst) == [head]
+    assert (
+        vrz(dst, "cat-file", "blob", vrz(repo, "ls-tree", "HEAD").split()[2])
+        == "hello\n"
+    )
+
+    # Again with a new commit: only what's missing is sent, after negotiating with what dst has.
+    (repo / "a.txt").write_text("hello again\n")
+    vrz(repo, "add", "a.txt")
+    vrz(repo, "commit", "-m", "second")
+    vrz(dst, "fetch", f"pipe:{repo}")
+    head = vrz(repo, "rev-parse", "HEAD").strip()
+    assert fetched(dst) == [head]
+    assert vrz(dst, "cat-file", "commit", head) == vrz(repo, "cat-file", "commit", head)
+    assert_same_tree(repo, dst, head)
+    assert "error" not in vrz(dst, "fsck")
+
+
+def test_push_over_pipe(repo, tmp_path):
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    vrz(dst, "init", ".")
+    # Pushed to a branch dst hasn't checked out, master being refused.
+    (dst / ".vrz" / "HEAD").write_text("ref: refs/heads/other\n")
+
+    vrz(repo, "push", f"pipe:{dst}", "master")
+    head = vrz(repo, "rev-parse", "HEAD").strip()
+    assert vrz(dst, "show-ref") == f"{head} refs/heads/master\n"
+    assert_same_tree(repo, dst, head)
+    assert "error" not in vrz(dst, "fsck")
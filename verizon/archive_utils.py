@@ -0,0 +1,149 @@
+import io
+import stat
+import tarfile
+import time
+import zipfile
+
+from classes import VerizonObjectCache
+from class_utils import object_find, object_read, object_read_stream
+from commit_graph_utils import commit_time
+
+ARCHIVE_FORMATS = ["tar", "tar.gz", "zip"]
+
+# Blobs up to this size are kept once read, so identical files are read once. Bigger ones are streamed again.
+ARCHIVE_CACHE_MAX_OBJECT_SIZE = 1024 * 1024
+
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+
+class ChunkReader:
+    """A file-like object reading from an iterator of chunks, for tarfile to copy a blob from as it's inflated."""
+
+    def __init__(self, chunks) -> None:
+        self.chunks = chunks
+        self.buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def archive_format(path):
+    """Guess the format from an output file name, tar by default."""
+    for fmt in ("tar.gz", "tgz", "zip", "tar"):
+        if path and path.endswith("." + fmt):
+            return "tar.gz" if fmt == "tgz" else fmt
+    return "tar"
+
+
+def archive_entries(repo, tree_sha, prefix=""):
+    """Yield (path, mode, sha) of every directory and file below tree_sha, parents first. Submodules have nothing to archive."""
+    for leaf in object_read(repo, tree_sha).items:
+        path = prefix + leaf.path
+        mode = int(leaf.mode, 8)
+
+        if stat.S_ISDIR(mode):
+            yield path + "/", mode, leaf.sha
+            yield from archive_entries(repo, leaf.sha, path + "/")
+        elif not leaf.mode.startswith(b"16"):
+            yield path, mode, leaf.sha
+
+
+def archive_blob(repo, sha, cache):
+    """Return (size, reader) of a blob: from the cache when it's been read before, streamed otherwise."""
+    cached = cache.get(sha)
+    if cached is not None:
+        return len(cached[1]), io.BytesIO(cached[1])
+
+    opened = object_read_stream(repo, sha, ARCHIVE_CHUNK_SIZE)
+    if opened is None:
+        raise Exception(f"Missing object {sha}")
+    fmt, size, chunks = opened
+
+    if size <= ARCHIVE_CACHE_MAX_OBJECT_SIZE:
+        data = b"".join(chunks)
+        cache.put(sha, fmt, data)
+        return size, io.BytesIO(data)
+    return size, ChunkReader(chunks)
+
+
+def archive(repo, name, out, fmt="tar", prefix=""):
+    """Write the tree of name, a tree-ish, to out as a tar, tar.gz or zip archive, without touching the worktree. Files get the commit's time, or the current time for a bare tree. out needn't be seekable, blobs are streamed to it as they're inflated."""
+    if fmt not in ARCHIVE_FORMATS:
+        raise Exception(f"Unknown archive format: {fmt}")
+
+    sha = object_find(repo, name)
+    obj = object_read(repo, sha)
+    mtime = commit_time(obj) if obj.fmt == b"commit" else int(time.time())
+    tree_sha = object_find(repo, sha, fmt=b"tree")
+
+    cache = VerizonObjectCache()
+    if fmt == "zip":
+        archive_zip(repo, tree_sha, out, prefix, mtime, cache)
+    else:
+        archive_tar(repo, tree_sha, out, fmt, prefix, mtime, cache)
+
+
+def archive_tar(repo, tree_sha, out, fmt, prefix, mtime, cache):
+    # Stream modes, which never seek back in out.
+    mode = "w|gz" if fmt == "tar.gz" else "w|"
+    with tarfile.open(fileobj=out, mode=mode, format=tarfile.PAX_FORMAT) as tar:
+        for path, leaf_mode, sha in archive_entries(repo, tree_sha):
+            info = tarfile.TarInfo(prefix + path)
+            info.mtime = mtime
+            info.uname = info.gname = "root"
+
+            if stat.S_ISDIR(leaf_mode):
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o775
+                tar.addfile(info)
+            elif stat.S_ISLNK(leaf_mode):
+                info.type = tarfile.SYMTYPE
+                info.mode = 0o777
+                info.linkname = archive_blob(repo, sha, cache)[1].read().decode("utf8")
+                tar.addfile(info)
+            else:
+                info.mode = 0o775 if leaf_mode & 0o100 else 0o664
+                info.size, reader = archive_blob(repo, sha, cache)
+                tar.addfile(info, reader)
+
+
+def archive_zip(repo, tree_sha, out, prefix, mtime, cache):
+    date_time = time.localtime(max(mtime, 315532800))[:6]  # zip dates start in 1980.
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for path, leaf_mode, sha in archive_entries(repo, tree_sha):
+            info = zipfile.ZipInfo(prefix + path, date_time)
+            info.create_system = (
+                3  # Unix, for the permissions in external_attr to be used.
+            )
+
+            if stat.S_ISDIR(leaf_mode):
+                info.external_attr = (stat.S_IFDIR | 0o775) << 16 | 0x10
+                zf.writestr(info, b"")
+                continue
+
+            size, reader = archive_blob(repo, sha, cache)
+            if stat.S_ISLNK(leaf_mode):
+                info.external_attr = (stat.S_IFLNK | 0o777) << 16
+            else:
+                info.external_attr = (
+                    stat.S_IFREG | (0o775 if leaf_mode & 0o100 else 0o664)
+                ) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.file_size = size
+
+            with zf.open(info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as f:
+                while True:
+                    chunk = reader.read(ARCHIVE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
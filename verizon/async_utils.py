@@ -0,0 +1,123 @@
+import asyncio
+import heapq
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from classes import VerizonObjectCache, VerizonRepository
+from class_utils import (
+    index_read,
+    object_build,
+    object_find,
+    object_read_raw,
+    object_write,
+)
+from commit_graph_utils import commit_parents, commit_time
+from other_utils import ref_resolve
+
+
+class VerizonAsyncRepository:
+    """An awaitable facade over a repository, for event-loop services. Every file access and every inflate runs in a pool of max_workers threads, and concurrent reads of the same sha share a single read. The threads share the repository, whose packs and object sets are loaded once, see REPO_LOAD_LOCK.
+
+    async with VerizonAsyncRepository(path) as repo:
+        commit = await repo.read(await repo.resolve("HEAD"))
+    """
+
+    def __init__(self, repo, max_workers=8, cache=None) -> None:
+        if not isinstance(repo, VerizonRepository):
+            repo = VerizonRepository(os.path.realpath(repo))
+
+        self.repo = repo
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.cache = cache if cache is not None else VerizonObjectCache()
+        self.inflight: dict[
+            str, asyncio.Future
+        ] = dict()  # sha to the future of the read already running for it.
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    def read_raw_sync(self, sha):
+        raw = self.cache.get(sha)
+        if raw is None:
+            raw = object_read_raw(self.repo, sha)
+            if raw is not None:
+                self.cache.put(sha, *raw)
+        return raw
+
+    async def read_raw(self, sha):
+        """Return (fmt, data) of an object, or None."""
+        future = self.inflight.get(sha)
+        if future is None:
+            future = asyncio.ensure_future(self.run(self.read_raw_sync, sha))
+            self.inflight[sha] = future
+            future.add_done_callback(lambda _: self.inflight.pop(sha, None))
+
+        # The future is shielded, a cancelled reader mustn't cancel the read for the others.
+        return await asyncio.shield(future)
+
+    async def read(self, sha):
+        """Return the object sha, or None."""
+        raw = await self.read_raw(sha)
+        if raw is None:
+            return None
+        return await self.run(object_build, sha, *raw)
+
+    async def write(self, obj):
+        return await self.run(object_write, obj, self.repo)
+
+    async def resolve(self, name, fmt=None, follow=True):
+        """The sha of a name, like object_find."""
+        return await self.run(object_find, self.repo, name, fmt, follow)
+
+    async def ref(self, ref):
+        return await self.run(ref_resolve, self.repo, ref)
+
+    async def index(self):
+        return await self.run(index_read, self.repo)
+
+    async def walk_tree(self, name, prefix=""):
+        """Yield (path, leaf) for every file below the tree of name, a tree or a commit. The subtrees of a tree are all read at once, while its files are being yielded."""
+        sha = await self.resolve(name, fmt=b"tree") if prefix == "" else name
+        tree = await self.read(sha)
+
+        subtrees = list()
+        for leaf in tree.items:
+            path = prefix + leaf.path
+            if leaf.mode.startswith(b"04"):
+                subtrees.append(
+                    (path, asyncio.ensure_future(self.read_raw(leaf.sha)), leaf)
+                )
+            else:
+                yield path, leaf
+
+        for path, prefetch, leaf in subtrees:
+            await prefetch
+            async for item in self.walk_tree(leaf.sha, path + "/"):
+                yield item
+
+    async def walk_history(self, name):
+        """Yield (sha, commit) for every commit reachable from name, newest first. The parents of a commit are read as soon as it's reached."""
+        sha = await self.resolve(name, fmt=b"commit")
+        commit = await self.read(sha)
+
+        seen = set([sha])
+        queue = [(-commit_time(commit), sha, commit)]
+        while queue:
+            _, sha, commit = heapq.heappop(queue)
+            yield sha, commit
+
+            parents = [p for p in commit_parents(commit) if p not in seen]
+            seen.update(parents)
+            for parent, obj in zip(
+                parents, await asyncio.gather(*map(self.read, parents))
+            ):
+                heapq.heappush(queue, (-commit_time(obj), parent, obj))
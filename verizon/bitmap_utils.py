@@ -0,0 +1,320 @@
+import hashlib
+import os
+import struct
+
+from classes import VerizonBitmapIndex
+from class_utils import object_read, packs_load
+from commit_graph_utils import commit_parents
+
+# Besides the ref tips, one commit in this many, newest first, gets a bitmap: a query never walks much more than this many commits.
+BITMAP_COMMIT_INTERVAL = 100
+
+EWAH_ALL_ONES = (1 << 64) - 1
+EWAH_MAX_RUN = (1 << 32) - 1
+EWAH_MAX_LITERALS = (1 << 31) - 1
+
+
+def ewah_encode(bits, nbits):
+    """Compress a bitmap, bytes with bit i in byte i // 8, as EWAH: each marker word tells how many words of all zeroes or all ones come next, and how many literal words follow them. Sparse and dense runs cost nothing."""
+    nwords = (nbits + 63) // 64
+    bits = bytes(bits).ljust(nwords * 8, b"\x00")
+    words = struct.unpack(f"<{nwords}Q", bits)
+
+    out = list()
+    i = 0
+    while i < nwords:
+        run_bit = 0
+        run = 0
+        if words[i] in (0, EWAH_ALL_ONES):
+            run_bit = 1 if words[i] == EWAH_ALL_ONES else 0
+            fill = words[i]
+            while i < nwords and words[i] == fill and run < EWAH_MAX_RUN:
+                run += 1
+                i += 1
+
+        start = i
+        while (
+            i < nwords
+            and words[i] not in (0, EWAH_ALL_ONES)
+            and i - start < EWAH_MAX_LITERALS
+        ):
+            i += 1
+
+        out.append(run_bit | (run << 1) | ((i - start) << 33))
+        out.extend(words[start:i])
+
+    return VerizonBitmapIndex.ewah_header.pack(nbits, len(out)) + struct.pack(
+        f">{len(out)}Q", *out
+    )
+
+
+def ewah_decode(data, at):
+    """Inflate the EWAH bitmap at offset at of data back to bytes."""
+    nbits, num_words = VerizonBitmapIndex.ewah_header.unpack_from(data, at)
+    words = struct.unpack_from(
+        f">{num_words}Q", data, at + VerizonBitmapIndex.ewah_header.size
+    )
+
+    out = list()
+    i = 0
+    while i < num_words:
+        marker = words[i]
+        run = (marker >> 1) & EWAH_MAX_RUN
+        literals = marker >> 33
+        out.extend([EWAH_ALL_ONES if marker & 1 else 0] * run)
+        out.extend(words[i + 1 : i + 1 + literals])
+        i += 1 + literals
+
+    return struct.pack(f"<{len(out)}Q", *out)[: (nbits + 7) // 8]
+
+
+def bits_or(a, b):
+    """OR two bitmaps of the same size, as Python ints: one pass in C instead of one per byte."""
+    n = len(a)
+    return bytearray(
+        (int.from_bytes(a, "little") | int.from_bytes(b[:n], "little")).to_bytes(
+            n, "little"
+        )
+    )
+
+
+def bits_and_not(a, b):
+    n = len(a)
+    return (
+        int.from_bytes(a, "little") & ~int.from_bytes(b[:n].ljust(n, b"\x00"), "little")
+    ).to_bytes(n, "little")
+
+
+def bits_count(a, b=None):
+    """Count the bits set in a, or in both a and b."""
+    value = int.from_bytes(a, "little")
+    if b is not None:
+        value &= int.from_bytes(b[: len(a)], "little")
+    return value.bit_count()
+
+
+def bits_positions(bits):
+    for i, byte in enumerate(bits):
+        while byte:
+            low = byte & -byte
+            yield i * 8 + low.bit_length() - 1
+            byte ^= low
+
+
+def bitmap_path(pack):
+    return pack.pack_path[: -len(".pack")] + ".bitmap"
+
+
+def pack_bitmap(pack):
+    """The bitmap index of pack, or None when it has none."""
+    if pack.bitmap is None:
+        pack.bitmap = False
+        path = bitmap_path(pack)
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            bitmap = VerizonBitmapIndex(data)
+            if (
+                hashlib.sha1(data[:-20]).digest() == data[-20:]
+                and bitmap.pack_checksum == pack.pack_checksum()
+            ):
+                pack.bitmap = bitmap
+
+    return pack.bitmap or None
+
+
+def repo_bitmap(repo):
+    """Return (pack, bitmap) of the first pack of repo with bitmaps, or None."""
+    for pack in packs_load(repo):
+        bitmap = pack_bitmap(pack)
+        if bitmap is not None:
+            return pack, bitmap
+    return None
+
+
+def pack_position(pack, bitmap, sha):
+    pos = pack.position(sha)
+    return None if pos is None else bitmap.index_to_pack[pos]
+
+
+def bitmap_walk(repo, position, tips, bits, extra, commit_bitmap):
+    """Set in bits every object reachable from tips, walking until each line of history reaches a commit with a bitmap, or an object already set. position gives the pack position of a sha, objects outside the pack go to extra.
+
+    A tree is only set once everything below it is, so a set tree is never walked again.
+    """
+    stack = list(tips)
+    while stack:
+        sha = stack.pop()
+        pos = position(sha)
+
+        if pos is not None:
+            if bits[pos >> 3] & (1 << (pos & 7)):
+                continue
+            stored = commit_bitmap(pos)
+            if stored is not None:
+                bits[:] = bits_or(bits, stored)
+                continue
+        elif sha in extra:
+            continue
+
+        obj = object_read(repo, sha)
+        if obj is None:
+            raise Exception(f"Missing object {sha}")
+
+        if pos is not None:
+            bits[pos >> 3] |= 1 << (pos & 7)
+        else:
+            extra.add(sha)
+
+        if obj.fmt == b"tag":
+            stack.append(obj.kvlm[b"object"].decode("ascii"))
+        elif obj.fmt == b"commit":
+            stack.extend(commit_parents(obj))
+            stack.append(obj.kvlm[b"tree"].decode("ascii"))
+        elif obj.fmt == b"tree":
+            for leaf in obj.items:
+                if leaf.mode.startswith(b"16"):
+                    continue
+                if leaf.mode.startswith(b"04"):
+                    stack.append(leaf.sha)
+                    continue
+
+                # Blobs have nothing below them, no need to read them.
+                leaf_pos = position(leaf.sha)
+                if leaf_pos is not None:
+                    bits[leaf_pos >> 3] |= 1 << (leaf_pos & 7)
+                else:
+                    extra.add(leaf.sha)
+
+
+def bitmap_reachable(repo, pack, bitmap, tips):
+    """Return (bits, extra): the objects reachable from tips, as a bitmap over the pack, plus the shas of those outside it."""
+    bits = bytearray((bitmap.count + 7) // 8)
+    extra = set()
+
+    def commit_bitmap(pos):
+        at = bitmap.commits.get(pos)
+        return None if at is None else ewah_decode(bitmap.data, at)
+
+    def position(sha):
+        return pack_position(pack, bitmap, sha)
+
+    bitmap_walk(repo, position, tips, bits, extra, commit_bitmap)
+    return bits, extra
+
+
+def bitmap_objects_missing(repo, wants, haves):
+    """objects_missing with bitmaps: the objects reachable from wants AND NOT from haves, in pack order. None when the repository has no bitmaps."""
+    found = repo_bitmap(repo)
+    if found is None:
+        return None
+    pack, bitmap = found
+
+    want_bits, want_extra = bitmap_reachable(repo, pack, bitmap, wants)
+    have_bits, have_extra = bitmap_reachable(repo, pack, bitmap, haves)
+
+    bits = bits_and_not(want_bits, have_bits)
+    ret = [pack.sha(bitmap.order[pos]) for pos in bits_positions(bits)]
+    ret.extend(sorted(want_extra - have_extra))
+    return ret
+
+
+def bitmap_count(repo, tips):
+    """Count the objects reachable from tips by type, with bitmaps. None when the repository has none."""
+    found = repo_bitmap(repo)
+    if found is None:
+        return None
+    pack, bitmap = found
+
+    bits, extra = bitmap_reachable(repo, pack, bitmap, tips)
+    ret = {
+        fmt.decode("ascii"): bits_count(bits, ewah_decode(bitmap.data, at))
+        for fmt, at in bitmap.types.items()
+    }
+    for sha in extra:
+        fmt = object_read(repo, sha).fmt.decode("ascii")
+        ret[fmt] += 1
+    return ret
+
+
+def commits_topological(commits):
+    """Order commits, a dict of sha to parents, parents first."""
+    ret = list()
+    done = set()
+    for sha in commits:
+        stack = [(sha, False)]
+        while stack:
+            cur, expanded = stack.pop()
+            if cur in done:
+                continue
+            if expanded:
+                done.add(cur)
+                ret.append(cur)
+                continue
+            stack.append((cur, True))
+            stack.extend(
+                (p, False) for p in commits[cur] if p in commits and p not in done
+            )
+    return ret
+
+
+def bitmap_write(repo, pack, entries, tips):
+    """Write the bitmap index of pack, whose entries are (sha, offset, fmt) in pack order. Ref tips, and one commit in BITMAP_COMMIT_INTERVAL, get a bitmap."""
+    count = len(entries)
+    nbytes = (count + 7) // 8
+
+    order = [pack.position(sha) for sha, _, _ in entries]
+    types = {fmt: bytearray(nbytes) for fmt in (b"commit", b"tree", b"blob", b"tag")}
+    commits = dict()
+    for pos, (sha, _, fmt) in enumerate(entries):
+        types[fmt][pos >> 3] |= 1 << (pos & 7)
+        if fmt == b"commit":
+            commits[sha] = commit_parents(object_read(repo, sha))
+
+    # Pack order is newest commits first.
+    selected = set(tip for tip in tips if tip in commits)
+    selected.update(
+        sha for i, sha in enumerate(commits) if i % BITMAP_COMMIT_INTERVAL == 0
+    )
+
+    # Ancestors first, so each bitmap starts from those of the selected commits below it.
+    bitmaps = dict()
+    positions = {sha: pos for pos, (sha, _, _) in enumerate(entries)}
+
+    def commit_bitmap(pos):
+        return bitmaps.get(entries[pos][0])
+
+    for sha in commits_topological(commits):
+        if sha not in selected:
+            continue
+
+        # The commit itself is walked, not taken from a bitmap.
+        bits = bytearray(nbytes)
+        bits[positions[sha] >> 3] |= 1 << (positions[sha] & 7)
+        tree = object_read(repo, sha).kvlm[b"tree"].decode("ascii")
+        bitmap_walk(
+            repo, positions.get, [tree] + commits[sha], bits, set(), commit_bitmap
+        )
+        bitmaps[sha] = bytes(bits)
+
+    data = [
+        VerizonBitmapIndex.header.pack(b"VBMP", 1, count, len(bitmaps)),
+        bytes.fromhex(pack.pack_checksum()),
+        struct.pack(f">{count}I", *order),
+    ]
+    for fmt in (b"commit", b"tree", b"blob", b"tag"):
+        data.append(ewah_encode(types[fmt], count))
+    for sha, bits in bitmaps.items():
+        data.append(struct.pack(">I", positions[sha]))
+        data.append(ewah_encode(bits, count))
+
+    data = b"".join(data)
+    data += hashlib.sha1(data).digest()
+
+    path = bitmap_path(pack)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+    pack.bitmap = None
+    return len(bitmaps)
@@ -1,165 +1,300 @@
 import os
 import re
+import mmap
+import struct
 import zlib
 import hashlib
+import threading
 
+from array import array
 from math import ceil
 
 from classes import (
     VerizonIndex,
     VerizonIndexEntry,
+    VerizonIndexEntries,
     VerizonCommit,
     VerizonBlob,
     VerizonTag,
     VerizonTree,
     VerizonTreeLeaf,
+    VerizonPackIndex,
+    VerizonBloomFilter,
+    VerizonObjectSet,
 )
-from utils import repo_file, repo_dir
-from other_utils import ref_resolve
+from lock_utils import LOCK_RETRIES, LockFile
+from utils import repo_file, repo_path
 
 
-def index_read(repo):
-    index_file = repo_file(repo, "index")
-    if not os.path.exists(index_file):
-        return VerizonIndex()
+INDEX_HEADER = VerizonIndexEntries.header
+INDEX_ENTRY = VerizonIndexEntries.entry
+INDEX_FLAGS = struct.Struct(">H")
+INDEX_EXTENSION = struct.Struct(">4sI")
+# The number of deleted positions in the link extension, followed by them, then by the replaced ones.
+INDEX_SPLIT_COUNT = struct.Struct(">I")
 
-    with open(index_file, "rb") as f:
-        raw = f.read()
+# Indexes with this many entries are split, unless index.splitIndex says otherwise...
+INDEX_SPLIT_MIN_ENTRIES = 10000
+# ...and their shared index rewritten once this share of its entries is deleted or changed.
+INDEX_SPLIT_MAX_PERCENT = 20
 
-    header = raw[:12]
-    signature = header[:4]
-    assert signature == b"DIRC"
 
-    version = int.from_bytes(header[4:8], "big")
-    assert version == 2, "Verizon supports only index file version 2"
+def index_file_read(path):
+    """Return (version, entries, extensions, checksum) of the index file at path, entries being decoded when first used."""
+    # Only the offsets of the entries are read up front, each is decoded from the mapping when first used.
+    with open(path, "rb") as f:
+        content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-    count = int.from_bytes(header[8:12], "big")
+    signature, version, count = INDEX_HEADER.unpack_from(content)
+    assert signature == b"DIRC"
+    assert version == 2, "Verizon supports only index file version 2"
 
-    entries = list()
-    content = raw[12:]
-    idx = 0
+    offsets = array("Q")
+    ends = array("Q")
+    idx = INDEX_HEADER.size
+    name_size = INDEX_ENTRY.size - 2
 
     for i in range(0, count):
-        ctime_s = int.from_bytes(content[idx : idx + 4], "big")
-        ctime_ns = int.from_bytes(content[idx + 4 : idx + 8], "big")
-
-        mtime_s = int.from_bytes(content[idx + 8 : idx + 12], "big")
-        mtime_ns = int.from_bytes(content[idx + 12 : idx + 16], "big")
-
-        dev = int.from_bytes(content[idx + 16 : idx + 20], "big")
-        ino = int.from_bytes(content[idx + 20 : idx + 24], "big")
-
-        unused = int.from_bytes(content[idx + 24 : idx + 26], "big")
-        assert 0 == unused
-
-        mode = int.from_bytes(content[idx + 26 : idx + 28], "big")
-        mode_type = mode >> 12
-        assert mode_type in [0b1000, 0b1010, 0b1110]
-
-        mode_perms = mode & 0b0000000111111111
-
-        uid = int.from_bytes(content[idx + 28 : idx + 32], "big")
-        gid = int.from_bytes(content[idx + 32 : idx + 36], "big")
-        fsize = int.from_bytes(content[idx + 36 : idx + 40], "big")
-
-        sha = format(int.from_bytes(content[idx + 40 : idx + 60], "big"), "040x")
-
-        flags = int.from_bytes(content[idx + 60 : idx + 62], "big")
-
-        flag_assume_valid = (flags & 0b1000000000000000) != 0
-        flag_extended = (flags & 0b0100000000000000) != 0
-        assert not flag_extended
-        flag_stage = flags & 0b0011000000000000
-
+        offsets.append(idx)
+        (flags,) = INDEX_FLAGS.unpack_from(content, idx + name_size)
         name_length = flags & 0b0000111111111111
 
-        idx += 62
-
+        idx += INDEX_ENTRY.size
         if name_length < 0xFFF:
             assert content[idx + name_length] == 0x00
-            raw_name = content[idx : idx + name_length]
             idx += name_length + 1
-
         else:
-            print("Notice that Name is 0x{:X} bytes long".format(name_length))
-            null_idx = content.find(b"\x00", idx + 0xFFF)
-            raw_name = content[idx:null_idx]
-            idx = null_idx + 1
-
-        name = raw_name.decode("utf8")
-
-        idx = 8 * ceil(idx / 8)
-
-        entries.append(
-            VerizonIndexEntry(
-                ctime=(ctime_s, ctime_ns),
-                mtime=(mtime_s, mtime_ns),
-                dev=dev,
-                ino=ino,
-                mode_type=mode_type,
-                mode_perms=mode_perms,
-                uid=uid,
-                gid=gid,
-                fsize=fsize,
-                sha=sha,
-                flag_assume_valid=flag_assume_valid,
-                flag_stage=flag_stage,
-                name=name,
-            )
-        )
-
-    return VerizonIndex(version=version, entries=entries)
+            idx = content.find(b"\x00", idx + 0xFFF) + 1
 
+        # Entries are padded to 8 bytes, counted from the end of the header.
+        idx = INDEX_HEADER.size + 8 * ceil((idx - INDEX_HEADER.size) / 8)
+        ends.append(idx)
 
-def index_write(repo, index):
-    with open(repo_file(repo, "index"), "wb") as f:
-        f.write(b"DIRC")
-        f.write(index.version.to_bytes(4, "big"))
-        f.write(len(index.entries).to_bytes(4, "big"))
+    # Indexes written before the checksum was added end right after the entries.
+    extensions = dict()
+    checksum = None
+    if len(content) > idx:
+        end = len(content) - 20
+        if hashlib.sha1(memoryview(content)[:end]).digest() != content[end:]:
+            raise Exception("Index checksum mismatch")
 
-        idx = 0
-        # Entries
-        for e in index.entries:
-            f.write(e.ctime[0].to_bytes(4, "big"))
-            f.write(e.ctime[1].to_bytes(4, "big"))
-            f.write(e.mtime[0].to_bytes(4, "big"))
-            f.write(e.mtime[1].to_bytes(4, "big"))
+        while idx < end:
+            signature, size = INDEX_EXTENSION.unpack_from(content, idx)
+            idx += INDEX_EXTENSION.size
+            extensions[signature] = content[idx : idx + size]
+            idx += size
+        checksum = content[end:].hex()
 
-            f.write(e.dev.to_bytes(4, "big"))
-            f.write(e.ino.to_bytes(4, "big"))
+    return version, VerizonIndexEntries(content, offsets, ends), extensions, checksum
 
-            # Mode
-            mode = (e.mode_type << 12) | e.mode_perms
-            f.write(mode.to_bytes(4, "big"))
 
-            f.write(e.uid.to_bytes(4, "big"))
-            f.write(e.gid.to_bytes(4, "big"))
-
-            f.write(e.fsize.to_bytes(4, "big"))
-
-            f.write(int(e.sha, 16).to_bytes(20, "big"))
+def index_read(repo):
+    index_file = repo_file(repo, "index")
+    if not os.path.exists(index_file) or not os.path.getsize(index_file):
+        return VerizonIndex()
 
-            flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
+    for attempt in range(LOCK_RETRIES):
+        version, entries, extensions, checksum = index_file_read(index_file)
+        fsmonitor = index_fsmonitor_unpack(extensions.get(b"FSMN"))
+        link = extensions.get(b"link")
+        if link is None:
+            return VerizonIndex(
+                version, entries, fsmonitor=fsmonitor, checksum=checksum
+            )
 
-            name_bytes = e.name.encode("utf8")
-            bytes_len = len(name_bytes)
+        # A split index: the entries of the shared index, minus those deleted, then the entries of this file.
+        base = link[:20].hex()
+        try:
+            _, merged, _, _ = index_file_read(repo_file(repo, f"sharedindex.{base}"))
+            break
+        except FileNotFoundError:
+            # Removed by a writer since the index was read, which means there's a new index to read.
+            continue
+    else:
+        raise Exception(f"Shared index {base} is missing")
+
+    # The entries of this file replace those of the shared index at the positions replaced, in order, then follow them.
+    (count,) = INDEX_SPLIT_COUNT.unpack_from(link, 20)
+    positions = struct.unpack(f">{(len(link) - 24) // 4}I", link[24:])
+    deleted, replaced = positions[:count], positions[count:]
+    for i, pos in enumerate(replaced):
+        merged[pos] = entries[i]
+    for pos in reversed(deleted):
+        del merged[pos]
+    merged.extend(entries[len(replaced) :])
+    return VerizonIndex(
+        version, merged, base=base, fsmonitor=fsmonitor, checksum=checksum
+    )
+
+
+def index_fsmonitor_pack(fsmonitor):
+    token, paths = fsmonitor
+    return b"\x00".join([token.encode("utf8")] + [p.encode("utf8") for p in paths])
+
+
+def index_fsmonitor_unpack(data):
+    """Return (token, paths) of the FSMN extension, see fsmonitor_query."""
+    if data is None:
+        return None
+    token, *paths = bytes(data).decode("utf8").split("\x00")
+    return token, paths
+
+
+def index_entry_changed(entry, stat):
+    ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
+    mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
+    return stat.st_ctime_ns != ctime_ns or stat.st_mtime_ns != mtime_ns
+
+
+def index_entry_restat(entry, stat):
+    """A copy of entry with the stat of its file, for content found unchanged."""
+    return VerizonIndexEntry(
+        ctime=(int(stat.st_ctime), stat.st_ctime_ns % 10**9),
+        mtime=(int(stat.st_mtime), stat.st_mtime_ns % 10**9),
+        dev=stat.st_dev,
+        ino=stat.st_ino,
+        mode_type=entry.mode_type,
+        mode_perms=entry.mode_perms,
+        uid=stat.st_uid,
+        gid=stat.st_gid,
+        fsize=stat.st_size,
+        binsha=entry.binsha,
+        flag_assume_valid=entry.flag_assume_valid,
+        flag_stage=entry.flag_stage,
+        name=entry.name,
+    )
+
+
+def index_names(index):
+    """The names of the entries of index, without decoding the entries."""
+    entries = index.entries
+    if isinstance(entries, VerizonIndexEntries):
+        return [entries.name(i) for i in range(len(entries))]
+    return [e.name for e in entries]
+
+
+def index_entry_pack(e):
+    name_bytes = e.name.encode("utf8")
+    flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
+    name_length = min(len(name_bytes), 0xFFF)
+
+    data = INDEX_ENTRY.pack(
+        e.ctime[0],
+        e.ctime[1],
+        e.mtime[0],
+        e.mtime[1],
+        e.dev,
+        e.ino,
+        0,
+        (e.mode_type << 12) | e.mode_perms,
+        e.uid,
+        e.gid,
+        e.fsize,
+        e.binsha,
+        flag_assume_valid | e.flag_stage | name_length,
+    )
+    # The name is NUL terminated, then padded to 8 bytes.
+    size = INDEX_ENTRY.size + len(name_bytes)
+    return data + name_bytes + b"\x00" * (8 - size % 8)
+
+
+def index_file_data(version, entries, extensions=None):
+    """The content of an index file, its entries and extensions followed by the SHA-1 of all that comes before. Entries not used since they were read are copied as they are."""
+    lazy = isinstance(entries, VerizonIndexEntries)
+
+    data = [INDEX_HEADER.pack(b"DIRC", version, len(entries))]
+    for i in range(len(entries)):
+        raw = entries.raw(i) if lazy else None
+        data.append(raw if raw is not None else index_entry_pack(entries[i]))
+    for signature, ext in (extensions or dict()).items():
+        data.append(INDEX_EXTENSION.pack(signature, len(ext)) + ext)
+
+    data = b"".join(data)
+    return data + hashlib.sha1(data).digest()
+
+
+def index_split_delta(index):
+    """Return (deleted, replaced, changed) of a split index: the positions of the shared entries no longer there, those of the shared entries set since, and the entries written to the index file, those set in order followed by the others. None when the entries aren't the shared ones, in order, followed by the others."""
+    entries = index.entries
+    if index.base is None or not isinstance(entries, VerizonIndexEntries):
+        return None
 
-            if bytes_len >= 0xFFF:
-                name_length = 0xFFF
-            else:
-                name_length = bytes_len
+    # An entry set keeps the position of the shared one it replaces, see VerizonIndexEntries.
+    kept = 0
+    while kept < len(entries) and entries.origins[kept] != -1:
+        kept += 1
 
-            f.write((flag_assume_valid | e.flag_stage | name_length).to_bytes(2, "big"))
+    shared = [x if x >= 0 else -2 - x for x in entries.origins[:kept]]
+    if any(x != -1 for x in entries.origins[kept:]) or any(
+        a >= b for a, b in zip(shared, shared[1:])
+    ):
+        return None
 
-            f.write(name_bytes)
-            f.write((0).to_bytes(1, "big"))
+    replaced = [i for i in range(kept) if entries.origins[i] < 0]
+    deleted = sorted(set(range(entries.data_count)) - set(shared))
+    changed = [entries[i] for i in replaced] + [
+        entries[i] for i in range(kept, len(entries))
+    ]
+    return deleted, [shared[i] for i in replaced], changed
+
+
+def index_write(repo, index, lock=None):
+    """Write index, through lock, the LockFile of the index taken before it was read, or a lock of its own. The index file is replaced rather than rewritten in place: an index read before is still mapped.
+
+    A big index is split: its entries are written once to a shared index, and the changes since to the index file, until they reach INDEX_SPLIT_MAX_PERCENT of it and everything is written to a new shared index.
+    """
+    split = repo.conf.getboolean("index", "splitindex", fallback=None)
+    if split is None:
+        split = len(index.entries) >= INDEX_SPLIT_MIN_ENTRIES
+
+    delta = index_split_delta(index) if split else None
+    if delta is not None:
+        deleted, replaced, changed = delta
+        if (
+            len(deleted) + len(changed)
+        ) * 100 > index.entries.data_count * INDEX_SPLIT_MAX_PERCENT:
+            delta = None
+
+    with lock or LockFile(repo_file(repo, "index")) as lock:
+        if delta is None and split:
+            data = index_file_data(index.version, index.entries)
+            base = data[-20:].hex()
+            with LockFile(repo_file(repo, f"sharedindex.{base}")) as shared:
+                shared.write(data)
+                shared.commit()
+            deleted, replaced, changed = list(), list(), list()
+            # The entries still point in the old shared index, another write of them starts a new one.
+            index.base = None
+        elif delta is None:
+            base = None
+        else:
+            base = index.base
+
+        extensions = dict()
+        if index.fsmonitor is not None:
+            extensions[b"FSMN"] = index_fsmonitor_pack(index.fsmonitor)
+
+        if base is not None:
+            positions = deleted + replaced
+            extensions[b"link"] = (
+                bytes.fromhex(base)
+                + INDEX_SPLIT_COUNT.pack(len(deleted))
+                + struct.pack(f">{len(positions)}I", *positions)
+            )
+            data = index_file_data(index.version, changed, extensions)
+        else:
+            data = index_file_data(index.version, index.entries, extensions)
 
-            idx += 62 + len(name_bytes) + 1
+        lock.write(data)
+        lock.commit()
 
-            if idx % 8 != 0:
-                pad = 8 - (idx % 8)
-                f.write((0).to_bytes(pad, "big"))
-                idx += pad
+        # Shared indexes no longer used. One still mapped by a reader stays readable until it's done.
+        for name in os.listdir(repo.vrzdir):
+            if (
+                re.fullmatch(r"sharedindex\.[0-9a-f]{40}", name)
+                and name != f"sharedindex.{base}"
+            ):
+                os.remove(os.path.join(repo.vrzdir, name))
 
 
 def tree_parse_one(raw, start=0):
@@ -173,8 +308,9 @@ def tree_parse_one(raw, start=0):
     y = raw.find(b"\x00", x)
     path = raw[x + 1 : y]
 
-    sha = format(int.from_bytes(raw[y + 1 : y + 21], "big"), "040x")
-    return y + 21, VerizonTreeLeaf(mode, path.decode("utf8"), sha)
+    return y + 21, VerizonTreeLeaf(
+        mode, path.decode("utf8"), binsha=raw[y + 1 : y + 21]
+    )
 
 
 def tree_parse(raw):
@@ -197,53 +333,466 @@ def tree_leaf_sort_key(leaf):
 
 def tree_serialize(obj):
     obj.items.sort(key=tree_leaf_sort_key)
-    ret = b""
+    ret = list()
 
     for i in obj.items:
-        ret += i.mode
-        ret += b""
-        ret += i.path.encode("utf8")
-        ret += b"\x00"
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, byteorder="big")
+        ret.append(i.mode)
+        ret.append(b" ")
+        ret.append(i.path.encode("utf8"))
+        ret.append(b"\x00")
+        ret.append(i.binsha)
+
+    return b"".join(ret)
+
+
+def alternates_read(objects_dir, seen):
+    """Return the object directories listed in objects/info/alternates, and theirs in turn."""
+    ret = list()
+    path = os.path.join(objects_dir, "info", "alternates")
+    if not os.path.isfile(path):
+        return ret
+
+    with open(path, "r") as f:
+        for line in f.read().splitlines():
+            line = line.strip()
+            if not line or line[0] == "#":
+                continue
+
+            # Relative paths are relative to the objects directory, like in git.
+            alternate = os.path.realpath(os.path.join(objects_dir, line))
+            if alternate in seen or not os.path.isdir(alternate):
+                continue
+
+            seen.add(alternate)
+            ret.append(alternate)
+            ret.extend(alternates_read(alternate, seen))
 
     return ret
 
 
-def object_read(repo, sha):
-    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+# Taken to load what threads sharing a repository read from, for it to be loaded once and only seen whole.
+REPO_LOAD_LOCK = threading.Lock()
 
-    if not os.path.isfile(path):
+
+def object_stores(repo):
+    """The object directories of repo: its own first, then the shared read-only ones from its alternates."""
+    if repo.object_stores is None:
+        own = os.path.realpath(repo_path(repo, "objects"))
+        repo.object_stores = [own] + alternates_read(own, set([own]))
+    return repo.object_stores
+
+
+# Shas written since the object set was last rewritten, past which it's rewritten on load.
+OBJECT_SET_MAX_LOG = 4096
+
+
+def object_set_scan(store):
+    """List the loose objects of store from its directories, the slow way."""
+    ret = list()
+    for d in os.listdir(store):
+        if len(d) != 2 or not os.path.isdir(os.path.join(store, d)):
+            continue
+        for f in os.listdir(os.path.join(store, d)):
+            if len(f) == 38:
+                ret.append(d + f)
+    return ret
+
+
+def object_set_write(store, shas, log_offset):
+    """Write the object set of store, holding shas and everything up to log_offset in its log. Return its content, written or not: an alternate can be read-only."""
+    shas = sorted(set(shas))
+
+    bloom = VerizonBloomFilter(count=len(shas))
+    raw = [bytes.fromhex(sha) for sha in shas]
+    for sha in raw:
+        bloom.add(sha)
+
+    data = b"".join(
+        [
+            VerizonObjectSet.header.pack(
+                b"VOBS", 1, bloom.num_hashes, len(shas), log_offset, len(bloom.data)
+            ),
+            b"".join(raw),
+            bytes(bloom.data),
+        ]
+    )
+    data += hashlib.sha1(data).digest()
+
+    path = os.path.join(store, "info", "object-set")
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+    return data
+
+
+def object_set_refresh(store, objset):
+    """Read the shas appended to the log of store since objset last looked at it."""
+    path = os.path.join(store, "info", "object-set.log")
+    try:
+        with open(path, "rb") as f:
+            f.seek(objset.log_size)
+            data = f.read()
+    except FileNotFoundError:
+        return
+
+    # A write in progress may have left a partial record, it's read next time.
+    end = len(data) - len(data) % 20
+    for at in range(0, end, 20):
+        objset.added.add(data[at : at + 20].hex())
+    objset.log_size += end
+
+
+def object_set_load(store):
+    """Load the object set of store, building it from a scan the first time, and rewriting it once too many shas were logged since."""
+    path = os.path.join(store, "info", "object-set")
+    log_path = path + ".log"
+
+    data = None
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+            data = None
+
+    if data is None:
+        # The log is measured first: what's logged during the scan is read again, not lost.
+        log_offset = os.path.getsize(log_path) if os.path.isfile(log_path) else 0
+        data = object_set_write(store, object_set_scan(store), log_offset)
+
+    objset = VerizonObjectSet(data)
+    object_set_refresh(store, objset)
+
+    if len(objset.added) > OBJECT_SET_MAX_LOG:
+        objset = VerizonObjectSet(
+            object_set_write(store, objset.shas(), objset.log_size)
+        )
+
+    return objset
+
+
+def object_sets(repo):
+    sets = repo.object_sets
+    if sets is not None:
+        return sets
+
+    # Loaded once: two loads could both rewrite the same object set.
+    with REPO_LOAD_LOCK:
+        if repo.object_sets is None:
+            repo.object_sets = {
+                store: object_set_load(store) for store in object_stores(repo)
+            }
+        return repo.object_sets
+
+
+def object_set_add(repo, sha):
+    """Record a loose object just written to the own store of repo, in memory and in the log."""
+    store = object_stores(repo)[0]
+    objset = object_sets(repo)[store]
+    objset.added.add(sha)
+
+    # One write of a whole record with O_APPEND, so concurrent writers never interleave.
+    fd = os.open(
+        os.path.join(store, "info", "object-set.log"),
+        os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+        0o666,
+    )
+    try:
+        os.write(fd, bytes.fromhex(sha))
+    finally:
+        os.close(fd)
+
+
+def object_path(repo, sha, refresh=True):
+    """Return the path of the loose object sha, in whichever object store has it, or None.
+
+    The answer comes from the object sets, in memory. Only when it's no, and refresh is set, are the logs read again, for objects other processes wrote since.
+    """
+    for store, objset in object_sets(repo).items():
+        if sha in objset:
+            return os.path.join(store, sha[0:2], sha[2:])
+
+    if not refresh:
         return None
 
+    sets = object_sets(repo)
+    # One refresh at a time: each reads the log from where the last one stopped.
+    with REPO_LOAD_LOCK:
+        for store, objset in sets.items():
+            object_set_refresh(store, objset)
+            if sha in objset:
+                return os.path.join(store, sha[0:2], sha[2:])
+    return None
+
+
+# Object types in a pack entry header, the same numbers as git.
+PACK_TYPES = {1: b"commit", 2: b"tree", 3: b"blob", 4: b"tag"}
+PACK_TYPE_NUMBERS = {v: k for k, v in PACK_TYPES.items()}
+
+
+def file_map(path):
+    """Map a whole file read-only. The mapping outlives the file descriptor."""
     with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def packs_scan(repo, known=()):
+    """Return the indexes of every pack in the object stores of repo, reusing those of known still there."""
+    known = {pack.pack_path: pack for pack in known}
+    packs = list()
+    for store in object_stores(repo):
+        pack_dir = os.path.join(store, "pack")
+        if not os.path.isdir(pack_dir):
+            continue
+
+        for f in sorted(os.listdir(pack_dir)):
+            if not f.endswith(".idx"):
+                continue
+            pack_path = os.path.join(pack_dir, f[:-4] + ".pack")
+            pack = known.get(pack_path)
+            if pack is None:
+                pack = VerizonPackIndex(file_map(os.path.join(pack_dir, f)), pack_path)
+            packs.append(pack)
+    return packs
+
+
+def packs_load(repo):
+    """Return the indexes of every pack in the object stores of repo. Threads sharing repo load them once, and never see them half loaded."""
+    packs = repo.packs
+    if packs is not None:
+        return packs
+
+    with REPO_LOAD_LOCK:
+        if repo.packs is None:
+            repo.packs = packs_scan(repo)
+        return repo.packs
+
+
+def packs_refresh(repo):
+    """Load the packs of repo again, for those other processes wrote since. Return whether there are new ones."""
+    with REPO_LOAD_LOCK:
+        old = repo.packs or list()
+        packs = packs_scan(repo, old)
+        repo.packs = packs
+    return any(pack not in old for pack in packs)
+
+
+def pack_data(pack):
+    """A memoryview of the whole pack file, mapped on first use."""
+    if pack.pack_data is None:
+        pack.pack_data = memoryview(file_map(pack.pack_path))
+    return pack.pack_data
+
+
+def pack_entry_stream(data, offset, chunk_size=65536):
+    """Return (fmt, size, chunks) of the pack entry at offset in data, a memoryview of the pack. chunks inflates it from slices of the mapping, nothing is copied before zlib."""
+    c = data[offset]
+    type_num = (c >> 4) & 0b111
+    size = c & 0b1111
+    shift = 4
+    while c & 0x80:
+        offset += 1
+        c = data[offset]
+        size |= (c & 0x7F) << shift
+        shift += 7
+    offset += 1
+
+    if type_num not in PACK_TYPES:
+        raise Exception(f"Unsupported pack entry type {type_num}")
+
+    def chunks():
+        z = zlib.decompressobj()
+        at = offset
+        sent = 0
+        while not z.eof:
+            if z.unconsumed_tail:
+                chunk = z.decompress(z.unconsumed_tail, chunk_size)
+            else:
+                if at >= len(data):
+                    raise Exception("Truncated pack entry")
+                chunk = z.decompress(data[at : at + chunk_size], chunk_size)
+                at += chunk_size
+            if chunk:
+                sent += len(chunk)
+                yield chunk
+        if sent != size:
+            raise Exception("Malformed pack entry: bad length")
+
+    return PACK_TYPES[type_num], size, chunks()
+
+
+def pack_entry_read(data, offset):
+    """Read the pack entry at offset in data. Return (fmt, content)."""
+    fmt, _, chunks = pack_entry_stream(data, offset)
+    return fmt, b"".join(chunks)
+
+
+def pack_find(repo, sha):
+    """Return (pack, offset) of sha in whichever pack has it, or None."""
+    for pack in packs_load(repo):
+        offset = pack.lookup(sha)
+        if offset is not None:
+            return pack, offset
+    return None
+
+
+def object_exists(repo, sha, refresh=True):
+    return (
+        object_path(repo, sha, refresh=False) is not None
+        or pack_find(repo, sha) is not None
+        or (refresh and object_path(repo, sha) is not None)
+    )
+
+
+def loose_object_open(path):
+    """Open the loose object file at path, None when path is or when the file is gone: packed and deleted since the object set listing it was read."""
+    if path is None:
+        return None
+    try:
+        return open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+
+def object_locate(repo, sha):
+    """Return where to read an object from, (an open loose object file, None) or (None, (pack, offset)), or None when it's nowhere.
+
+    Loose objects come first, unless they were packed and deleted since the object sets were read: they're then in a pack, if need be one the packs are loaded again for.
+    """
+    path = object_path(repo, sha, refresh=False)
+    f = loose_object_open(path)
+    if f is not None:
+        return f, None
+
+    found = pack_find(repo, sha)
+    if found is not None:
+        return None, found
+
+    f = loose_object_open(object_path(repo, sha))
+    if f is not None:
+        return f, None
+
+    if path is not None and packs_refresh(repo):
+        found = pack_find(repo, sha)
+        if found is not None:
+            return None, found
+    return None
+
+
+def object_read_raw(repo, sha):
+    """Return (fmt, data) of an object without building an object from it, or None."""
+    found = object_locate(repo, sha)
+    if found is None:
+        return None
+
+    f, packed = found
+    if packed is not None:
+        pack, offset = packed
+        return pack_entry_read(pack_data(pack), offset)
+
+    with f:
         raw = zlib.decompress(f.read())
 
-        # Read the object type
-        x = raw.find(b"")
-        fmt = raw[0:x]
+    # Read the object type
+    x = raw.find(b" ")
+    fmt = raw[0:x]
 
-        # Read and Validate the object size
-        y = raw.find(b"\x00", x)
-        size = int(raw[x:y].decode("ascii"))
+    # Read and Validate the object size
+    y = raw.find(b"\x00", x)
+    size = int(raw[x:y].decode("ascii"))
 
-        if size != len(raw) - y - 1:
-            raise Exception(f"Malformed object {sha}: bad length")
+    if size != len(raw) - y - 1:
+        raise Exception(f"Malformed object {sha}: bad length")
 
-        match fmt:
-            case b"commit":
-                c = VerizonCommit
-            case b"tree":
-                c = VerizonTree
-            case b"tag":
-                c = VerizonTag
-            case b"blob":
-                c = VerizonBlob
-            case _:
-                raise Exception(f"Unknown type {fmt.decode('ascii')} for object {sha}")
+    return fmt, raw[y + 1 :]
 
-        # Call constructor and return object.
-        return c(raw[y + 1])
+
+def object_read_stream(repo, sha, chunk_size=65536):
+    """Return (fmt, size, chunks) of an object, chunks yielding its content as it's inflated, or None. Big blobs are never held in memory whole."""
+    found = object_locate(repo, sha)
+    if found is None:
+        return None
+
+    f, packed = found
+    if packed is not None:
+        pack, offset = packed
+        return pack_entry_stream(pack_data(pack), offset, chunk_size)
+
+    return loose_object_file_stream(f, sha, chunk_size)
+
+
+def loose_object_stream(path, sha, chunk_size=65536):
+    """Return (fmt, size, chunks) of the loose object file at path, like object_read_stream."""
+    return loose_object_file_stream(open(path, "rb"), sha, chunk_size)
+
+
+def loose_object_file_stream(f, sha, chunk_size=65536):
+    """Return (fmt, size, chunks) of the open loose object file f, which chunks closes."""
+    z = zlib.decompressobj()
+
+    # Inflate until the whole header is there.
+    head = b""
+    while b"\x00" not in head:
+        data = z.unconsumed_tail or f.read(chunk_size)
+        if not data:
+            f.close()
+            raise Exception(f"Malformed object {sha}: truncated header")
+        head += z.decompress(data, chunk_size)
+
+    x = head.find(b" ")
+    y = head.find(b"\x00", x)
+    fmt = head[0:x]
+    size = int(head[x:y].decode("ascii"))
+
+    def chunks():
+        with f:
+            sent = len(head) - y - 1
+            if sent:
+                yield memoryview(head)[y + 1 :]
+            while not z.eof:
+                # No chunk inflates past chunk_size, whatever the compression ratio.
+                data = z.unconsumed_tail or f.read(chunk_size)
+                if not data:
+                    raise Exception(f"Malformed object {sha}: truncated")
+                data = z.decompress(data, chunk_size)
+                if data:
+                    sent += len(data)
+                    yield data
+            if sent != size:
+                raise Exception(f"Malformed object {sha}: bad length")
+
+    return fmt, size, chunks()
+
+
+def object_read(repo, sha):
+    raw = object_read_raw(repo, sha)
+
+    if raw is None:
+        return None
+
+    return object_build(sha, *raw)
+
+
+def object_build(sha, fmt, data):
+    """Build the object of the right class from an object's type and content."""
+    match fmt:
+        case b"commit":
+            c = VerizonCommit
+        case b"tree":
+            c = VerizonTree
+        case b"tag":
+            c = VerizonTag
+        case b"blob":
+            c = VerizonBlob
+        case _:
+            raise Exception(f"Unknown type {fmt.decode('ascii')} for object {sha}")
+
+    # Call constructor and return object.
+    return c(data)
 
 
 def object_write(obj, repo=None):
@@ -253,12 +802,13 @@ def object_write(obj, repo=None):
 
     sha = hashlib.sha1(result).hexdigest()
 
-    if repo:
+    # Another process writing the same object meanwhile only costs a second identical write, no need to look at its log.
+    if repo and not object_exists(repo, sha, refresh=False):
         path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
 
-        if not os.path.exists(path):
-            with open(path, "wb") as f:
-                f.write(zlib.compress(result))
+        with open(path, "wb") as f:
+            f.write(zlib.compress(result))
+        object_set_add(repo, sha)
 
     return sha
 
@@ -320,6 +870,8 @@ def object_hash(fd, fmt, repo=None):
 
 def object_resolve(repo, name):
     """Resolve names to an object has in repo."""
+    from other_utils import ref_resolve
+
     candidates = list()
     hashRE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
 
@@ -333,14 +885,22 @@ def object_resolve(repo, name):
     if hashRE.match(name):
         name = name.lower()
         prefix = name[0:2]
-        path = repo_dir(repo, "objects", prefix, mkdir=False)
+        rem = name[2:]
+
+        for store in object_stores(repo):
+            path = os.path.join(store, prefix)
+            if not os.path.isdir(path):
+                continue
 
-        if path:
-            rem = name[2:]
             for f in os.listdir(path):
-                if f.startswith(rem):
+                if f.startswith(rem) and prefix + f not in candidates:
                     candidates.append(prefix + f)
 
+        for pack in packs_load(repo):
+            for sha in pack.prefixed(name):
+                if sha not in candidates:
+                    candidates.append(sha)
+
     as_tag = ref_resolve(repo, "refs/tags/" + name)
     # Try for references.
     if as_tag:
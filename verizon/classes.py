@@ -1,14 +1,28 @@
 import os
 import configparser
-from class_utils import tree_serialize, tree_parse
-from other_utils import kvlm_serialize, kvlm_parse
-from utils import repo_file
+import hashlib
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+from collections.abc import MutableSequence
+
+# class_utils, other_utils and utils are built on the classes here: what is needed from them is imported where it's used.
 
 
 class VerizonRepository:
-    worktree = None
-    vrzdir = None
+    worktree: str
+    vrzdir: str
     conf = None
+    object_stores = None  # the object directories to read from, filled on first use.
+    packs = None  # the pack indexes of every object store, loaded on first use.
+    object_sets = (
+        None  # the loose objects of every object store, by store, loaded on first use.
+    )
+    tree_paths = None  # the flattened listings of trees read so far, see tree_paths.
+    commit_table = (
+        None  # (stamp of the commit-graph, commit table), see commit_table_cached.
+    )
 
     def __init__(self, path, force=False):
         self.worktree = path
@@ -17,6 +31,8 @@ class VerizonRepository:
         if not (force or os.path.isdir(self.vrzdir)):
             raise Exception(f"Not a Verizon Repository : {path}")
 
+        from utils import repo_file
+
         # Read Config file.
         self.conf = configparser.ConfigParser()
         cf = repo_file(self, "config")
@@ -52,10 +68,22 @@ class VerizonObject:
 
 # Tree wrapper for a single record(a single path).
 class VerizonTreeLeaf:
-    def __init__(self, mode, path, sha) -> None:
+    __slots__ = ("mode", "path", "binsha")
+
+    def __init__(self, mode, path, sha=None, binsha=None) -> None:
         self.mode = mode
         self.path = path
-        self.sha = sha
+        self.binsha = (
+            binsha if binsha is not None else bytes.fromhex(sha)
+        )  # the sha as its 20 bytes.
+
+    @property
+    def sha(self):
+        return self.binsha.hex()
+
+    @sha.setter
+    def sha(self, sha):
+        self.binsha = bytes.fromhex(sha)
 
 
 ## Type Header could be one of `blob`, `commit`, `tag`, `tree`.
@@ -76,9 +104,13 @@ class VerizonCommit(VerizonObject):
     fmt = b"commit"
 
     def deserialize(self, data):
+        from other_utils import kvlm_parse
+
         self.kvlm = kvlm_parse(data)
 
-    def serialize(self, repo):
+    def serialize(self):
+        from other_utils import kvlm_serialize
+
         return kvlm_serialize(self.kvlm)
 
     def init(self):
@@ -93,9 +125,13 @@ class VerizonTree(VerizonObject):
     fmt = b"tree"
 
     def deserialize(self, data):
+        from class_utils import tree_parse
+
         self.items = tree_parse(data)
 
     def serialize(self):
+        from class_utils import tree_serialize
+
         return tree_serialize(self)
 
     def init(self):
@@ -103,6 +139,22 @@ class VerizonTree(VerizonObject):
 
 
 class VerizonIndexEntry:
+    __slots__ = (
+        "ctime",
+        "mtime",
+        "dev",
+        "ino",
+        "mode_type",
+        "mode_perms",
+        "uid",
+        "gid",
+        "fsize",
+        "binsha",
+        "flag_assume_valid",
+        "flag_stage",
+        "name",
+    )
+
     def __init__(
         self,
         ctime=None,
@@ -118,6 +170,7 @@ class VerizonIndexEntry:
         flag_assume_valid=None,
         flag_stage=None,
         name=None,
+        binsha=None,
     ) -> None:
         self.ctime = ctime  # the last time the file's metadata changed.
         self.mtime = mtime  # the last time the file's data changed.
@@ -128,22 +181,144 @@ class VerizonIndexEntry:
         self.uid = uid  # the user id of the owner.
         self.gid = gid  # the group id of owner
         self.fsize = fsize  # the size of this object(in bytes)
-        self.sha = sha  # the object's sha
+        if binsha is None and sha is not None:
+            binsha = bytes.fromhex(sha)
+        self.binsha = binsha  # the object's sha, as its 20 bytes.
         self.flag_assume_valid = flag_assume_valid
         self.flag_stage = flag_stage
         self.name = name  # the name of the object(full path)
 
+    @property
+    def sha(self):
+        return None if self.binsha is None else self.binsha.hex()
+
+    @sha.setter
+    def sha(self, sha):
+        self.binsha = bytes.fromhex(sha)
+
+
+class VerizonIndexEntries(MutableSequence):
+    """The entries of an index file, decoded on first access. Until then an entry is only its offset in data, and index_write copies its bytes back as they are."""
+
+    header = struct.Struct(">4sII")
+    # The fixed-width part of an entry, up to the name: ctime, mtime, dev, ino, unused, mode, uid, gid, size, sha and flags.
+    entry = struct.Struct(">6I2H3I20sH")
+
+    def __init__(self, data, offsets, ends) -> None:
+        self.data = data
+        self.offsets = offsets  # array("Q") of where each entry starts in data...
+        self.ends = ends  # ...and where it ends, padding included.
+        self.items = [None] * len(offsets)  # the entries decoded so far, or set since.
+        self.data_count = len(offsets)  # the number of entries in data.
+        # The position in data of each entry, -1 for those inserted since, and -2 - position for those set since: entries are replaced, never changed in place.
+        self.origins = array("q", range(self.data_count))
+
+    def __len__(self):
+        return len(self.items)
+
+    def decode(self, i):
+        (
+            ctime_s,
+            ctime_ns,
+            mtime_s,
+            mtime_ns,
+            dev,
+            ino,
+            unused,
+            mode,
+            uid,
+            gid,
+            fsize,
+            sha,
+            flags,
+        ) = self.entry.unpack_from(self.data, self.offsets[i])
+        assert 0 == unused
+
+        mode_type = mode >> 12
+        # 0b0100 is a directory left out of a sparse checkout, stored as a single entry.
+        assert mode_type in [0b1000, 0b1010, 0b1110, 0b0100]
+
+        assert not flags & 0b0100000000000000, "Extended index entries aren't supported"
+
+        return VerizonIndexEntry(
+            ctime=(ctime_s, ctime_ns),
+            mtime=(mtime_s, mtime_ns),
+            dev=dev,
+            ino=ino,
+            mode_type=mode_type,
+            mode_perms=mode & 0b0000000111111111,
+            uid=uid,
+            gid=gid,
+            fsize=fsize,
+            binsha=sha,
+            flag_assume_valid=(flags & 0b1000000000000000) != 0,
+            flag_stage=flags & 0b0011000000000000,
+            name=self.name(i),
+        )
+
+    def name(self, i):
+        """The name of entry i, without decoding the rest of it."""
+        item = self.items[i]
+        if item is not None:
+            return item.name
+        start = self.offsets[i] + self.entry.size
+        return bytes(self.data[start : self.data.find(b"\x00", start)]).decode("utf8")
+
+    def raw(self, i):
+        """The bytes of entry i as read, or None once it's been decoded or replaced."""
+        if self.items[i] is not None or self.origins[i] < 0:
+            return None
+        return self.data[self.offsets[i] : self.ends[i]]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        item = self.items[i]
+        if item is None:
+            item = self.items[i] = self.decode(i)
+        return item
+
+    def __iter__(self):
+        for i in range(len(self.items)):
+            yield self[i]
+
+    def __setitem__(self, i, entry):
+        if isinstance(i, slice):
+            raise TypeError("Index entries can't be set by slice")
+        self.items[i] = entry
+        if self.origins[i] >= 0:
+            self.origins[i] = -2 - self.origins[i]
+
+    def __delitem__(self, i):
+        del self.items[i]
+        del self.offsets[i]
+        del self.ends[i]
+        del self.origins[i]
+
+    def insert(self, i, entry):
+        self.items.insert(i, entry)
+        # Inserted entries are never read from data, their offset doesn't matter.
+        self.offsets.insert(i, 0)
+        self.ends.insert(i, 0)
+        self.origins.insert(i, -1)
+
 
 class VerizonIndex:
-    version = None
-    entries = []
+    __slots__ = ("version", "entries", "base", "fsmonitor", "checksum")
 
-    def __init__(self, version=2, entries=None) -> None:
+    def __init__(
+        self, version=2, entries=None, base=None, fsmonitor=None, checksum=None
+    ) -> None:
         if not entries:
             entries = list()
 
         self.version = version
         self.entries = entries
+        self.base = base  # the sha of the shared index entries were read from, for a split index.
+        self.fsmonitor = (
+            fsmonitor  # (token, paths) of the last status, see fsmonitor_query.
+        )
+        self.checksum = checksum  # the SHA-1 of the index file read.
 
 
 class VerizonIgnore:
@@ -153,3 +328,392 @@ class VerizonIgnore:
     def __init__(self, absolute, scoped) -> None:
         self.absolute = absolute
         self.scoped = scoped
+
+
+class VerizonBloomFilter:
+    # Same parameters as git's changed-path filters: 10 bits per entry and 7 hashes give roughly a 1% false positive rate.
+    bits_per_entry = 10
+    num_hashes = 7
+
+    def __init__(self, data=None, count=0, num_hashes=7) -> None:
+        if data is None:
+            nbytes = (count * self.bits_per_entry + 7) // 8
+            data = bytearray(nbytes)
+
+        self.data = data
+        self.num_hashes = num_hashes
+
+    def positions(self, key):
+        nbits = len(self.data) * 8
+        digest = hashlib.blake2b(key, digest_size=8).digest()
+        h1 = int.from_bytes(digest[:4], "big")
+        h2 = int.from_bytes(digest[4:], "big") | 1
+
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % nbits
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.data[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        """False means the key was definitely never added, True means it may have been."""
+        if not self.data:
+            return False
+
+        for pos in self.positions(key):
+            if not self.data[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class VerizonObjectSet:
+    """The loose objects of an object store: a sorted array of binary shas, with a Bloom filter in front of it, plus the shas written since, kept in a set. Answers whether the store has an object without a syscall."""
+
+    header = struct.Struct(">4sBBxxIII")
+
+    def __init__(self, data) -> None:
+        (
+            signature,
+            version,
+            num_hashes,
+            count,
+            log_offset,
+            bloom_size,
+        ) = self.header.unpack_from(data)
+        if signature != b"VOBS" or version != 1:
+            raise Exception("Malformed object set")
+
+        self.data = data
+        self.count = count
+        self.shas_at = self.header.size
+        bloom_at = self.shas_at + count * 20
+        self.bloom = VerizonBloomFilter(
+            data=data[bloom_at : bloom_at + bloom_size], num_hashes=num_hashes
+        )
+
+        self.log_offset = (
+            log_offset  # how much of the log the sorted shas already hold.
+        )
+        self.log_size = log_offset  # how much of the log has been read.
+        self.added: set[str] = set()
+
+    def __len__(self):
+        return self.count + len(self.added)
+
+    def __contains__(self, sha):
+        if sha in self.added:
+            return True
+
+        raw = bytes.fromhex(sha)
+        if raw not in self.bloom:
+            return False
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            at = self.shas_at + mid * 20
+            cur = self.data[at : at + 20]
+            if cur == raw:
+                return True
+            if cur < raw:
+                lo = mid + 1
+            else:
+                hi = mid
+        return False
+
+    def shas(self):
+        for pos in range(self.count):
+            at = self.shas_at + pos * 20
+            yield self.data[at : at + 20].hex()
+        yield from self.added
+
+
+class VerizonCommitGraph:
+    """A read-only view over the commit-graph file. Fields are decoded on demand, so opening the graph doesn't cost anything per commit."""
+
+    header = struct.Struct(">4sBBBxII")
+    commit_data = struct.Struct(">20sIIIQ")
+
+    # Parent slots, the same as git's commit-graph.
+    parent_none = 0x70000000
+    parent_extra = 0x80000000
+
+    def __init__(self, data) -> None:
+        signature, version, num_hashes, _, count, edges = self.header.unpack_from(data)
+        if signature != b"VCGF" or version != 1:
+            raise Exception("Malformed commit-graph file")
+
+        self.data = data
+        self.count = count
+        self.num_hashes = num_hashes
+
+        self.fanout_at = self.header.size
+        self.oids_at = self.fanout_at + 256 * 4
+        self.commits_at = self.oids_at + count * 20
+        self.edges_at = self.commits_at + count * self.commit_data.size
+        self.bloom_index_at = self.edges_at + edges * 4
+        self.bloom_data_at = self.bloom_index_at + count * 4
+
+    def oid(self, pos):
+        at = self.oids_at + pos * 20
+        return self.data[at : at + 20].hex()
+
+    def lookup(self, sha):
+        """Return the position of sha in the graph, or None."""
+        raw = bytes.fromhex(sha)
+        lo = 0 if raw[0] == 0 else self.fanout(raw[0] - 1)
+        hi = self.fanout(raw[0])
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            at = self.oids_at + mid * 20
+            cur = self.data[at : at + 20]
+            if cur == raw:
+                return mid
+            if cur < raw:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return None
+
+    def fanout(self, byte):
+        return struct.unpack_from(">I", self.data, self.fanout_at + byte * 4)[0]
+
+    def commit(self, pos):
+        """Return (tree, parent positions, generation, commit time) of the commit at pos."""
+        tree, p1, p2, generation, time = self.commit_data.unpack_from(
+            self.data, self.commits_at + pos * self.commit_data.size
+        )
+
+        parents = list()
+        if p1 != self.parent_none:
+            parents.append(p1)
+
+        if p2 & self.parent_extra:
+            at = self.edges_at + (p2 & ~self.parent_extra) * 4
+            while True:
+                edge = struct.unpack_from(">I", self.data, at)[0]
+                parents.append(edge & ~self.parent_extra)
+                if edge & self.parent_extra:
+                    break
+                at += 4
+        elif p2 != self.parent_none:
+            parents.append(p2)
+
+        return tree.hex(), parents, generation, time
+
+    def bloom(self, pos):
+        """Return the changed-path filter of the commit at pos, against its first parent."""
+        start = 0
+        if pos > 0:
+            start = struct.unpack_from(
+                ">I", self.data, self.bloom_index_at + (pos - 1) * 4
+            )[0]
+        end = struct.unpack_from(">I", self.data, self.bloom_index_at + pos * 4)[0]
+
+        at = self.bloom_data_at
+        return VerizonBloomFilter(
+            data=self.data[at + start : at + end], num_hashes=self.num_hashes
+        )
+
+
+class VerizonCommitTable:
+    """Commits as rows of a few flat arrays, addressed by position, with only what a history walk needs. Much lighter than a VerizonCommit per commit."""
+
+    # Commits which aren't in the commit-graph have no generation number, git uses the same marker.
+    generation_infinity = 0xFFFFFFFF
+
+    def __init__(self) -> None:
+        self.oids: list[str] = list()
+        self.pos: dict[str, int] = dict()
+        self.parents: list[
+            list
+        ] = list()  # Positions, or shas while the parents haven't been loaded.
+        self.generation = array("I")
+        self.time = array("Q")
+
+    def __len__(self):
+        return len(self.oids)
+
+    def append(self, sha, parents, generation, time):
+        self.pos[sha] = len(self.oids)
+        self.oids.append(sha)
+        self.parents.append(parents)
+        self.generation.append(generation)
+        self.time.append(time)
+        return self.pos[sha]
+
+
+class VerizonDiffPair:
+    """One file of a diff. The old side is missing for added files and the new side for deleted ones."""
+
+    def __init__(
+        self,
+        old_path,
+        new_path,
+        old_sha,
+        new_sha,
+        new_data=None,
+        status=None,
+        score=None,
+    ) -> None:
+        self.old_path = old_path
+        self.new_path = new_path
+        self.old_sha = old_sha
+        self.new_sha = new_sha
+        self.new_data = new_data  # the new content when it isn't in the object store, like a worktree file.
+        self.score = score  # similarity of renames and copies, from 0 to 1.
+
+        if status is None:
+            if old_sha is None:
+                status = "added"
+            elif new_sha is None:
+                status = "deleted"
+            else:
+                status = "modified"
+        self.status = status
+
+    @property
+    def path(self):
+        return self.new_path if self.new_path is not None else self.old_path
+
+
+class VerizonPackIndex:
+    """The index of a pack: its objects' shas, sorted, and where each one starts in the pack."""
+
+    header = struct.Struct(">4sII")
+
+    def __init__(self, data, pack_path=None) -> None:
+        signature, version, count = self.header.unpack_from(data)
+        if signature != b"VIDX" or version != 1:
+            raise Exception("Malformed pack index")
+
+        self.data = data
+        self.count = count
+        self.pack_path = pack_path
+        self.pack_data = None  # a memoryview of the mapped pack, once read from.
+        self.bitmap = None  # its reachability bitmaps, once looked for, False when there are none.
+
+        self.fanout_at = self.header.size
+        self.shas_at = self.fanout_at + 256 * 4
+        self.offsets_at = self.shas_at + count * 20
+
+    def fanout(self, byte):
+        return struct.unpack_from(">I", self.data, self.fanout_at + byte * 4)[0]
+
+    def sha(self, pos):
+        at = self.shas_at + pos * 20
+        return self.data[at : at + 20].hex()
+
+    def offset(self, pos):
+        return struct.unpack_from(">Q", self.data, self.offsets_at + pos * 8)[0]
+
+    def position(self, sha):
+        """Return the position of sha in the index, or None."""
+        raw = bytes.fromhex(sha)
+        lo = 0 if raw[0] == 0 else self.fanout(raw[0] - 1)
+        hi = self.fanout(raw[0])
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            at = self.shas_at + mid * 20
+            cur = self.data[at : at + 20]
+            if cur == raw:
+                return mid
+            if cur < raw:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return None
+
+    def lookup(self, sha):
+        """Return the offset of sha in the pack, or None."""
+        pos = self.position(sha)
+        return None if pos is None else self.offset(pos)
+
+    def pack_checksum(self):
+        return self.data[-40:-20].hex()
+
+    def prefixed(self, prefix):
+        """Yield the shas starting with the hex prefix."""
+        first = int(prefix[0:2], 16)
+        lo = 0 if first == 0 else self.fanout(first - 1)
+        for pos in range(lo, self.fanout(first)):
+            sha = self.sha(pos)
+            if sha.startswith(prefix):
+                yield sha
+
+
+class VerizonBitmapIndex:
+    """The reachability bitmaps of a pack. Bit i of a bitmap stands for the i-th object in pack order, and the bitmap of a commit has the bit of every object reachable from it. Bitmaps are EWAH-compressed."""
+
+    header = struct.Struct(">4sBxxxII")
+    ewah_header = struct.Struct(">II")
+
+    def __init__(self, data) -> None:
+        signature, version, count, num_commits = self.header.unpack_from(data)
+        if signature != b"VBMP" or version != 1:
+            raise Exception("Malformed bitmap index")
+
+        self.data = data
+        self.count = count
+        at = self.header.size
+
+        self.pack_checksum = data[at : at + 20].hex()
+        at += 20
+
+        # The index position of the object at each pack position, and back.
+        self.order = array("I", struct.unpack_from(f">{count}I", data, at))
+        at += count * 4
+        self.index_to_pack = array("I", bytes(count * 4))
+        for pack_pos, index_pos in enumerate(self.order):
+            self.index_to_pack[index_pos] = pack_pos
+
+        # Where each bitmap starts: one per object type, then one per selected commit.
+        self.types = dict()
+        for fmt in (b"commit", b"tree", b"blob", b"tag"):
+            self.types[fmt] = at
+            at = self.ewah_end(at)
+
+        self.commits = dict()
+        for _ in range(num_commits):
+            (pack_pos,) = struct.unpack_from(">I", data, at)
+            self.commits[pack_pos] = at + 4
+            at = self.ewah_end(at + 4)
+
+    def ewah_end(self, at):
+        _, num_words = self.ewah_header.unpack_from(self.data, at)
+        return at + self.ewah_header.size + num_words * 8
+
+
+class VerizonObjectCache:
+    """Inflated objects, the least recently used ones dropped past max_size bytes. Safe to share between threads."""
+
+    def __init__(self, max_size=64 * 1024 * 1024) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.entries: OrderedDict[str, tuple[bytes, bytes]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, sha):
+        with self.lock:
+            entry = self.entries.get(sha)
+            if entry is not None:
+                self.entries.move_to_end(sha)
+            return entry
+
+    def put(self, sha, fmt, data):
+        if len(data) > self.max_size:
+            return
+
+        with self.lock:
+            if sha in self.entries:
+                return
+            self.entries[sha] = (fmt, data)
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, (_, old) = self.entries.popitem(last=False)
+                self.size -= len(old)
@@ -0,0 +1,138 @@
+import configparser
+import errno
+import os
+import shutil
+
+from class_utils import object_find, object_read, index_write
+from classes import VerizonIndex, VerizonRepository
+from other_utils import (
+    branch_get_active,
+    index_entry_from_stat,
+    ref_list,
+    tree_checkout,
+    tree_to_dict,
+)
+from utils import repo_create, repo_dir, repo_file
+
+
+def link_or_copy(src, dst, link):
+    """Hardlink src to dst when link is set, copy it otherwise. Return whether the next file can still be linked: once a link fails across filesystems, every other one would too."""
+    if link:
+        try:
+            os.link(src, dst)
+            return True
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+
+    shutil.copy2(src, dst)
+    return False
+
+
+def objects_clone(src_objects, dst_objects):
+    """Hardlink, or copy, every object file and pack of src_objects into dst_objects. Objects are immutable, so sharing their inodes is safe."""
+    link = True
+    for root, _, files in os.walk(src_objects):
+        rel_root = os.path.relpath(root, src_objects)
+        dst_root = os.path.join(dst_objects, rel_root)
+        os.makedirs(dst_root, exist_ok=True)
+
+        for f in files:
+            # The alternates of the source are written separately, with absolute paths.
+            if rel_root == "info" and f == "alternates":
+                continue
+            dst = os.path.join(dst_root, f)
+            if os.path.exists(dst):
+                continue
+            # The object set log is appended to in place, a shared inode would mix both stores.
+            if rel_root == "info" and f.startswith("object-set"):
+                shutil.copy2(os.path.join(root, f), dst)
+                continue
+            link = link_or_copy(os.path.join(root, f), dst, link)
+
+
+def refs_flatten(refs, prefix=""):
+    ret = dict()
+    for k, v in refs.items():
+        name = f"{prefix}/{k}" if prefix else k
+        if isinstance(v, str):
+            ret[name] = v
+        elif v:
+            ret.update(refs_flatten(v, name))
+    return ret
+
+
+def repo_clone(src, dst, shared=False):
+    """Clone the local repository at src into a new one at dst. With shared, no object is linked or copied: dst reads them from src through objects/info/alternates."""
+    src_repo = VerizonRepository(os.path.realpath(src))
+    repo = repo_create(dst)
+
+    src_objects = os.path.realpath(os.path.join(src_repo.vrzdir, "objects"))
+    dst_objects = repo_dir(repo, "objects")
+
+    src_alternates = os.path.join(src_objects, "info", "alternates")
+    alternates = list()
+    if shared:
+        alternates.append(src_objects)
+    else:
+        objects_clone(src_objects, dst_objects)
+
+    # The source's own alternates have to be reachable from the clone too.
+    if os.path.isfile(src_alternates):
+        with open(src_alternates, "r") as f:
+            for line in f.read().splitlines():
+                if line.strip() and not line.startswith("#"):
+                    alternates.append(os.path.realpath(os.path.join(src_objects, line)))
+
+    if alternates:
+        with open(
+            repo_file(repo, "objects", "info", "alternates", mkdir=True), "w"
+        ) as f:
+            for alternate in alternates:
+                f.write(alternate + "\n")
+
+    # Branches become remote-tracking refs, tags are kept as they are.
+    refs = refs_flatten(ref_list(src_repo))
+    for name, sha in refs.items():
+        if not sha:
+            continue
+        if name.startswith("heads/"):
+            target = "remotes/origin/" + name[len("heads/") :]
+        elif name.startswith("tags/"):
+            target = name
+        else:
+            continue
+
+        with open(repo_file(repo, "refs", *target.split("/"), mkdir=True), "w") as f:
+            f.write(sha + "\n")
+
+    config = configparser.ConfigParser()
+    config.read([repo_file(repo, "config")])
+    config.add_section('remote "origin"')
+    config.set('remote "origin"', "url", os.path.realpath(src))
+    with open(repo_file(repo, "config"), "w") as f:
+        config.write(f)
+
+    branch = branch_get_active(src_repo)
+    head = refs.get("heads/" + branch) if branch else None
+    if not head:
+        return repo
+
+    with open(
+        repo_file(repo, "refs", "heads", *branch.split("/"), mkdir=True), "w"
+    ) as f:
+        f.write(head + "\n")
+    with open(repo_file(repo, "HEAD"), "w") as f:
+        f.write(f"ref: refs/heads/{branch}\n")
+
+    # Check out HEAD and build the index from what was written.
+    tree = object_read(repo, object_find(repo, head, fmt=b"tree"))
+    tree_checkout(repo, tree, repo.worktree)
+
+    index = VerizonIndex()
+    for path, sha in sorted(tree_to_dict(repo, head).items()):
+        full_path = os.path.join(repo.worktree, path)
+        index.entries.append(index_entry_from_stat(path, sha, os.stat(full_path)))
+    index_write(repo, index)
+
+    return repo
@@ -1,33 +1,11 @@
 import os
-import grp
-import pwd
+import sys
 
 from datetime import datetime
 
 from utils import repo_find, repo_create, repo_file
-from other_utils import (
-    cat_file,
-    add,
-    object_hash,
-    log_graphviz,
-    object_find,
-    ls_tree,
-    object_read,
-    ref_list,
-    tree_checkout,
-    show_ref,
-    tag_create,
-    commit_create,
-    vrzconfig_user_get,
-    index_read,
-    tree_to_dict,
-    vrzconfig_read,
-    vrzignore_read,
-    check_ignore,
-    branch_get_active,
-    rm,
-    tree_from_index,
-)
+
+# Every command imports what it needs itself, for none to load the modules of the others: this one is imported by all of them, see CMD_SERVER_BENCH_IMPORTS.
 
 
 def cmd_init(args):
@@ -35,16 +13,42 @@ def cmd_init(args):
 
 
 def cmd_add(args):
+    from other_utils import add, add_update
+
+    repo = repo_find()
+    if args.update:
+        add_update(repo, args.path)
+    elif not args.path:
+        raise Exception("Nothing specified, nothing added")
+    else:
+        add(repo, args.path)
+
+
+def cmd_archive(args):
+    from archive_utils import archive, archive_format
+
     repo = repo_find()
-    add(repo, args.path)
+    fmt = args.format or archive_format(args.output)
+
+    if args.output is None:
+        archive(repo, args.tree, sys.stdout.buffer, fmt, args.prefix)
+        sys.stdout.buffer.flush()
+        return
+
+    with open(args.output, "wb") as out:
+        archive(repo, args.tree, out, fmt, args.prefix)
 
 
 def cmd_cat_file(args):
+    from other_utils import cat_file
+
     repo = repo_find()
     cat_file(repo, args.object, fmt=args.type.encode())
 
 
 def cmd_hash_object(args):
+    from other_utils import object_hash
+
     if args.write:
         repo = repo_find()
     else:
@@ -56,23 +60,311 @@ def cmd_hash_object(args):
 
 
 def cmd_log(args):
+    from commit_graph_utils import log_path
+    from other_utils import log_graphviz, object_find, object_read, pathspec_normalize
+
     repo = repo_find()
+
+    if args.pathspec:
+        pathspec = pathspec_normalize(repo, args.pathspec)
+        for sha in log_path(repo, object_find(repo, args.commit), pathspec):
+            message = object_read(repo, sha).kvlm[None].decode("utf8").strip()
+            print(f"{sha} {message.splitlines()[0] if message else ''}")
+        return
+
     print("digraph verizonlog{")
     print("  node[shape=rect]")
     log_graphviz(repo, object_find(repo, args.commit), set())
     print("}")
 
 
+def cmd_clone(args):
+    from clone_utils import repo_clone
+
+    repo_clone(args.source, args.directory, shared=args.shared)
+
+
+def cmd_fetch(args):
+    from transport_utils import fetch
+
+    repo = repo_find()
+    for ref, old, new in fetch(repo, args.remote):
+        print(f"{old[:7] if old else '(new)'}..{new[:7]} {ref}")
+
+
+def cmd_push(args):
+    from other_utils import branch_get_active
+    from transport_utils import push
+
+    repo = repo_find()
+    branches = args.branch
+    if not branches:
+        branches = [branch_get_active(repo)]
+        if not branches[0]:
+            raise Exception("HEAD is detached, name the branches to push")
+
+    rejected = False
+    for ref, status in push(repo, args.remote, branches, force=args.force):
+        print(f"{ref}: {status}")
+        rejected = rejected or status not in ("ok", "up to date")
+    if rejected:
+        sys.exit(1)
+
+
+def cmd_upload_pack(args):
+    from transport_utils import upload_pack
+
+    repo = repo_find(args.directory)
+    upload_pack(repo, sys.stdin.buffer, sys.stdout.buffer)
+
+
+def cmd_receive_pack(args):
+    from transport_utils import receive_pack
+
+    repo = repo_find(args.directory)
+    receive_pack(repo, sys.stdin.buffer, sys.stdout.buffer)
+
+
+def cmd_serve(args):
+    import asyncio
+
+    from server_utils import serve_load_test, server_start
+
+    repos = dict()
+    for spec in args.repository:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            name, path = os.path.basename(os.path.realpath(spec)), spec
+        repos[name] = path
+
+    if args.load_test:
+        asyncio.run(
+            serve_load_test(
+                repos, args.load_test, args.connections, args.concurrency, args.workers
+            )
+        )
+        return
+
+    async def serve():
+        server = await server_start(
+            repos, args.host, args.port, args.concurrency, args.workers
+        )
+        print(f"Serving {', '.join(repos)} on http://{args.host}:{args.port}")
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def cmd_fast_import(args):
+    from fast_import_utils import fast_import
+
+    repo = repo_find()
+    counts, updated, refused = fast_import(repo, sys.stdin.buffer, force=args.force)
+
+    print(
+        f"Imported {counts[b'blob']} blobs, {counts[b'tree']} trees, {counts[b'commit']} commits and {counts[b'tag']} tags"
+    )
+    for ref in updated:
+        print(f"Updated {ref}")
+
+    for ref in refused:
+        print(f"Not updating {ref}: it has commits the import doesn't, use --force")
+    if refused:
+        sys.exit(1)
+
+
+def cmd_fsck(args):
+    from fsck_utils import fsck
+
+    repo = repo_find()
+    broken = False
+
+    for kind, _, message in fsck(repo, args.connectivity_only, args.jobs):
+        # Dangling objects are only garbage, not damage.
+        broken = broken or kind != "dangling"
+        print(message, flush=True)
+
+    if broken:
+        sys.exit(1)
+
+
+def cmd_fsmonitor(args):
+    from fsmonitor_utils import (
+        fsmonitor_query,
+        fsmonitor_run,
+        fsmonitor_start,
+        fsmonitor_stop,
+    )
+    from other_utils import index_read
+
+    repo = repo_find()
+
+    match args.action:
+        case "start":
+            fsmonitor_start(repo)
+        case "run":
+            fsmonitor_run(repo)
+        case "stop":
+            if not fsmonitor_stop(repo):
+                print("The fsmonitor daemon isn't running")
+                sys.exit(1)
+        case "status":
+            found = fsmonitor_query(repo, index_read(repo))
+            if found is None:
+                print("The fsmonitor daemon isn't running")
+                sys.exit(1)
+            print(f"The fsmonitor daemon is watching {repo.worktree}")
+
+
+def cmd_cmd_server(args):
+    from cmd_server_utils import (
+        cmd_server_bench,
+        cmd_server_run,
+        cmd_server_running,
+        cmd_server_start,
+        cmd_server_stop,
+    )
+
+    repo = repo_find()
+
+    match args.action:
+        case "start":
+            cmd_server_start(repo)
+        case "run":
+            cmd_server_run(repo)
+        case "stop":
+            if not cmd_server_stop(repo):
+                print("The command server isn't running")
+                sys.exit(1)
+        case "status":
+            if not cmd_server_running(repo):
+                print("The command server isn't running")
+                sys.exit(1)
+            print(f"The command server is running for {repo.worktree}")
+        case "bench":
+            if not cmd_server_bench(repo):
+                print("Importing the commands is over budget")
+                sys.exit(1)
+
+
+def cmd_grep(args):
+    from grep_utils import grep
+    from other_utils import index_read
+
+    repo = repo_find()
+    if args.cached and args.tree:
+        raise Exception("--cached can't be used with a tree")
+
+    found = False
+    prefix = f"{args.tree}:" if args.tree else ""
+    out = sys.stdout.buffer
+
+    for path, binary, matches in grep(
+        repo,
+        args.pattern,
+        index=None if args.tree else index_read(repo),
+        ref=args.tree,
+        cached=args.cached,
+        pathspec=args.pathspec,
+        ignore_case=args.ignore_case,
+        max_count=args.max_count,
+        files_only=args.files_with_matches,
+        jobs=args.jobs,
+    ):
+        found = True
+        name = (prefix + path).encode("utf8")
+
+        if args.files_with_matches:
+            out.write(name + b"\n")
+        elif binary:
+            out.write(b"Binary file " + name + b" matches\n")
+        else:
+            for lineno, line in matches:
+                number = f"{lineno}:".encode("ascii") if args.line_number else b""
+                out.write(name + b":" + number + line + b"\n")
+
+    out.flush()
+    if not found:
+        sys.exit(1)
+
+
+def cmd_repack(args):
+    from pack_utils import repack
+
+    repo = repo_find()
+    count = repack(repo, delete=args.delete, write_bitmap=args.write_bitmap)
+    print(f"Packed {count} objects")
+
+
+def cmd_count_objects(args):
+    from pack_utils import objects_count, objects_count_reachable
+
+    repo = repo_find()
+    counts = objects_count(repo)
+
+    if not args.verbose:
+        print(f"{counts['count']} objects, {counts['size'] // 1024} kilobytes")
+        return
+
+    print(f"count: {counts['count']}")
+    print(f"size: {counts['size'] // 1024}")
+    print(f"in-pack: {counts['in-pack']}")
+    print(f"packs: {counts['packs']}")
+    print(f"size-pack: {counts['size-pack'] // 1024}")
+
+    reachable = objects_count_reachable(repo)
+    print(f"reachable: {sum(reachable.values())}")
+    for fmt, count in reachable.items():
+        print(f"  {fmt}s: {count}")
+
+
+def cmd_commit_graph(args):
+    from commit_graph_utils import commit_graph_write
+
+    repo = repo_find()
+    count = commit_graph_write(repo)
+    print(f"Wrote commit-graph with {count} commits")
+
+
+def cmd_merge_base(args):
+    from merge_base_utils import is_ancestor, merge_base
+    from other_utils import object_find
+
+    repo = repo_find()
+    commits = [object_find(repo, c, fmt=b"commit") for c in args.commit]
+
+    if args.is_ancestor:
+        if len(commits) != 2:
+            raise Exception("--is-ancestor takes exactly two commits")
+        sys.exit(0 if is_ancestor(repo, commits[0], commits[1]) else 1)
+
+    if len(commits) < 2:
+        raise Exception("merge-base needs at least two commits")
+
+    bases = merge_base(repo, commits[0], commits[1:], find_all=args.all)
+    if not bases:
+        sys.exit(1)
+
+    for sha in bases:
+        print(sha)
+
+
 def cmd_ls_tree(args):
+    from other_utils import ls_tree
+
     repo = repo_find()
     ls_tree(repo, args.tree, args.recursive)
 
 
 def cmd_checkout(args):
+    from other_utils import object_find, object_read, tree_checkout
+    from sparse_utils import sparse_read
+
     repo = repo_find()
     obj = object_read(repo, object_find(repo, args.commit))
 
-    if obj.fmt == b"tree":
+    if obj.fmt == b"commit":
         obj = object_read(repo, obj.kvlm[b"tree"].decode("ascii"))
 
     if os.path.exists(args.path):
@@ -83,16 +375,20 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path)
 
-    tree_checkout(repo, obj, os.path.relpath(args.path))
+    tree_checkout(repo, obj, os.path.relpath(args.path), cone=sparse_read(repo))
 
 
 def cmd_show_ref(args):
+    from other_utils import ref_list, show_ref
+
     repo = repo_find()
     refs = ref_list(repo)
     show_ref(repo, refs, prefix="refs")
 
 
 def cmd_tag(args):
+    from other_utils import ref_list, show_ref, tag_create
+
     repo = repo_find()
 
     if args.name:
@@ -109,6 +405,8 @@ def cmd_tag(args):
 
 
 def cmd_rev_parse(args):
+    from other_utils import object_find
+
     if args.type:
         fmt = args.type.encode()
     else:
@@ -119,6 +417,11 @@ def cmd_rev_parse(args):
 
 
 def cmd_ls_files(args):
+    import grp
+    import pwd
+
+    from other_utils import index_read
+
     repo = repo_find()
     index = index_read(repo)
 
@@ -132,9 +435,12 @@ def cmd_ls_files(args):
         if args.verbose:
             print(
                 "  {} with perms: {:o}".format(
-                    {0b1000: "regular_file", 0b1010: "symlink", 0b1110: "git link"}[
-                        e.mode_type
-                    ],
+                    {
+                        0b1000: "regular_file",
+                        0b1010: "symlink",
+                        0b1110: "git link",
+                        0b0100: "sparse directory",
+                    }[e.mode_type],
                     e.mode_perms,
                 )
             )
@@ -151,6 +457,8 @@ def cmd_ls_files(args):
 
 
 def cmd_check_ignore(args):
+    from other_utils import check_ignore, vrzignore_read
+
     repo = repo_find()
     rules = vrzignore_read(repo)
 
@@ -159,65 +467,113 @@ def cmd_check_ignore(args):
             print(path)
 
 
+def cmd_diff(args):
+    from diff_utils import (
+        diff_pairs_cached,
+        diff_pairs_trees,
+        diff_pairs_worktree,
+        diff_print,
+        diff_print_stat,
+    )
+    from other_utils import index_read, object_find
+    from rename_utils import detect_renames
+
+    repo = repo_find()
+
+    match len(args.commit):
+        case 0:
+            index = index_read(repo)
+            if args.cached:
+                pairs = diff_pairs_cached(repo, index, args.pathspec)
+            else:
+                pairs = diff_pairs_worktree(repo, index, args.pathspec)
+        case 1:
+            if not args.cached:
+                raise Exception(
+                    "Diffing a commit against the worktree isn't supported, use --cached"
+                )
+            pairs = diff_pairs_cached(
+                repo, index_read(repo), args.pathspec, ref=args.commit[0]
+            )
+        case 2:
+            pairs = diff_pairs_trees(
+                repo,
+                object_find(repo, args.commit[0], fmt=b"tree"),
+                object_find(repo, args.commit[1], fmt=b"tree"),
+                pathspec=args.pathspec,
+            )
+        case _:
+            raise Exception("diff takes at most two commits")
+
+    if not args.no_renames:
+        pairs = detect_renames(repo, pairs, copies=args.find_copies)
+
+    if args.stat:
+        diff_print_stat(repo, pairs)
+    else:
+        diff_print(repo, pairs)
+
+
 def cmd_status_head_index(repo, index):
-    print("Changes to be committed.")
+    from diff_utils import diff_pairs_cached
+    from rename_utils import detect_renames
 
-    head = tree_to_dict(repo, "HEAD")
-    for entry in index.entries:
-        if entry.name in head:
-            if head[entry.name] != entry.sha:
-                print(f"  modified: {entry.name}")
-            del head[entry.name]
-        else:
-            print(f"  added:  {entry.name}")
+    print("Changes to be committed.")
 
-    for entry in head.keys():
-        print(f"  deleted: {entry}")
+    for pair in detect_renames(repo, diff_pairs_cached(repo, index)):
+        match pair.status:
+            case "modified":
+                print(f"  modified: {pair.path}")
+            case "added":
+                print(f"  added:  {pair.path}")
+            case "deleted":
+                print(f"  deleted: {pair.path}")
+            case "renamed":
+                print(f"  renamed: {pair.old_path} -> {pair.new_path}")
 
 
 def cmd_status_index_worktree(repo, index):
+    from fsmonitor_utils import fsmonitor_query, fsmonitor_save, worktree_scan
+    from other_utils import check_ignore, object_hash, vrzignore_read
+
     print("Changes not staged for commit:")
 
-    ignore = vrzignore_read(repo)
-    vrzdir_prefix = repo.vrzdir + os.path.sep
-    all_files = list()
+    ignore = vrzignore_read(repo, index)
 
-    for root, _, files in os.walk(repo.worktree, True):
-        if root == repo.vrzdir or root.startswith(vrzdir_prefix):
-            continue
+    # With the fsmonitor daemon running, only the paths changed since the last status are looked at.
+    found = fsmonitor_query(repo, index)
+    token, paths = found if found is not None else (None, None)
+    dirty, untracked = worktree_scan(repo, index, paths)
 
-        for f in files:
-            full_path = os.path.join(root, f)
-            rel_path = os.path.relpath(full_path, repo.worktree)
-            all_files.append(rel_path)
+    changed = list()
+    refreshed = list()
+    for i, entry, stat in dirty:
+        if stat is None:
+            print(f"  deleted: {entry.name}")
+            changed.append(entry.name)
+            continue
 
-    for entry in index.entries:
         full_path = os.path.join(repo.worktree, entry.name)
-
-        if not os.path.exists(full_path):
-            print(f"  deleted: {entry.name}")
+        with open(full_path, "rb") as fd:
+            new_sha = object_hash(fd, b"blob", None)
+        if entry.sha != new_sha:
+            print(f"  modified: {entry.name}")
+            changed.append(entry.name)
         else:
-            stat = os.stat(full_path)
-
-            ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
-            mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
-
-            if (stat.st_ctime_ns != ctime_ns) or (stat.st_mtime_ns != mtime_ns):
-                with open(full_path, "rb") as fd:
-                    new_sha = object_hash(fd, b"blob", None)
-                    same = entry.sha == new_sha
-                    if not same:
-                        print(f"  modified: {entry.name}")
-        if entry.name in all_files:
-            all_files.remove(entry.name)
+            refreshed.append((i, stat))
 
     print("\nUntracked Files: ")
-    for f in all_files:
+    for f in untracked:
         if not check_ignore(ignore, f):
             print(" ", f)
 
+    if token is not None:
+        fsmonitor_save(repo, index, token, changed + untracked, refreshed)
+
 
 def cmd_status_branch(repo):
+    from other_utils import branch_get_active, object_find
+
     branch = branch_get_active(repo)
     if branch:
         print(f"On branch {branch}.")
@@ -226,6 +582,8 @@ def cmd_status_branch(repo):
 
 
 def cmd_status(_):
+    from other_utils import index_read
+
     repo = repo_find()
     index = index_read(repo)
 
@@ -235,33 +593,63 @@ def cmd_status(_):
     cmd_status_index_worktree(repo, index)
 
 
+def cmd_sparse_checkout(args):
+    from other_utils import sparse_checkout_apply
+    from sparse_utils import sparse_read
+
+    repo = repo_find()
+
+    match args.action:
+        case "set":
+            sparse_checkout_apply(repo, args.dirs)
+        case "disable":
+            sparse_checkout_apply(repo, None)
+        case "list":
+            for d in sparse_read(repo) or list():
+                print(d)
+
+
 def cmd_rm(args):
+    from other_utils import rm
+
     repo = repo_find()
     rm(repo, args.path)
 
 
 def cmd_commit(args):
+    from lock_utils import LockFile
+    from other_utils import (
+        branch_get_active,
+        commit_create,
+        index_read,
+        object_find,
+        ref_resolve,
+        refs_update,
+        tree_from_index,
+        vrzconfig_read,
+        vrzconfig_user_get,
+    )
+
     repo = repo_find()
-    index = index_read(repo)
 
-    tree = tree_from_index(repo, index)
+    # Commits are serialized on the index lock, and the branch only moves if it's still where this commit starts from.
+    with LockFile(repo_file(repo, "index")):
+        index = index_read(repo)
+        head = ref_resolve(repo, "HEAD")
 
-    commit = commit_create(
-        repo,
-        tree,
-        object_find(repo, "HEAD"),
-        vrzconfig_user_get(vrzconfig_read()),
-        datetime.now(),
-        args.message,
-    )
+        tree = tree_from_index(repo, index)
 
-    active_branch = branch_get_active(repo)
-    if active_branch:
-        with open(
-            repo_file(repo, os.path.join("refs/heads", active_branch)), "w"
-        ) as fd:
-            fd.write(commit + "\n")
+        commit = commit_create(
+            repo,
+            tree,
+            object_find(repo, "HEAD"),
+            vrzconfig_user_get(vrzconfig_read()),
+            datetime.now(),
+            args.message,
+        )
 
-    else:
-        with open(repo_file(repo, "HEAD"), "w") as fd:
-            fd.write("\n")
+        active_branch = branch_get_active(repo)
+        if active_branch:
+            refs_update(repo, [("refs/heads/" + active_branch, head, commit)])
+        else:
+            refs_update(repo, [("HEAD", head, commit)])
@@ -0,0 +1,485 @@
+import argparse
+
+## Main Logic. We will be working with CLI a lot.
+argparser = argparse.ArgumentParser(description="Verizon for Version Control")
+argsubparsers = argparser.add_subparsers(title="Command", dest="command")
+argsubparsers.required = True
+
+## Init
+argsp = argsubparsers.add_parser("init", help="Initialize a new, empty repo")
+
+argsp.add_argument(
+    "path",
+    metavar="directory",
+    nargs="?",
+    default=".",
+    help="Where to create the repository",
+)
+
+## Archive
+argsp = argsubparsers.add_parser(
+    "archive", help="Write the files of a tree-ish to a tar or zip archive."
+)
+
+argsp.add_argument(
+    "--format",
+    choices=["tar", "tar.gz", "zip"],
+    help="The archive format, guessed from the output file name by default.",
+)
+
+argsp.add_argument("-o", "--output", help="Write to this file instead of stdout.")
+
+argsp.add_argument(
+    "--prefix", default="", help="Prepend this to every path, like project/."
+)
+
+argsp.add_argument("tree", help="The commit, tag or tree to archive.")
+
+## Cat-File
+argsp = argsubparsers.add_parser(
+    "cat-file", help="Provide contents of repository objects."
+)
+
+argsp.add_argument(
+    "type",
+    metavar="type",
+    choices=["blob", "commit", "tag", "tree"],
+    help="Specify the type.",
+)
+
+argsp.add_argument("object", metavar="object", help="The object to display")
+
+## Count-Objects.
+argsp = argsubparsers.add_parser(
+    "count-objects", help="Count the objects and the disk space they take."
+)
+
+argsp.add_argument(
+    "-v",
+    "--verbose",
+    action="store_true",
+    help="Also count packs, and the objects reachable from the refs by type.",
+)
+
+## Diff.
+argsp = argsubparsers.add_parser(
+    "diff", help="Show changes between the worktree, the index and commits."
+)
+
+argsp.add_argument(
+    "--cached",
+    action="store_true",
+    help="Compare the index with HEAD, or with the given commit.",
+)
+
+argsp.add_argument(
+    "--stat", action="store_true", help="Only show how many lines changed per file."
+)
+
+argsp.add_argument(
+    "--no-renames",
+    action="store_true",
+    help="Show renamed files as a deletion and an addition.",
+)
+
+argsp.add_argument(
+    "-C",
+    "--find-copies",
+    action="store_true",
+    help="Also detect files copied from another changed file.",
+)
+
+argsp.add_argument("commit", nargs="*", help="Up to two commits or trees to compare.")
+
+## Hash-Object
+argsp = argsubparsers.add_parser(
+    "hash-object",
+    help="Compute the object ID and optionally create a blob from a file.",
+)
+
+argsp.add_argument(
+    "-t",
+    metavar="type",
+    dest="type",
+    choices=["blob", "commit", "tag", "tree"],
+    default="blob",
+    help="Specify the type.",
+)
+
+argsp.add_argument(
+    "-w",
+    dest="write",
+    action="store_true",
+    help="Actually write the object into the database.",
+)
+
+argsp.add_argument("path", help="Read object from file.")
+
+## Log
+argsp = argsubparsers.add_parser("log", help="Display the history of a given commit.")
+
+argsp.add_argument("commit", default="HEAD", nargs="?", help="Commit to start at.")
+
+## Commit-Graph.
+argsp = argsubparsers.add_parser(
+    "commit-graph",
+    help="Write the commit-graph file, with changed-path filters for `log -- <path>`.",
+)
+
+argsp.add_argument("action", choices=["write"], help="What to do with the graph.")
+
+## Ls-Tree
+argsp = argsubparsers.add_parser("ls-tree", help="Pretty print a tree object.")
+
+argsp.add_argument(
+    "-r", dest="recursive", action="store_true", help="Recurse into sub-trees."
+)
+
+argsp.add_argument("tree", help="A tree-ish object.")
+
+## Merge-Base.
+argsp = argsubparsers.add_parser(
+    "merge-base", help="Find the best common ancestor(s) of commits."
+)
+
+argsp.add_argument(
+    "--all", action="store_true", help="Output all the best common ancestors."
+)
+
+argsp.add_argument(
+    "--is-ancestor",
+    action="store_true",
+    help="Exit with status 0 if the first commit is an ancestor of the second, 1 otherwise.",
+)
+
+argsp.add_argument("commit", nargs="+", help="The commits.")
+
+## Checkout
+argsp = argsubparsers.add_parser(
+    "checkout", help="Checkout a commit inside of a directory."
+)
+
+argsp.add_argument("commit", help="The commit or tree to checkout.")
+
+argsp.add_argument("path", help="The empty directory to checkout on.")
+
+## Clone.
+argsp = argsubparsers.add_parser(
+    "clone", help="Clone a local repository into a new directory."
+)
+
+argsp.add_argument(
+    "--shared",
+    action="store_true",
+    help="Don't link or copy objects, read them from the source through objects/info/alternates.",
+)
+
+argsp.add_argument("source", help="The repository to clone.")
+
+argsp.add_argument("directory", help="Where to create the clone.")
+
+## Fetch.
+argsp = argsubparsers.add_parser(
+    "fetch", help="Download objects and refs from another repository."
+)
+
+argsp.add_argument(
+    "remote",
+    nargs="?",
+    default="origin",
+    help="The remote or url to fetch from, a path or pipe:<path>.",
+)
+
+## Fast-import.
+argsp = argsubparsers.add_parser(
+    "fast-import", help="Import a git fast-import stream, read from stdin."
+)
+
+argsp.add_argument(
+    "--force",
+    action="store_true",
+    help="Move refs even when they'd lose commits.",
+)
+
+## Fsck.
+argsp = argsubparsers.add_parser(
+    "fsck", help="Verify the objects of the repository and their connectivity."
+)
+
+argsp.add_argument(
+    "--connectivity-only",
+    action="store_true",
+    help="Only check that everything reachable is there, without reading blobs.",
+)
+
+argsp.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=None,
+    help="Worker processes, one per CPU by default.",
+)
+
+## Fsmonitor.
+argsp = argsubparsers.add_parser(
+    "fsmonitor",
+    help="Watch the worktree for changes, so status only looks at the files changed.",
+)
+
+argsp.add_argument(
+    "action",
+    choices=["start", "stop", "status", "run"],
+    help="Start the daemon in the background, stop it, check it runs, or run it in the foreground.",
+)
+
+## Cmd-server.
+argsp = argsubparsers.add_parser(
+    "cmd-server",
+    help="Run read-only commands in a resident process, which keeps the repository loaded.",
+)
+
+argsp.add_argument(
+    "action",
+    choices=["start", "stop", "status", "run", "bench"],
+    help="Start the server in the background, stop it, check it runs, run it in the foreground, or time commands with and without it.",
+)
+
+## Push.
+argsp = argsubparsers.add_parser(
+    "push", help="Update remote branches along with the objects they need."
+)
+
+argsp.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    help="Update branches which don't fast-forward.",
+)
+
+argsp.add_argument(
+    "remote",
+    nargs="?",
+    default="origin",
+    help="The remote or url to push to, a path or pipe:<path>.",
+)
+
+argsp.add_argument(
+    "branch", nargs="*", help="The branches to push, the current one by default."
+)
+
+## Upload-Pack.
+argsp = argsubparsers.add_parser(
+    "upload-pack", help="Send objects to a fetch over stdin and stdout."
+)
+
+argsp.add_argument("directory", help="The repository to serve.")
+
+## Receive-Pack.
+argsp = argsubparsers.add_parser(
+    "receive-pack", help="Receive objects from a push over stdin and stdout."
+)
+
+argsp.add_argument("directory", help="The repository to update.")
+
+## Serve.
+argsp = argsubparsers.add_parser(
+    "serve", help="Serve refs, objects and packs of repositories over HTTP."
+)
+
+argsp.add_argument("--host", default="127.0.0.1", help="The address to listen on.")
+
+argsp.add_argument("--port", type=int, default=8000, help="The port to listen on.")
+
+argsp.add_argument(
+    "--concurrency",
+    type=int,
+    default=64,
+    help="How many objects or packs can be sent at once.",
+)
+
+argsp.add_argument(
+    "--workers",
+    type=int,
+    default=None,
+    help="Threads reading and inflating objects, Python's default when unset.",
+)
+
+argsp.add_argument(
+    "--load-test",
+    metavar="REQUESTS",
+    type=int,
+    default=0,
+    help="Instead of serving, send this many requests to a localhost instance and report the latencies.",
+)
+
+argsp.add_argument(
+    "--connections",
+    type=int,
+    default=32,
+    help="Concurrent client connections of the load test.",
+)
+
+argsp.add_argument(
+    "repository",
+    nargs="+",
+    help="The repositories to serve, as a path or name=path.",
+)
+
+## Show-Ref.
+argsp = argsubparsers.add_parser("show-ref", help="List references.")
+
+## Tag.
+argsp = argsubparsers.add_parser("tag", help="List and create tags.")
+
+argsp.add_argument(
+    "-a",
+    action="store_true",
+    dest="create_tag_object",
+    help="Whether to create a tag object.",
+)
+
+argsp.add_argument("name", nargs="?", help="The new tag's name.")
+
+argsp.add_argument(
+    "object", default="HEAD", nargs="?", help="The object the new tag will point to."
+)
+
+## Repack.
+argsp = argsubparsers.add_parser(
+    "repack", help="Pack every reachable object into a single pack."
+)
+
+argsp.add_argument(
+    "-d",
+    action="store_true",
+    dest="delete",
+    help="Remove the loose objects and the packs the new pack makes redundant.",
+)
+
+argsp.add_argument(
+    "--write-bitmap",
+    action="store_true",
+    help="Also write reachability bitmaps for the new pack.",
+)
+
+## Rev-Parse.
+argsp = argsubparsers.add_parser(
+    "rev-parse", help="Parse revision(or other objects) identifiers."
+)
+
+argsp.add_argument(
+    "-vrz-type",
+    metavar="type",
+    dest="type",
+    choices=["blob", "commit", "tag", "tree"],
+    default=None,
+    help="Specify the expected type.",
+)
+
+argsp.add_argument("name", help="The name to parse.")
+
+## Grep.
+argsp = argsubparsers.add_parser(
+    "grep", help="Print the lines matching a pattern in tracked files or a tree."
+)
+
+argsp.add_argument(
+    "-i", "--ignore-case", action="store_true", help="Ignore case differences."
+)
+
+argsp.add_argument(
+    "-n", "--line-number", action="store_true", help="Prefix lines with their number."
+)
+
+argsp.add_argument(
+    "-l",
+    "--files-with-matches",
+    action="store_true",
+    help="Only print the names of matching files, each file's search stopping at its first match.",
+)
+
+argsp.add_argument(
+    "-m",
+    "--max-count",
+    metavar="NUM",
+    type=int,
+    default=None,
+    help="Stop searching a file after NUM matching lines.",
+)
+
+argsp.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=None,
+    help="Worker processes, one per CPU by default.",
+)
+
+argsp.add_argument(
+    "--cached",
+    action="store_true",
+    help="Search the blobs in the index instead of the worktree.",
+)
+
+argsp.add_argument("pattern", help="The regular expression to search for.")
+
+argsp.add_argument(
+    "tree", nargs="?", default=None, help="Search this tree-ish instead."
+)
+
+## Ls-Files.
+argsp = argsubparsers.add_parser("ls-files", help="List all the stage files.")
+
+argsp.add_argument("--verbose", action="store_true", help="Show everything.")
+
+## Check-Ignore.
+argsp = argsubparsers.add_parser(
+    "check-ignore", help="Check path(s) against ignore rules."
+)
+
+argsp.add_argument("path", nargs="+", help="Paths to check.")
+
+## Status.
+argsp = argsubparsers.add_parser("status", help="Show the working tree status.")
+
+## Sparse-Checkout.
+argsp = argsubparsers.add_parser(
+    "sparse-checkout", help="Only check out some directories of the worktree."
+)
+
+argsp.add_argument(
+    "action",
+    choices=["set", "list", "disable"],
+    help="Set the checked out directories, list them, or check out everything again.",
+)
+
+argsp.add_argument("dirs", nargs="*", help="The directories to check out, for set.")
+
+## Remove.
+argsp = argsubparsers.add_parser(
+    "rm", help="Remove files from the working tree and the index."
+)
+
+argsp.add_argument("path", nargs="+", help="Files to check.")
+
+## Add.
+argsp = argsubparsers.add_parser("add", help="Add file contents files to the index.")
+
+argsp.add_argument("path", nargs="*", help="Files to add.")
+
+argsp.add_argument(
+    "-u",
+    "--update",
+    action="store_true",
+    help="Stage the modified and deleted tracked files, under path if given.",
+)
+
+## Commit.
+argsp = argsubparsers.add_parser("commit", help="Record changes to the repository.")
+
+argsp.add_argument(
+    "-m",
+    metavar="message",
+    dest="message",
+    help="Message to associate with this commit.",
+)
@@ -0,0 +1,386 @@
+import os
+import struct
+import sys
+import time
+
+# Imported by main.py before anything else: what a client needs is only imported here, and what the server needs by its functions.
+
+# The commands a server runs for its clients: those which read nothing but their arguments, and write nothing but caches. status records the stat it refreshed in the index, through its lock like in a process of its own, see fsmonitor_save.
+CMD_SERVER_COMMANDS = {
+    "cat-file",
+    "check-ignore",
+    "diff",
+    "grep",
+    "log",
+    "ls-files",
+    "ls-tree",
+    "merge-base",
+    "rev-parse",
+    "show-ref",
+    "status",
+}
+
+# Imported by the server when it starts, rather than by the first command needing them.
+CMD_SERVER_PRELOAD = [
+    "main",
+    "cmd_fns",
+    "other_utils",
+    "diff_utils",
+    "rename_utils",
+    "fsmonitor_utils",
+    "commit_graph_utils",
+    "grep_utils",
+    "merge_base_utils",
+]
+
+# What a repository is opened again for when it changes: its config, and the packs and loose objects of its own store. The index isn't kept open, every command reads it again.
+CMD_SERVER_STAMPS = [
+    ("config",),
+    ("objects", "pack"),
+    ("objects", "info", "alternates"),
+    ("objects", "info", "object-set"),
+]
+
+CMD_SERVER_TIMEOUT = 5
+
+# A server with no client for this many seconds exits.
+CMD_SERVER_IDLE_TIMEOUT = 30 * 60
+
+# The exit code of a command and the size of its output, followed by the output, then what it wrote to stderr.
+CMD_SERVER_REPLY = struct.Struct(">iQ")
+
+# The most importing what any command needs may take in a fresh interpreter, see cmd_server_bench.
+CMD_SERVER_IMPORT_BUDGET = 0.15
+
+# What every command imports, then what most of them import on top.
+CMD_SERVER_BENCH_IMPORTS = [
+    "main",
+    "cmd_parser",
+    "cmd_fns",
+    "other_utils",
+    "sparse_utils",
+    "diff_utils",
+    "rename_utils",
+    "lock_utils",
+    "fsmonitor_utils",
+]
+
+CMD_SERVER_BENCH_RUNS = 5
+
+CMD_SERVER_BENCH_COMMANDS = [["rev-parse", "HEAD"], ["status"]]
+
+
+def cmd_server_socket_find(path):
+    """The socket of the command server of the repository around path, whether it runs or not, or None outside of a repository. Found like repo_find does, without loading what a repository needs."""
+    path = os.path.realpath(path)
+    while True:
+        if os.path.isdir(os.path.join(path, ".vrz")):
+            return os.path.join(path, ".vrz", "cmd-server.sock")
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def cmd_server_request(path, fields, timeout=CMD_SERVER_TIMEOUT):
+    """Send fields to the server listening on path. Return its reply, None when none answers."""
+    import socket
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        client.sendall(b"\x00".join(os.fsencode(f) for f in fields))
+        client.shutdown(socket.SHUT_WR)
+        reply = list()
+        while True:
+            chunk = client.recv(64 * 1024)
+            if not chunk:
+                break
+            reply.append(chunk)
+    except OSError:
+        # A socket left by a server that died, or one that hangs.
+        return None
+    finally:
+        client.close()
+
+    return b"".join(reply)
+
+
+def cmd_server_forward(argv):
+    """Run argv on the command server of the repository around the current directory, and write out what it printed. Return its exit code, or None when argv isn't a command for the server, or no server answers: it's then for this process to run."""
+    if not argv or argv[0] not in CMD_SERVER_COMMANDS:
+        return None
+    path = cmd_server_socket_find(".")
+    if path is None or not os.path.exists(path):
+        return None
+
+    # Commands take their time: once connected, the client waits as long as a command run here would.
+    reply = cmd_server_request(path, ["run", os.getcwd()] + argv, timeout=None)
+    if reply is None or len(reply) < CMD_SERVER_REPLY.size:
+        return None
+
+    code, size = CMD_SERVER_REPLY.unpack_from(reply)
+    at = CMD_SERVER_REPLY.size
+    sys.stdout.buffer.write(reply[at : at + size])
+    sys.stdout.buffer.flush()
+    sys.stderr.buffer.write(reply[at + size :])
+    sys.stderr.buffer.flush()
+    return code
+
+
+class CmdServer:
+    """Run commands for the clients of a repository, one at a time, in a process which keeps what they use loaded: the modules they import, and the repositories they open, with their packs mapped, object sets read and tree listings built. A repository is opened again when its config or object store changes."""
+
+    def __init__(self, repo) -> None:
+        import importlib
+
+        from class_utils import object_sets, packs_load
+
+        for name in CMD_SERVER_PRELOAD:
+            importlib.import_module(name)
+
+        self.repos: dict[
+            str, tuple
+        ] = dict()  # worktree to (stamps of CMD_SERVER_STAMPS, repository).
+        self.running = True
+
+        repo = self.repo_open(repo.worktree)
+        packs_load(repo)
+        object_sets(repo)
+
+    def repo_open(self, path):
+        """The repository at path, the one opened before unless it changed since."""
+        from classes import VerizonRepository
+        from utils import file_stamp
+
+        stamps = tuple(
+            file_stamp(os.path.join(path, ".vrz", *p)) for p in CMD_SERVER_STAMPS
+        )
+        found = self.repos.get(path)
+        if found is not None and found[0] == stamps:
+            return found[1]
+
+        repo = VerizonRepository(path)
+        self.repos[path] = (stamps, repo)
+        return repo
+
+    def run(self, cwd, argv):
+        """Run argv in cwd, like a process of its own would. Return (exit code, output, what it wrote to stderr)."""
+        import io
+        import traceback
+
+        from main import main_run
+
+        if not argv or argv[0] not in CMD_SERVER_COMMANDS:
+            return (
+                1,
+                b"",
+                f"Not a command the server runs: {' '.join(argv)}\n".encode("utf8"),
+            )
+
+        out = io.BytesIO()
+        err = io.BytesIO()
+        stdout = io.TextIOWrapper(out, encoding="utf8", write_through=True)
+        stderr = io.TextIOWrapper(
+            err, encoding="utf8", errors="backslashreplace", write_through=True
+        )
+        saved = (sys.stdout, sys.stderr, os.getcwd())
+
+        code = 0
+        try:
+            os.chdir(cwd)
+            sys.stdout, sys.stderr = stdout, stderr
+            main_run(argv)
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                code = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout, sys.stderr = saved[0], saved[1]
+            os.chdir(saved[2])
+
+        return code, out.getvalue(), err.getvalue()
+
+    def handle(self, conn):
+        conn.settimeout(CMD_SERVER_TIMEOUT)
+        with conn:
+            request = list()
+            while True:
+                chunk = conn.recv(64 * 1024)
+                if not chunk:
+                    break
+                request.append(chunk)
+
+            command, *fields = [
+                os.fsdecode(f) for f in b"".join(request).split(b"\x00")
+            ]
+            if command == "ping":
+                conn.sendall(b"pong")
+            elif command == "quit":
+                self.running = False
+                conn.sendall(b"bye")
+            elif command == "run" and fields:
+                code, out, err = self.run(fields[0], fields[1:])
+                conn.sendall(CMD_SERVER_REPLY.pack(code, len(out)) + out + err)
+
+    def serve(self, path):
+        """Answer clients on the Unix socket at path until told to quit, or none came for CMD_SERVER_IDLE_TIMEOUT."""
+        import socket
+
+        import utils
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(16)
+        server.settimeout(CMD_SERVER_IDLE_TIMEOUT)
+
+        utils.repo_open = self.repo_open
+        try:
+            while self.running:
+                try:
+                    conn, _ = server.accept()
+                except TimeoutError:
+                    break
+                try:
+                    self.handle(conn)
+                except OSError:
+                    pass
+        finally:
+            utils.repo_open = utils.VerizonRepository
+            server.close()
+            os.unlink(path)
+
+
+def cmd_server_socket(repo):
+    return os.path.join(repo.vrzdir, "cmd-server.sock")
+
+
+def cmd_server_start(repo):
+    """Start the command server of repo in the background, and wait until it answers."""
+    import subprocess
+
+    from utils import vrz_command
+
+    if cmd_server_request(cmd_server_socket(repo), ["ping"]) is not None:
+        raise Exception("The command server is already running")
+
+    subprocess.Popen(
+        vrz_command("cmd-server", "run"),
+        cwd=repo.worktree,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+    deadline = time.monotonic() + CMD_SERVER_TIMEOUT
+    while time.monotonic() < deadline:
+        if cmd_server_request(cmd_server_socket(repo), ["ping"]) is not None:
+            return
+        time.sleep(0.05)
+    raise Exception("The command server didn't start")
+
+
+def cmd_server_run(repo):
+    """Run the command server of repo in the foreground."""
+    path = cmd_server_socket(repo)
+    if os.path.exists(path):
+        if cmd_server_request(path, ["ping"]) is not None:
+            raise Exception("The command server is already running")
+        # Left by a server that died.
+        os.unlink(path)
+
+    CmdServer(repo).serve(path)
+
+
+def cmd_server_stop(repo):
+    """Stop the command server of repo. Return False when none was running."""
+    return cmd_server_request(cmd_server_socket(repo), ["quit"]) is not None
+
+
+def cmd_server_running(repo):
+    return cmd_server_request(cmd_server_socket(repo), ["ping"]) is not None
+
+
+def cmd_server_bench(repo, runs=CMD_SERVER_BENCH_RUNS):
+    """Print the time importing CMD_SERVER_BENCH_IMPORTS takes in a fresh interpreter, and that of CMD_SERVER_BENCH_COMMANDS run in repo by a process of their own, then through a command server, the best of runs each. Return whether the imports are within CMD_SERVER_IMPORT_BUDGET."""
+    import subprocess
+
+    from utils import vrz_command
+
+    if cmd_server_running(repo):
+        raise Exception(
+            "The command server is running, stop it to time commands without it"
+        )
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    mains = list()
+    totals = list()
+    for _ in range(runs):
+        proc = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                "import " + ", ".join(CMD_SERVER_BENCH_IMPORTS),
+            ],
+            cwd=here,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        # Lines of "import time: self | cumulative | name", in microseconds, after a header, the name indented by two spaces more for each level it was imported from. Only outermost imports count: one imported by another is part of its cumulative, and one already imported has no line.
+        main = total = 0
+        for line in proc.stderr.splitlines()[1:]:
+            _, cumulative, name = line.split("|")
+            if name.startswith("  ") or name.strip() not in CMD_SERVER_BENCH_IMPORTS:
+                continue
+            total += int(cumulative) / 1e6
+            if name.strip() == "main":
+                main = int(cumulative) / 1e6
+        mains.append(main)
+        totals.append(total)
+
+    total = min(totals)
+    print(
+        f"import main: {min(mains) * 1000:.1f}ms, what a command sent to the server loads"
+    )
+    print(
+        f"import {', '.join(CMD_SERVER_BENCH_IMPORTS)}: {total * 1000:.1f}ms, budget {CMD_SERVER_IMPORT_BUDGET * 1000:.0f}ms"
+    )
+
+    def timed(argv):
+        times = list()
+        for _ in range(runs):
+            start = time.perf_counter()
+            # A command failing would time nothing worth comparing.
+            subprocess.run(
+                vrz_command(*argv),
+                cwd=repo.worktree,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    cold = [timed(argv) for argv in CMD_SERVER_BENCH_COMMANDS]
+    cmd_server_start(repo)
+    try:
+        served = [timed(argv) for argv in CMD_SERVER_BENCH_COMMANDS]
+    finally:
+        cmd_server_stop(repo)
+
+    for argv, c, s in zip(CMD_SERVER_BENCH_COMMANDS, cold, served):
+        print(
+            f"{' '.join(argv)}: {c * 1000:.1f}ms alone, {s * 1000:.1f}ms through the server"
+        )
+
+    return total <= CMD_SERVER_IMPORT_BUDGET
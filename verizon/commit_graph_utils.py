@@ -0,0 +1,271 @@
+import hashlib
+import heapq
+import os
+import struct
+
+from classes import VerizonBloomFilter, VerizonCommitGraph
+from class_utils import object_read
+from other_utils import ref_list, ref_resolve, tree_diff
+from utils import repo_file
+
+# Commits touching more paths than this get a filter which always answers "maybe", instead of a huge one.
+BLOOM_MAX_CHANGED_PATHS = 512
+
+
+def commit_parents(commit):
+    parents = commit.kvlm.get(b"parent", list())
+    if not isinstance(parents, list):
+        parents = [parents]
+    return [p.decode("ascii") for p in parents]
+
+
+def commit_time(commit):
+    # The committer line ends with "<timestamp> <timezone>".
+    committer = commit.kvlm.get(b"committer", b"")
+    if isinstance(committer, list):
+        committer = committer[0]
+    fields = committer.split(b" ")
+
+    try:
+        return int(fields[-2])
+    except (IndexError, ValueError):
+        return 0
+
+
+def commit_graph_path(repo):
+    return repo_file(repo, "objects", "info", "commit-graph", mkdir=True)
+
+
+def commit_graph_read(repo):
+    """Return the repository's commit graph, or None if it hasn't been written."""
+    path = repo_file(repo, "objects", "info", "commit-graph")
+    if not path or not os.path.isfile(path):
+        return None
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+        raise Exception("Commit-graph checksum mismatch")
+
+    return VerizonCommitGraph(data)
+
+
+def ref_tips(repo, refs=None):
+    if refs is None:
+        refs = ref_list(repo)
+
+    ret = list()
+    for v in refs.values():
+        if isinstance(v, str):
+            ret.append(v)
+        elif v:
+            ret.extend(ref_tips(repo, v))
+    return ret
+
+
+def changed_paths(repo, old_tree, new_tree):
+    """Every path changed between the two trees, leading directories included, so a filter can answer queries for a directory too."""
+    ret = set()
+    for path, _, _ in tree_diff(repo, old_tree, new_tree):
+        while path and path not in ret:
+            ret.add(path)
+            path = os.path.dirname(path)
+    return ret
+
+
+def commit_graph_write(repo, tips=None):
+    """Write the commit graph of every commit reachable from tips (all refs and HEAD by default), with a changed-path Bloom filter per commit."""
+    if tips is None:
+        tips = ref_tips(repo)
+        head = ref_resolve(repo, "HEAD")
+        if head:
+            tips.append(head)
+
+    # Collect the commits, reading each object once.
+    commits = dict()
+    stack = list(tips)
+    while stack:
+        sha = stack.pop()
+        if sha in commits:
+            continue
+
+        # Tags point at commits through their `object` field.
+        obj = object_read(repo, sha)
+        while obj.fmt == b"tag":
+            sha = obj.kvlm[b"object"].decode("ascii")
+            obj = object_read(repo, sha)
+        if obj.fmt != b"commit" or sha in commits:
+            continue
+
+        parents = commit_parents(obj)
+        commits[sha] = (obj.kvlm[b"tree"].decode("ascii"), parents, commit_time(obj))
+        stack.extend(parents)
+
+    oids = sorted(commits.keys())
+    pos = {sha: i for i, sha in enumerate(oids)}
+
+    # Generation numbers: 1 for root commits, 1 + the largest parent generation otherwise.
+    generation = dict()
+    for sha in oids:
+        stack = [sha]
+        while stack:
+            cur = stack[-1]
+            if cur in generation:
+                stack.pop()
+                continue
+            pending = [p for p in commits[cur][1] if p not in generation]
+            if pending:
+                stack.extend(pending)
+                continue
+            generation[cur] = 1 + max(
+                (generation[p] for p in commits[cur][1]), default=0
+            )
+            stack.pop()
+
+    commit_rows = list()
+    edges = list()
+    blooms = list()
+
+    for sha in oids:
+        tree, parents, time = commits[sha]
+        p1 = pos[parents[0]] if parents else VerizonCommitGraph.parent_none
+
+        if len(parents) <= 1:
+            p2 = VerizonCommitGraph.parent_none
+        elif len(parents) == 2:
+            p2 = pos[parents[1]]
+        else:
+            p2 = VerizonCommitGraph.parent_extra | len(edges)
+            extra = [pos[p] for p in parents[1:]]
+            extra[-1] |= VerizonCommitGraph.parent_extra
+            edges.extend(extra)
+
+        commit_rows.append(
+            VerizonCommitGraph.commit_data.pack(
+                bytes.fromhex(tree), p1, p2, generation[sha], time
+            )
+        )
+
+        parent_tree = commits[parents[0]][0] if parents else None
+        paths = changed_paths(repo, parent_tree, tree)
+        if len(paths) > BLOOM_MAX_CHANGED_PATHS:
+            blooms.append(b"\xff")
+        else:
+            bloom = VerizonBloomFilter(count=len(paths))
+            for path in paths:
+                bloom.add(path.encode("utf8"))
+            blooms.append(bytes(bloom.data))
+
+    fanout = [0] * 256
+    for sha in oids:
+        fanout[int(sha[0:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    bloom_index = list()
+    end = 0
+    for bloom in blooms:
+        end += len(bloom)
+        bloom_index.append(end)
+
+    data = b"".join(
+        [
+            VerizonCommitGraph.header.pack(
+                b"VCGF", 1, VerizonBloomFilter.num_hashes, 0, len(oids), len(edges)
+            ),
+            struct.pack(">256I", *fanout),
+            b"".join(bytes.fromhex(sha) for sha in oids),
+            b"".join(commit_rows),
+            struct.pack(f">{len(edges)}I", *edges),
+            struct.pack(f">{len(bloom_index)}I", *bloom_index),
+            b"".join(blooms),
+        ]
+    )
+    data += hashlib.sha1(data).digest()
+
+    path = commit_graph_path(repo)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+    return len(oids)
+
+
+def commit_info(repo, graph, sha):
+    """Return (tree, parents, commit time) of a commit, from the graph when it's there."""
+    pos = graph.lookup(sha) if graph else None
+    if pos is not None:
+        tree, parents, _, time = graph.commit(pos)
+        return tree, [graph.oid(p) for p in parents], time
+
+    commit = object_read(repo, sha)
+    return (
+        commit.kvlm[b"tree"].decode("ascii"),
+        commit_parents(commit),
+        commit_time(commit),
+    )
+
+
+def commit_maybe_touches(graph, sha, pathspec):
+    """Ask the changed-path filter of sha. False means none of the pathspec changed against the first parent, without reading a single tree."""
+    pos = graph.lookup(sha) if graph else None
+    if pos is None or not pathspec:
+        return True
+
+    bloom = graph.bloom(pos)
+    for spec in pathspec:
+        if spec.rstrip("/").encode("utf8") in bloom:
+            return True
+    return False
+
+
+def log_path(repo, sha, pathspec):
+    """Yield the commits reachable from sha which change a path in pathspec, newest first.
+
+    A commit is skipped when it's identical to a parent for the pathspec, and for merges only that parent is followed, like git's default history simplification. An empty pathspec selects every path.
+    """
+    # An unborn branch has no history.
+    if sha is None:
+        return
+
+    graph = commit_graph_read(repo)
+
+    seen = set([sha])
+    tree, parents, time = commit_info(repo, graph, sha)
+    queue = [(-time, sha, tree, parents)]
+
+    while queue:
+        _, sha, tree, parents = heapq.heappop(queue)
+        infos = [commit_info(repo, graph, parent) for parent in parents]
+
+        follow = list(zip(parents, infos))
+        touched = True
+
+        for i, (parent, (parent_tree, _, _)) in enumerate(follow):
+            if i == 0 and not commit_maybe_touches(graph, sha, pathspec):
+                same = True
+            else:
+                same = (
+                    next(tree_diff(repo, parent_tree, tree, pathspec=pathspec), None)
+                    is None
+                )
+
+            if same:
+                follow = [follow[i]]
+                touched = False
+                break
+
+        if not parents:
+            touched = (
+                next(tree_diff(repo, None, tree, pathspec=pathspec), None) is not None
+            )
+
+        if touched:
+            yield sha
+
+        for parent, (parent_tree, parent_parents, parent_time) in follow:
+            if parent in seen:
+                continue
+            seen.add(parent)
+            heapq.heappush(queue, (-parent_time, parent, parent_tree, parent_parents))
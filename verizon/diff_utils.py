@@ -0,0 +1,482 @@
+import os
+import sys
+from bisect import bisect_left
+
+from classes import VerizonBlob, VerizonDiffPair
+from class_utils import index_entry_changed, object_read, object_write
+from other_utils import pathspec_match, tree_diff, tree_to_dict
+
+# Like git, content is binary if there's a NUL byte in its first block.
+BINARY_CHECK_BYTES = 8000
+
+# Histogram diff only anchors on lines occurring at most this many times in a region, beyond that it hands over to Myers.
+HISTOGRAM_MAX_CHAIN = 64
+
+# Myers gives up past this many edits and reports the whole region as replaced, instead of walking forever on unrelated content.
+MYERS_MAX_COST = 1024
+
+
+def is_binary(data):
+    return b"\x00" in data[:BINARY_CHECK_BYTES]
+
+
+def lines_intern(a, b):
+    """Replace every line of a and b with a small integer, equal lines getting the same one, so the diff compares ints instead of bytes."""
+    ids = dict()
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+    return a_ids, b_ids
+
+
+def myers_diff(a, alo, ahi, b, blo, bhi):
+    """Return the edits turning a[alo:ahi] into b[blo:bhi], from Myers' O(ND) algorithm."""
+    n = ahi - alo
+    m = bhi - blo
+    max_d = min(n + m, MYERS_MAX_COST)
+    offset = max_d + 1
+
+    v = [0] * (2 * max_d + 3)
+    trace = list()
+    end = None
+
+    for d in range(max_d + 1):
+        trace.append(v[offset - d - 1 : offset + d + 2])
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+
+            v[offset + k] = x
+            if x >= n and y >= m:
+                end = d
+                break
+
+        if end is not None:
+            break
+
+    if end is None:
+        return [(alo, ahi, blo, bhi)]
+
+    # Walk the trace back to collect the matching lines.
+    matches = list()
+    x, y = n, m
+    for d in range(end, 0, -1):
+        prev = trace[d]
+
+        def at(k):
+            return prev[k + d + 1]
+
+        k = x - y
+        if k == -d or (k != d and at(k - 1) < at(k + 1)):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+
+        prev_x = at(prev_k)
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            matches.append((x, y))
+
+        x, y = prev_x, prev_y
+
+    while x > 0 and y > 0:
+        x -= 1
+        y -= 1
+        matches.append((x, y))
+
+    edits = list()
+    ai, bi = 0, 0
+    for x, y in reversed(matches):
+        if x > ai or y > bi:
+            edits.append((alo + ai, alo + x, blo + bi, blo + y))
+        ai, bi = x + 1, y + 1
+
+    if ai < n or bi < m:
+        edits.append((alo + ai, ahi, blo + bi, bhi))
+
+    return edits
+
+
+def unique_anchors(a, alo, ahi, b, blo, bhi):
+    """Return the lines occurring exactly once in both regions which can all be matched in order, as (a index, b index) pairs. That's patience diff's first step: one pass splits a big region into many small ones."""
+    a_count = dict()
+    for i in range(alo, ahi):
+        a_count[a[i]] = i if a[i] not in a_count else -1
+
+    b_count = dict()
+    for j in range(blo, bhi):
+        if a_count.get(b[j], -1) >= 0:
+            b_count[b[j]] = j if b[j] not in b_count else -1
+
+    pairs = [(a_count[line], j) for line, j in b_count.items() if j >= 0]
+    if not pairs:
+        return pairs
+    pairs.sort()
+
+    # Longest increasing subsequence of the b indexes, in O(n log n).
+    tails = list()
+    tails_at = list()
+    back = [-1] * len(pairs)
+    for n, (_, j) in enumerate(pairs):
+        at = bisect_left(tails, j)
+        if at > 0:
+            back[n] = tails_at[at - 1]
+        if at == len(tails):
+            tails.append(j)
+            tails_at.append(n)
+        else:
+            tails[at] = j
+            tails_at[at] = n
+
+    ret = list()
+    n = tails_at[-1]
+    while n >= 0:
+        ret.append(pairs[n])
+        n = back[n]
+    ret.reverse()
+    return ret
+
+
+def histogram_anchor(a, alo, ahi, b, blo, bhi):
+    """Find the longest common run around the rarest line shared by both regions, as (a index, b index, length), or None."""
+    occurrences = dict()
+    for i in range(alo, ahi):
+        occurrences.setdefault(a[i], list()).append(i)
+
+    best = None
+    best_count = HISTOGRAM_MAX_CHAIN + 1
+    j = blo
+
+    while j < bhi:
+        positions = occurrences.get(b[j])
+        next_j = j + 1
+
+        if positions and len(positions) <= best_count:
+            for i in positions:
+                start_a, start_b = i, j
+                while (
+                    start_a > alo and start_b > blo and a[start_a - 1] == b[start_b - 1]
+                ):
+                    start_a -= 1
+                    start_b -= 1
+
+                end_a, end_b = i + 1, j + 1
+                while end_a < ahi and end_b < bhi and a[end_a] == b[end_b]:
+                    end_a += 1
+                    end_b += 1
+
+                length = end_a - start_a
+                if best is None or len(positions) < best_count or length > best[2]:
+                    best = (start_a, start_b, length)
+                    best_count = len(positions)
+
+                next_j = max(next_j, end_b)
+
+        j = next_j
+
+    return best
+
+
+def diff_edits(a, b):
+    """Return the edits turning the line ids a into b, as sorted (a start, a end, b start, b end) regions.
+
+    Regions are split on the lines unique to both sides first, then on the rarest common line like histogram diff does, and what can't be split is left to Myers.
+    """
+    edits = list()
+    stack = [(0, len(a), 0, len(b))]
+
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+
+        if alo == ahi or blo == bhi:
+            if alo < ahi or blo < bhi:
+                edits.append((alo, ahi, blo, bhi))
+            continue
+
+        anchors = unique_anchors(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            for ai, bi in reversed(anchors):
+                stack.append((ai + 1, ahi, bi + 1, bhi))
+                ahi, bhi = ai, bi
+            stack.append((alo, ahi, blo, bhi))
+            continue
+
+        anchor = histogram_anchor(a, alo, ahi, b, blo, bhi)
+        if anchor is None:
+            if set(a[alo:ahi]).isdisjoint(b[blo:bhi]):
+                edits.append((alo, ahi, blo, bhi))
+            else:
+                edits.extend(myers_diff(a, alo, ahi, b, blo, bhi))
+            continue
+
+        ai, bi, length = anchor
+        stack.append((ai + length, ahi, bi + length, bhi))
+        stack.append((alo, ai, blo, bi))
+
+    edits.sort()
+    return edits
+
+
+def diff_lines(a_data, b_data):
+    """Split both sides into lines and diff them. Return (a lines, b lines, edits)."""
+    a_lines = a_data.splitlines(keepends=True)
+    b_lines = b_data.splitlines(keepends=True)
+    a_ids, b_ids = lines_intern(a_lines, b_lines)
+    return a_lines, b_lines, diff_edits(a_ids, b_ids)
+
+
+def diff_hunks(edits, a_len, b_len, context=3):
+    """Group edits closer than twice the context into hunks, as lists of edits with the hunk's line ranges."""
+    hunk = list()
+    for edit in edits:
+        if hunk and edit[0] - hunk[-1][1] > 2 * context:
+            yield hunk_range(hunk, a_len, b_len, context), hunk
+            hunk = list()
+        hunk.append(edit)
+
+    if hunk:
+        yield hunk_range(hunk, a_len, b_len, context), hunk
+
+
+def hunk_range(hunk, a_len, b_len, context):
+    a_start = max(hunk[0][0] - context, 0)
+    b_start = max(hunk[0][2] - context, 0)
+    a_end = min(hunk[-1][1] + context, a_len)
+    b_end = min(hunk[-1][3] + context, b_len)
+    return a_start, a_end, b_start, b_end
+
+
+def hunk_header_range(start, length):
+    # An empty range names the line before it, like git and diff -u do.
+    if length == 0:
+        return f"{start},0"
+    if length == 1:
+        return f"{start + 1}"
+    return f"{start + 1},{length}"
+
+
+def diff_print_lines(out, prefix, lines):
+    for line in lines:
+        out.write(prefix + line)
+        if not line.endswith(b"\n"):
+            out.write(b"\n\\ No newline at end of file\n")
+
+
+def diff_print_unified(out, a_lines, b_lines, edits, context=3):
+    for (a_start, a_end, b_start, b_end), hunk in diff_hunks(
+        edits, len(a_lines), len(b_lines), context
+    ):
+        header = "@@ -{} +{} @@\n".format(
+            hunk_header_range(a_start, a_end - a_start),
+            hunk_header_range(b_start, b_end - b_start),
+        )
+        out.write(header.encode("ascii"))
+
+        ai = a_start
+        for e_a0, e_a1, e_b0, e_b1 in hunk:
+            diff_print_lines(out, b" ", a_lines[ai:e_a0])
+            diff_print_lines(out, b"-", a_lines[e_a0:e_a1])
+            diff_print_lines(out, b"+", b_lines[e_b0:e_b1])
+            ai = e_a1
+        diff_print_lines(out, b" ", a_lines[ai:a_end])
+
+
+def blob_data(repo, sha):
+    if not sha:
+        return b""
+    return object_read(repo, sha).blobdata
+
+
+def blob_sha(data):
+    return object_write(VerizonBlob(data))
+
+
+def diff_pairs_trees(repo, old_tree, new_tree, prefix="", pathspec=None):
+    """Yield the pairs between two trees. Equal subtrees are never read."""
+    for path, old, new in tree_diff(repo, old_tree, new_tree, prefix, pathspec):
+        yield VerizonDiffPair(path if old else None, path if new else None, old, new)
+
+
+def diff_pairs_cached(repo, index, pathspec=None, ref="HEAD"):
+    """Yield the pairs between a commit, HEAD by default, and the index."""
+    # Directories left out of a sparse checkout are compared as a whole, and only read if they differ.
+    sparse = set(e.name for e in index.entries if e.name.endswith("/"))
+
+    try:
+        head = tree_to_dict(repo, ref, sparse=sparse)
+    except Exception:
+        # No commit yet, everything in the index is new.
+        head = dict()
+
+    for entry in index.entries:
+        if not pathspec_match(pathspec, entry.name.rstrip("/"), partial=True):
+            continue
+
+        old = head.pop(entry.name, None)
+        if entry.name in sparse:
+            if old != entry.sha:
+                yield from diff_pairs_trees(
+                    repo, old, entry.sha, entry.name.rstrip("/"), pathspec
+                )
+        elif old != entry.sha:
+            yield VerizonDiffPair(
+                entry.name if old else None, entry.name, old, entry.sha
+            )
+
+    for path, old in sorted(head.items()):
+        if pathspec_match(pathspec, path):
+            yield VerizonDiffPair(path, None, old, None)
+
+
+def diff_pairs_worktree(repo, index, pathspec=None):
+    """Yield the pairs between the index and the worktree. Files whose stat matches the index aren't read at all."""
+    for entry in index.entries:
+        # Sparse directories have nothing in the worktree.
+        if entry.name.endswith("/") or not pathspec_match(pathspec, entry.name):
+            continue
+
+        full_path = os.path.join(repo.worktree, entry.name)
+        if not os.path.exists(full_path):
+            yield VerizonDiffPair(entry.name, None, entry.sha, None)
+            continue
+
+        if not index_entry_changed(entry, os.stat(full_path)):
+            continue
+
+        with open(full_path, "rb") as f:
+            data = f.read()
+
+        sha = blob_sha(data)
+        if sha != entry.sha:
+            yield VerizonDiffPair(entry.name, entry.name, entry.sha, sha, new_data=data)
+
+
+def pair_data(repo, pair):
+    """Return the old and new content of a pair."""
+    a_data = blob_data(repo, pair.old_sha)
+    if pair.new_data is not None:
+        return a_data, pair.new_data
+    return a_data, blob_data(repo, pair.new_sha)
+
+
+def diff_numstat(repo, pair):
+    """Return (added, deleted) line counts, or None for binary content. Counted from the edits alone, no hunk is built."""
+    if pair.old_sha == pair.new_sha:
+        return 0, 0
+
+    a_data, b_data = pair_data(repo, pair)
+    if is_binary(a_data) or is_binary(b_data):
+        return None
+
+    _, _, edits = diff_lines(a_data, b_data)
+    return (
+        sum(e[3] - e[2] for e in edits),
+        sum(e[1] - e[0] for e in edits),
+    )
+
+
+def pair_display_name(pair):
+    if pair.status in ("renamed", "copied"):
+        return f"{pair.old_path} => {pair.new_path}"
+    return pair.path
+
+
+def bar_width(count, scale):
+    # Any change shows up in the bar, however small.
+    if not count:
+        return 0
+    return max(1, int(count * scale + 0.5))
+
+
+def diff_print_stat(repo, pairs, out=None, width=50):
+    if out is None:
+        out = sys.stdout
+
+    rows = list()
+    for pair in pairs:
+        rows.append((pair_display_name(pair), diff_numstat(repo, pair)))
+
+    if not rows:
+        return
+
+    name_width = max(len(path) for path, _ in rows)
+    most = max((sum(n) for _, n in rows if n), default=0)
+    scale = min(1, width / most) if most else 1
+
+    added = deleted = 0
+    for path, numstat in rows:
+        if numstat is None:
+            out.write(f" {path.ljust(name_width)} | Bin\n")
+            continue
+
+        plus, minus = numstat
+        added += plus
+        deleted += minus
+        bar = "+" * bar_width(plus, scale) + "-" * bar_width(minus, scale)
+        out.write(f" {path.ljust(name_width)} | {plus + minus:>5} {bar}\n")
+
+    out.write(
+        f" {len(rows)} file{'s' if len(rows) != 1 else ''} changed, {added} insertions(+), {deleted} deletions(-)\n"
+    )
+
+
+def diff_print(repo, pairs, out=None, context=3):
+    if out is None:
+        out = sys.stdout.buffer
+
+    for pair in pairs:
+        old, new = pair.old_sha, pair.new_sha
+        old_path = pair.old_path or pair.new_path
+        new_path = pair.new_path or pair.old_path
+
+        a_name = f"a/{old_path}" if old else "/dev/null"
+        b_name = f"b/{new_path}" if new else "/dev/null"
+
+        out.write(f"diff --git a/{old_path} b/{new_path}\n".encode("utf8"))
+
+        if pair.status in ("renamed", "copied"):
+            verb = "rename" if pair.status == "renamed" else "copy"
+            out.write(
+                f"similarity index {int(pair.score * 100)}%\n{verb} from {old_path}\n{verb} to {new_path}\n".encode(
+                    "utf8"
+                )
+            )
+
+        # Same blob, same content. Nothing needs to be read.
+        if old == new:
+            continue
+
+        out.write(
+            f"index {(old or '0' * 40)[0:7]}..{(new or '0' * 40)[0:7]}\n".encode(
+                "ascii"
+            )
+        )
+
+        a_data, b_data = pair_data(repo, pair)
+
+        if is_binary(a_data) or is_binary(b_data):
+            out.write(f"Binary files {a_name} and {b_name} differ\n".encode("utf8"))
+            continue
+
+        a_lines, b_lines, edits = diff_lines(a_data, b_data)
+        if not edits:
+            continue
+
+        out.write(f"--- {a_name}\n+++ {b_name}\n".encode("utf8"))
+        diff_print_unified(out, a_lines, b_lines, edits, context)
@@ -0,0 +1,570 @@
+import collections
+import hashlib
+import os
+import struct
+import zlib
+
+from classes import VerizonTree, VerizonTreeLeaf
+from class_utils import (
+    object_exists,
+    object_find,
+    object_read_raw,
+    tree_parse,
+    tree_serialize,
+)
+from merge_base_utils import is_ancestor
+from other_utils import kvlm_parse, kvlm_serialize, ref_resolve, refs_update
+from pack_utils import object_hash_raw, pack_entry_header, pack_index_write
+from tree_paths_utils import TREE_MODE
+from utils import repo_dir
+
+# Objects are compressed into batches of about this many bytes, each appended to the pack with a single write.
+FAST_IMPORT_BATCH_SIZE = 16 * 1024 * 1024
+
+# Past this many objects, a pack is finished and another one started: the table of what a pack holds is kept in memory until then.
+FAST_IMPORT_MAX_PACK_OBJECTS = 1000000
+
+# Fast over small: repack compresses everything again, at zlib's default level.
+FAST_IMPORT_COMPRESSION = 1
+
+FAST_IMPORT_CHUNK_SIZE = 1024 * 1024
+
+
+class FastImportTree:
+    """A tree being built by fast-import. entries maps names to a FastImportTree for subtrees, or to (mode, binsha) for everything else, and is only read from sha once needed. sha is None while the tree has changes not written yet."""
+
+    __slots__ = ("sha", "entries")
+
+    def __init__(self, sha=None) -> None:
+        self.sha = sha
+        self.entries: dict[str, FastImportTree | tuple[bytes, bytes]] | None = (
+            None if sha else dict()
+        )
+
+
+class FastImportPack:
+    """The pack fast-import writes into. Objects are compressed into batches and appended to a temporary file, where they can be read back before the pack is finished."""
+
+    def __init__(self, repo, counts) -> None:
+        self.repo = repo
+        self.counts = counts
+        self.dir = repo_dir(repo, "objects", "pack", mkdir=True)
+        self.path = os.path.join(self.dir, f"tmp-{os.getpid()}-import.pack")
+
+        self.file = open(self.path, "w+b")
+        # The count is only known once the pack is finished.
+        self.file.write(b"PACK" + struct.pack(">II", 2, 0))
+        self.size = 12
+
+        self.batch: list[bytes] = list()
+        self.batch_size = 0
+        self.entries: dict[
+            str, tuple[bytes, int, int]
+        ] = dict()  # sha to (fmt, start, end) in the file.
+
+    def add(self, fmt, data):
+        """Add an object to the pack, unless the repository or the pack has it already. Return its sha."""
+        sha = object_hash_raw(fmt, data)
+        if sha in self.entries or object_exists(self.repo, sha, refresh=False):
+            return sha
+
+        entry = pack_entry_header(fmt, len(data)) + zlib.compress(
+            data, FAST_IMPORT_COMPRESSION
+        )
+        self.entries[sha] = (fmt, self.size, self.size + len(entry))
+        self.size += len(entry)
+        self.counts[fmt] += 1
+
+        self.batch.append(entry)
+        self.batch_size += len(entry)
+        if self.batch_size >= FAST_IMPORT_BATCH_SIZE:
+            self.flush()
+        return sha
+
+    def flush(self):
+        if self.batch:
+            self.file.write(b"".join(self.batch))
+            self.batch = list()
+            self.batch_size = 0
+        self.file.flush()
+
+    def read(self, sha):
+        """Return (fmt, data) of an object added to the pack, or None."""
+        entry = self.entries.get(sha)
+        if entry is None:
+            return None
+
+        fmt, start, end = entry
+        self.flush()
+        raw = os.pread(self.file.fileno(), end - start, start)
+
+        # Past the header, a varint.
+        at = 0
+        while raw[at] & 0x80:
+            at += 1
+        return fmt, zlib.decompress(raw[at + 1 :])
+
+    def finish(self):
+        """Write the count and the checksum of the pack, then its index, and move both in place. Return the number of objects in the pack."""
+        self.flush()
+        count = len(self.entries)
+        if not count:
+            self.abort()
+            return 0
+
+        self.file.seek(8)
+        self.file.write(struct.pack(">I", count))
+
+        # Read back for the checksum, which covers the count.
+        self.file.seek(0)
+        checksum = hashlib.sha1()
+        while True:
+            chunk = self.file.read(FAST_IMPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            checksum.update(chunk)
+        self.file.write(checksum.digest())
+        self.file.close()
+
+        checksum = checksum.hexdigest()
+        name = os.path.join(self.dir, f"pack-{checksum}")
+        pack_index_write(
+            name + ".idx.tmp",
+            [(sha, start) for sha, (_, start, _) in self.entries.items()],
+            checksum,
+        )
+        os.replace(self.path, name + ".pack")
+        os.replace(name + ".idx.tmp", name + ".idx")
+
+        # The next read has to see the new pack.
+        self.repo.packs = None
+        return count
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def fast_import_path(raw):
+    """Decode a path of the stream, C-style quoted or not."""
+    if raw.startswith(b'"'):
+        raw = raw[1:-1].decode("unicode_escape").encode("latin1")
+    return raw.decode("utf8")
+
+
+def fast_import_paths(raw):
+    """Split the source and destination paths of a copy or a rename."""
+    if not raw.startswith(b'"'):
+        src, dst = raw.split(b" ", 1)
+        return fast_import_path(src), fast_import_path(dst)
+
+    end = 1
+    while raw[end] != ord('"'):
+        end += 2 if raw[end] == ord("\\") else 1
+    return fast_import_path(raw[: end + 1]), fast_import_path(raw[end + 2 :])
+
+
+def fast_import_mode(raw):
+    mode = int(raw, 8)
+    # The short forms of fast-import.
+    if mode == 0o644 or mode == 0o755:
+        mode |= 0o100000
+    return mode
+
+
+class FastImport:
+    """Reads a git fast-import stream: blobs, commits, tags, resets, checkpoints and progress. Trees are kept in memory, changed as commits go, and only their changed parts written. Objects go straight into packs, and refs are updated once, at the end or at a checkpoint."""
+
+    def __init__(self, repo, stream, force=False) -> None:
+        self.repo = repo
+        self.stream = stream
+        self.force = force
+
+        self.counts: collections.Counter[bytes] = collections.Counter()
+        self.pack = FastImportPack(repo, self.counts)
+        self.marks: dict[int, str] = dict()
+        # The tip of every ref set by the stream, and the tree of every branch, as it's being changed.
+        self.refs: dict[str, str] = dict()
+        self.branches: dict[str, FastImportTree] = dict()
+        self.updated: set[str] = set()
+        self.refused: set[str] = set()
+        self.pushed = None
+
+    def line(self, required=False):
+        """The next command line, without its LF, or None at the end of the stream, unless required. Blank lines and comments are skipped."""
+        if self.pushed is not None:
+            line, self.pushed = self.pushed, None
+            return line
+
+        while True:
+            line = self.stream.readline()
+            if not line:
+                if required:
+                    raise Exception("Truncated stream")
+                return None
+            if line.endswith(b"\n"):
+                line = line[:-1]
+            if line and not line.startswith(b"#"):
+                return line
+
+    def data(self, line):
+        """Read the data a data command holds, counted or delimited."""
+        if line is None or not line.startswith(b"data "):
+            raise Exception(f"Expected data, got {line!r}")
+
+        arg = line[5:]
+        if arg.startswith(b"<<"):
+            delimiter = arg[2:] + b"\n"
+            lines = list()
+            while True:
+                line = self.stream.readline()
+                if not line:
+                    raise Exception("Truncated data")
+                if line == delimiter:
+                    return b"".join(lines)
+                lines.append(line)
+
+        size = int(arg)
+        data = self.stream.read(size)
+        if len(data) != size:
+            raise Exception("Truncated data")
+        return data
+
+    def write(self, fmt, data):
+        sha = self.pack.add(fmt, data)
+        if len(self.pack.entries) >= FAST_IMPORT_MAX_PACK_OBJECTS:
+            self.pack.finish()
+            self.pack = FastImportPack(self.repo, self.counts)
+        return sha
+
+    def read_raw(self, sha):
+        raw = self.pack.read(sha) or object_read_raw(self.repo, sha)
+        if raw is None:
+            raise Exception(f"Missing object {sha}")
+        return raw
+
+    def object_ref(self, raw):
+        """The sha of a mark, :<n>, of a ref the stream has set, or of anything object_find resolves."""
+        name = raw.decode("utf8")
+        if name.startswith(":"):
+            sha = self.marks.get(int(name[1:]))
+            if sha is None:
+                raise Exception(f"Unknown mark {name}")
+            return sha
+
+        # refs/heads/<branch>^0, to carry on from a branch of the repository.
+        if name.endswith("^0"):
+            name = name[:-2]
+        if name in self.refs:
+            return self.refs[name]
+        return object_find(self.repo, name)
+
+    def mark(self, line):
+        """Record the mark of line, if it's one. Return the mark, or None."""
+        if not line.startswith(b"mark :"):
+            return None
+        return int(line[6:])
+
+    def tree_of(self, sha):
+        """A tree to change, starting from that of commit sha."""
+        fmt, data = self.read_raw(sha)
+        if fmt != b"commit":
+            raise Exception(f"{sha} is a {fmt.decode('ascii')}, not a commit")
+        return FastImportTree(kvlm_parse(data)[b"tree"].decode("ascii"))
+
+    def tree_entries(self, node):
+        if node.entries is None:
+            node.entries = dict()
+            for leaf in tree_parse(self.read_raw(node.sha)[1]):
+                mode = int(leaf.mode, 8)
+                if mode == TREE_MODE:
+                    node.entries[leaf.path] = FastImportTree(leaf.sha)
+                else:
+                    node.entries[leaf.path] = (b"%06o" % mode, leaf.binsha)
+        return node.entries
+
+    def tree_get(self, node, parts):
+        for name in parts[:-1]:
+            node = self.tree_entries(node).get(name)
+            if not isinstance(node, FastImportTree):
+                return None
+        return self.tree_entries(node).get(parts[-1])
+
+    def tree_set(self, node, parts, value):
+        for name in parts[:-1]:
+            entries = self.tree_entries(node)
+            node.sha = None
+            child = entries.get(name)
+            if not isinstance(child, FastImportTree):
+                child = entries[name] = FastImportTree()
+            node = child
+        self.tree_entries(node)[parts[-1]] = value
+        node.sha = None
+
+    def tree_delete(self, node, parts):
+        """Remove parts from node, and the directories it leaves empty. Return whether there was anything to remove."""
+        entries = self.tree_entries(node)
+        child = entries.get(parts[0])
+        if child is None:
+            return False
+
+        if len(parts) > 1:
+            if not isinstance(child, FastImportTree) or not self.tree_delete(
+                child, parts[1:]
+            ):
+                return False
+            if not child.entries:
+                del entries[parts[0]]
+        else:
+            del entries[parts[0]]
+        node.sha = None
+        return True
+
+    def tree_write(self, node):
+        """Write the trees changed below node, and node. Return its sha."""
+        if node.sha is not None:
+            return node.sha
+
+        tree = VerizonTree()
+        for name, entry in node.entries.items():
+            if isinstance(entry, FastImportTree):
+                sha = entry.sha if entry.sha is not None else self.tree_write(entry)
+                leaf = VerizonTreeLeaf(b"040000", name, sha)
+            else:
+                leaf = VerizonTreeLeaf(entry[0], name, binsha=entry[1])
+            tree.items.append(leaf)
+
+        node.sha = self.write(b"tree", tree_serialize(tree))
+        return node.sha
+
+    def file_change(self, root, line):
+        """Apply a file command of a commit to root. Return the new root, or None when line isn't a file command."""
+        if line.startswith(b"M "):
+            mode, ref, path = line[2:].split(b" ", 2)
+            mode = fast_import_mode(mode)
+            if ref == b"inline":
+                sha = self.write(b"blob", self.data(self.line()))
+            else:
+                sha = self.object_ref(ref)
+
+            if mode == TREE_MODE:
+                value = FastImportTree(sha)
+            else:
+                value = (b"%06o" % mode, bytes.fromhex(sha))
+            self.tree_set(root, fast_import_path(path).split("/"), value)
+
+        elif line.startswith(b"D "):
+            self.tree_delete(root, fast_import_path(line[2:]).split("/"))
+
+        elif line.startswith(b"C ") or line.startswith(b"R "):
+            src, dst = fast_import_paths(line[2:])
+            value = self.tree_get(root, src.split("/"))
+            if value is None:
+                raise Exception(f"Path {src} not in branch")
+            if line.startswith(b"R "):
+                self.tree_delete(root, src.split("/"))
+            elif isinstance(value, FastImportTree):
+                # Copies never share a tree which is changed later.
+                value = FastImportTree(self.tree_write(value))
+            self.tree_set(root, dst.split("/"), value)
+
+        elif line == b"deleteall":
+            root = FastImportTree()
+
+        else:
+            return None
+        return root
+
+    def commit(self, ref):
+        line = self.line(required=True)
+        mark = self.mark(line)
+        if mark is not None:
+            line = self.line(required=True)
+        if line.startswith(b"original-oid "):
+            line = self.line(required=True)
+
+        author = None
+        if line.startswith(b"author "):
+            author = line[7:]
+            line = self.line(required=True)
+        if not line.startswith(b"committer "):
+            raise Exception(f"Expected committer, got {line!r}")
+        committer = line[10:]
+        line = self.line(required=True)
+
+        encoding = None
+        if line.startswith(b"encoding "):
+            encoding = line[9:]
+            line = self.line(required=True)
+        message = self.data(line)
+        line = self.line()
+
+        parents = list()
+        root = self.branches.get(ref)
+        if line is not None and line.startswith(b"from "):
+            sha = self.object_ref(line[5:])
+            # Carrying on from the tip of the branch keeps the tree as it is in memory.
+            if root is None or sha != self.refs.get(ref):
+                root = self.tree_of(sha)
+            parents.append(sha)
+            line = self.line()
+        elif self.refs.get(ref):
+            parents.append(self.refs[ref])
+        if root is None:
+            root = FastImportTree()
+
+        while line is not None and line.startswith(b"merge "):
+            parents.append(self.object_ref(line[6:]))
+            line = self.line()
+
+        while line is not None:
+            changed = self.file_change(root, line)
+            if changed is None:
+                self.pushed = line
+                break
+            root = changed
+            line = self.line()
+
+        kvlm = dict()
+        kvlm[b"tree"] = self.tree_write(root).encode("ascii")
+        if len(parents) == 1:
+            kvlm[b"parent"] = parents[0].encode("ascii")
+        elif parents:
+            kvlm[b"parent"] = [p.encode("ascii") for p in parents]
+        kvlm[b"author"] = author or committer
+        kvlm[b"committer"] = committer
+        if encoding:
+            kvlm[b"encoding"] = encoding
+        # kvlm_serialize ends the message with a LF of its own.
+        kvlm[None] = message[:-1] if message.endswith(b"\n") else message
+
+        sha = self.write(b"commit", kvlm_serialize(kvlm))
+        self.refs[ref] = sha
+        self.branches[ref] = root
+        if mark is not None:
+            self.marks[mark] = sha
+
+    def tag(self, name):
+        line = self.line(required=True)
+        mark = self.mark(line)
+        if mark is not None:
+            line = self.line(required=True)
+        if not line.startswith(b"from "):
+            raise Exception(f"Expected from, got {line!r}")
+        target = self.object_ref(line[5:])
+        line = self.line(required=True)
+        if line.startswith(b"original-oid "):
+            line = self.line(required=True)
+
+        tagger = None
+        if line.startswith(b"tagger "):
+            tagger = line[7:]
+            line = self.line(required=True)
+        message = self.data(line)
+
+        kvlm = dict()
+        kvlm[b"object"] = target.encode("ascii")
+        kvlm[b"type"] = self.read_raw(target)[0]
+        kvlm[b"tag"] = name.encode("utf8")
+        if tagger:
+            kvlm[b"tagger"] = tagger
+        kvlm[None] = message[:-1] if message.endswith(b"\n") else message
+
+        sha = self.write(b"tag", kvlm_serialize(kvlm))
+        self.refs["refs/tags/" + name] = sha
+        if mark is not None:
+            self.marks[mark] = sha
+
+    def reset(self, ref):
+        line = self.line()
+        if line is not None and line.startswith(b"from "):
+            sha = self.object_ref(line[5:])
+            self.refs[ref] = sha
+            self.branches[ref] = self.tree_of(sha)
+        else:
+            # The next commit on the branch starts it anew.
+            self.pushed = line
+            self.refs.pop(ref, None)
+            self.branches.pop(ref, None)
+
+    def blob(self):
+        line = self.line(required=True)
+        mark = self.mark(line)
+        if mark is not None:
+            line = self.line(required=True)
+        if line.startswith(b"original-oid "):
+            line = self.line(required=True)
+
+        sha = self.write(b"blob", self.data(line))
+        if mark is not None:
+            self.marks[mark] = sha
+
+    def checkpoint(self):
+        """Finish the pack and update the refs, for everything read so far to be in the repository."""
+        self.pack.finish()
+        self.pack = FastImportPack(self.repo, self.counts)
+        self.refs_write()
+
+    def refs_write(self):
+        """Move the refs set by the stream, all at once. Those which would lose commits are left alone, unless forced."""
+        updates = list()
+        for ref, sha in self.refs.items():
+            old = ref_resolve(self.repo, ref)
+            if old == sha:
+                continue
+            if old is not None and not self.force:
+                if not (
+                    ref.startswith("refs/heads/") and is_ancestor(self.repo, old, sha)
+                ):
+                    self.refused.add(ref)
+                    continue
+            updates.append((ref, old, sha))
+
+        if updates:
+            refs_update(self.repo, updates)
+            self.updated.update(ref for ref, _, _ in updates)
+
+    def run(self):
+        try:
+            while True:
+                line = self.line()
+                if line is None or line == b"done":
+                    break
+
+                if line == b"blob":
+                    self.blob()
+                elif line.startswith(b"commit "):
+                    self.commit(fast_import_ref(line[7:]))
+                elif line.startswith(b"tag "):
+                    self.tag(line[4:].decode("utf8"))
+                elif line.startswith(b"reset "):
+                    self.reset(fast_import_ref(line[6:]))
+                elif line == b"checkpoint":
+                    self.checkpoint()
+                elif line.startswith(b"progress "):
+                    print(line.decode("utf8"), flush=True)
+                elif line.startswith(b"feature ") or line.startswith(b"option "):
+                    # Nothing to set up for the features this reads.
+                    pass
+                else:
+                    raise Exception(f"Unsupported command {line!r}")
+
+            self.pack.finish()
+            self.refs_write()
+        finally:
+            self.pack.abort()
+
+
+def fast_import_ref(raw):
+    ref = raw.decode("utf8")
+    if not ref.startswith("refs/"):
+        raise Exception(f"Not a full ref name: {ref}")
+    return ref
+
+
+def fast_import(repo, stream, force=False):
+    """Import the git fast-import stream read from stream, a binary file, into repo. Return (counts, updated, refused): the number of objects written by type, the refs moved, and those left alone because moving them would lose commits."""
+    importer = FastImport(repo, stream, force)
+    importer.run()
+    return importer.counts, sorted(importer.updated), sorted(importer.refused)
@@ -0,0 +1,267 @@
+import hashlib
+import itertools
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from classes import VerizonRepository
+from class_utils import (
+    index_names,
+    index_read,
+    loose_object_stream,
+    object_build,
+    object_read_stream,
+    object_set_scan,
+    object_stores,
+    pack_data,
+    pack_entry_stream,
+    packs_load,
+)
+from commit_graph_utils import commit_parents, ref_tips
+from other_utils import ref_resolve
+
+# Below this many objects, starting worker processes costs more than it saves.
+FSCK_PARALLEL_MIN_OBJECTS = 256
+
+# Objects per task: few enough to spread the work, enough for each task to be worth sending.
+FSCK_BATCH_SIZE = 512
+
+# Tasks sent ahead per worker: the pool never waits, and the tasks not yet sent are never all in memory.
+FSCK_TASKS_AHEAD = 4
+
+FSCK_CHUNK_SIZE = 1024 * 1024
+
+SHA_RE = re.compile(rb"[0-9a-f]{40}")
+
+TREE_MODES = {0o100644, 0o100755, 0o100664, 0o120000, 0o040000, 0o160000}
+
+# The settings, set in every worker process by fsck_init.
+fsck_repo = None
+fsck_packs = None
+fsck_connectivity_only = False
+
+
+def fsck_init(worktree, connectivity_only):
+    global fsck_repo, fsck_packs, fsck_connectivity_only
+    fsck_repo = VerizonRepository(worktree)
+    fsck_packs = {pack.pack_path: pack for pack in packs_load(fsck_repo)}
+    fsck_connectivity_only = connectivity_only
+
+
+def fsck_locations(repo):
+    """Yield (sha, path, offset) of every copy of every object: the loose ones by file, offset being None, then those of each pack, in pack order so that it's read front to back."""
+    for store in object_stores(repo):
+        for sha in sorted(object_set_scan(store)):
+            yield sha, os.path.join(store, sha[0:2], sha[2:]), None
+
+    for pack in packs_load(repo):
+        for offset, sha in sorted(
+            (pack.offset(pos), pack.sha(pos)) for pos in range(pack.count)
+        ):
+            yield sha, pack.pack_path, offset
+
+
+def fsck_links(sha, fmt, data):
+    """Check the structure of a commit, tag or tree. Return (errors, links): links being (sha, fmt) of the objects it refers to, fmt being the type it expects them to have."""
+    errors = list()
+    links = list()
+    obj = object_build(sha, fmt, data)
+
+    if fmt == b"tree":
+        names = set()
+        for leaf in obj.items:
+            mode = int(leaf.mode, 8)
+            if mode not in TREE_MODES:
+                errors.append(
+                    f"bad mode {leaf.mode.decode('ascii').strip()} for {leaf.path}"
+                )
+            if not leaf.path or "/" in leaf.path or leaf.path in (".", "..", ".vrz"):
+                errors.append(f"bad name {leaf.path!r}")
+            if leaf.path in names:
+                errors.append(f"duplicate entry {leaf.path}")
+            names.add(leaf.path)
+
+            if mode == 0o040000:
+                links.append((leaf.sha, b"tree"))
+            # Submodule commits live in another repository.
+            elif mode != 0o160000:
+                links.append((leaf.sha, b"blob"))
+        return errors, links
+
+    if fmt == b"commit":
+        required = (b"tree", b"author", b"committer")
+    else:
+        required = (b"object", b"type", b"tag")
+    for key in required:
+        if key not in obj.kvlm:
+            errors.append(f"missing {key.decode('ascii')} line")
+        elif isinstance(obj.kvlm[key], list):
+            errors.append(f"more than one {key.decode('ascii')} line")
+    if errors:
+        return errors, links
+
+    if fmt == b"commit":
+        targets = [(obj.kvlm[b"tree"], b"tree")]
+        targets.extend((p.encode("ascii"), b"commit") for p in commit_parents(obj))
+    else:
+        targets = [(obj.kvlm[b"object"], obj.kvlm[b"type"])]
+
+    for target, target_fmt in targets:
+        if not SHA_RE.fullmatch(target):
+            errors.append(f"bad sha {target!r}")
+        else:
+            links.append((target.decode("ascii"), target_fmt))
+    return errors, links
+
+
+def fsck_object(location):
+    """Verify one copy of an object. Return (sha, fmt, errors, links), fmt being None when it can't even be read."""
+    sha, path, offset = location
+    try:
+        if offset is None:
+            try:
+                fmt, size, chunks = loose_object_stream(path, sha, FSCK_CHUNK_SIZE)
+            except FileNotFoundError:
+                # Packed and deleted since it was listed: the copy read is the one it's now in.
+                found = object_read_stream(fsck_repo, sha, FSCK_CHUNK_SIZE)
+                if found is None:
+                    raise
+                fmt, size, chunks = found
+        else:
+            fmt, size, chunks = pack_entry_stream(
+                pack_data(fsck_packs[path]), offset, FSCK_CHUNK_SIZE
+            )
+
+        # Blobs refer to nothing: checking connectivity only, their type is all that's needed.
+        if fmt == b"blob" and fsck_connectivity_only:
+            return sha, fmt, list(), list()
+
+        digest = hashlib.sha1(fmt + b" " + str(size).encode("ascii") + b"\x00")
+        data = None if fmt == b"blob" else list()
+        for chunk in chunks:
+            digest.update(chunk)
+            if data is not None:
+                data.append(bytes(chunk))
+
+        errors = list()
+        if digest.hexdigest() != sha:
+            errors.append(f"hash mismatch, the content hashes to {digest.hexdigest()}")
+        if data is None:
+            return sha, fmt, errors, list()
+
+        try:
+            found, links = fsck_links(sha, fmt, b"".join(data))
+        except Exception as e:
+            found, links = [f"malformed: {e!r}"], list()
+        return sha, fmt, errors + found, links
+
+    except Exception as e:
+        where = path if offset is None else f"{path} at {offset}"
+        return sha, None, [f"unreadable in {where}: {e!r}"], list()
+
+
+def fsck_batch(batch):
+    return [fsck_object(location) for location in batch]
+
+
+def fsck_results(repo, connectivity_only, jobs):
+    """Yield the results of fsck_object for every copy of every object, as they come in from a pool of worker processes."""
+    settings = (repo.worktree, connectivity_only)
+    locations = fsck_locations(repo)
+    first = list(itertools.islice(locations, FSCK_PARALLEL_MIN_OBJECTS))
+
+    if len(first) < FSCK_PARALLEL_MIN_OBJECTS or jobs == 1:
+        fsck_init(*settings)
+        for location in itertools.chain(first, locations):
+            yield fsck_object(location)
+        return
+
+    locations = itertools.chain(first, locations)
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=fsck_init, initargs=settings
+    ) as pool:
+        ahead = FSCK_TASKS_AHEAD * (jobs or os.cpu_count() or 1)
+        pending = set()
+        while True:
+            while len(pending) < ahead:
+                batch = list(itertools.islice(locations, FSCK_BATCH_SIZE))
+                if not batch:
+                    break
+                pending.add(pool.submit(fsck_batch, batch))
+            if not pending:
+                return
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+
+
+def fsck_roots(repo):
+    """The shas everything has to be reachable from: the refs, HEAD and the index."""
+    roots = [(sha, None) for sha in ref_tips(repo)]
+
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        roots.append((head, b"commit"))
+
+    index = index_read(repo)
+    for i, name in enumerate(index_names(index)):
+        # A directory out of the sparse checkout is a tree.
+        roots.append((index.entries[i].sha, b"tree" if name.endswith("/") else b"blob"))
+    return roots
+
+
+def fsck(repo, connectivity_only=False, jobs=None):
+    """Verify every object of repo: re-hash it, check its structure and that what it refers to is there, with the type expected. Yield (kind, sha, message) for each problem, errors as they're found, then, once everything has been read, what's missing and what's dangling, kind being "error", "missing" or "dangling".
+
+    With connectivity_only, blobs aren't read past their header."""
+    found = dict()  # sha to fmt, of every object read.
+    links = dict()  # sha to the links of every commit, tag and tree.
+    reported = set()  # unreadable or missing, reported once.
+
+    for sha, fmt, errors, object_links in fsck_results(repo, connectivity_only, jobs):
+        for message in errors:
+            yield "error", sha, f"{(fmt or b'object').decode('ascii')} {sha}: {message}"
+        if fmt is None:
+            reported.add(sha)
+            continue
+        found[sha] = fmt
+        if object_links:
+            links[sha] = object_links
+
+    # Missing and dangling objects are only known with all of them read.
+    referenced = set()
+    for sha, object_links in links.items():
+        for target, target_fmt in object_links:
+            referenced.add(target)
+            fmt = found.get(target)
+            if fmt is None:
+                if target in reported:
+                    continue
+                reported.add(target)
+                yield "missing", target, f"missing {target_fmt.decode('ascii')} {target}, from {found[sha].decode('ascii')} {sha}"
+            elif fmt != target_fmt:
+                yield "error", sha, f"{found[sha].decode('ascii')} {sha}: {target} is a {fmt.decode('ascii')}, not a {target_fmt.decode('ascii')}"
+
+    reachable = set()
+    stack = list()
+    for sha, fmt in fsck_roots(repo):
+        if sha not in found:
+            if sha in reported:
+                continue
+            reported.add(sha)
+            yield "missing", sha, f"missing {(fmt or b'object').decode('ascii')} {sha}, from the refs or the index"
+        elif sha not in reachable:
+            reachable.add(sha)
+            stack.append(sha)
+
+    while stack:
+        for target, _ in links.get(stack.pop(), ()):
+            if target in found and target not in reachable:
+                reachable.add(target)
+                stack.append(target)
+
+    # Only the tips of what's unreachable, like git: the rest is reachable from them.
+    for sha, fmt in sorted(found.items()):
+        if sha not in reachable and sha not in referenced:
+            yield "dangling", sha, f"dangling {fmt.decode('ascii')} {sha}"
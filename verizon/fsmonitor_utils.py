@@ -0,0 +1,437 @@
+import os
+import struct
+import time
+
+from class_utils import (
+    index_entry_changed,
+    index_entry_restat,
+    index_names,
+    index_write,
+)
+from lock_utils import LockFile
+from sparse_utils import sparse_includes, sparse_read
+from utils import repo_file, vrz_command
+from worktree_utils import worktree_walk
+
+# From <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+FSMONITOR_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+
+# wd, mask, cookie and the length of the name following.
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# Past this many changed paths the journal is dropped, and clients asking about older tokens scan everything.
+FSMONITOR_MAX_JOURNAL = 100000
+
+FSMONITOR_TIMEOUT = 5
+
+
+class FsmonitorDaemon:
+    """Watch every directory of a worktree with inotify, and keep the paths changed since the daemon started, each with the number of the last event which touched it. A token is the daemon's id and an event number: what changed since a token is every path touched after that event."""
+
+    def __init__(self, repo) -> None:
+        import ctypes
+        import ctypes.util
+        import uuid
+
+        self.worktree = repo.worktree
+        self.vrzdir = repo.vrzdir
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.id = uuid.uuid4().hex[:16]
+        self.seq = 0
+        self.floor = 0  # tokens before this event are too old to answer.
+        self.journal: dict[
+            str, int
+        ] = dict()  # path to the number of the last event on it.
+        self.watches: dict[
+            int, str
+        ] = dict()  # watch descriptor to directory, relative to the worktree.
+        self.running = True
+
+        self.watch_tree("")
+
+    def token(self):
+        return f"{self.id}:{self.seq}"
+
+    def changed(self, path):
+        self.seq += 1
+        self.journal[path] = self.seq
+        if len(self.journal) > FSMONITOR_MAX_JOURNAL:
+            self.reset()
+
+    def reset(self):
+        """Forget what changed: every token given so far now asks for a full scan."""
+        self.journal.clear()
+        self.seq += 1
+        self.floor = self.seq
+
+    def watch_tree(self, path, record=False):
+        """Watch path and every directory below it. With record, the files found are counted as changed, they may have been written before the watch was set."""
+        import ctypes
+        import errno
+
+        for root, dirs, files in os.walk(os.path.join(self.worktree, path)):
+            if root == self.vrzdir:
+                dirs[:] = list()
+                continue
+
+            rel_root = os.path.relpath(root, self.worktree)
+            rel_root = "" if rel_root == "." else rel_root
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), FSMONITOR_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    raise Exception(
+                        "Too many directories to watch, raise fs.inotify.max_user_watches"
+                    )
+                # Already gone, its deletion is in the queue.
+                continue
+            self.watches[wd] = rel_root
+
+            if record:
+                for f in files:
+                    self.changed(os.path.join(rel_root, f))
+
+    def read_events(self):
+        """Journal every event queued. Called before answering a client: a change made before it asked is queued by then."""
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+
+            at = 0
+            while at < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, at)
+                at += INOTIFY_EVENT.size
+                name = os.fsdecode(data[at : at + length].rstrip(b"\x00"))
+                at += length
+
+                if mask & IN_Q_OVERFLOW:
+                    self.reset()
+                    continue
+
+                directory = self.watches.get(wd)
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if directory is None:
+                    continue
+
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    if directory == "":
+                        # The worktree itself is gone.
+                        self.running = False
+                    continue
+
+                path = os.path.join(directory, name) if directory else name
+                if path == ".vrz" or path.startswith(".vrz" + os.sep):
+                    continue
+
+                # A directory moved away or deleted counts as a change of everything below it.
+                self.changed(path)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(path, record=True)
+
+    def since(self, token):
+        """The paths changed after token, or None when it's not a token of this daemon or too old."""
+        daemon_id, _, seq = token.partition(":")
+        if daemon_id != self.id or not seq.isdigit() or int(seq) < self.floor:
+            return None
+        seq = int(seq)
+        return sorted(path for path, last in self.journal.items() if last > seq)
+
+    def handle(self, conn):
+        conn.settimeout(FSMONITOR_TIMEOUT)
+        with conn:
+            request = b""
+            while not request.endswith(b"\n"):
+                chunk = conn.recv(4096)
+                if not chunk:
+                    return
+                request += chunk
+
+            command, _, arg = request.decode("utf8").rstrip("\n").partition(" ")
+            self.read_events()
+
+            if command == "since":
+                paths = self.since(arg)
+                reply = [self.token().encode("utf8")]
+                if paths is None:
+                    reply.append(b"full")
+                else:
+                    reply.append(b"changes")
+                    reply += [p.encode("utf8") for p in paths]
+                conn.sendall(b"\x00".join(reply))
+            elif command == "quit":
+                self.running = False
+                conn.sendall(b"bye")
+
+    def serve(self, path):
+        """Answer clients on the Unix socket at path until told to quit, or the worktree is deleted."""
+        import selectors
+        import socket
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(16)
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.fd, selectors.EVENT_READ, "inotify")
+        selector.register(server, selectors.EVENT_READ, "client")
+        try:
+            while self.running:
+                for key, _ in selector.select():
+                    if key.data == "inotify":
+                        self.read_events()
+                    else:
+                        conn, _ = server.accept()
+                        try:
+                            self.handle(conn)
+                        except OSError:
+                            pass
+        finally:
+            selector.close()
+            server.close()
+            os.unlink(path)
+            os.close(self.fd)
+
+
+def fsmonitor_socket(repo):
+    return repo_file(repo, "fsmonitor.sock")
+
+
+def fsmonitor_request(repo, request):
+    """Send request to the daemon of repo. Return its reply, None when none is running."""
+    path = fsmonitor_socket(repo)
+    if not os.path.exists(path):
+        return None
+
+    import socket
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(FSMONITOR_TIMEOUT)
+    try:
+        client.connect(path)
+        client.sendall(request.encode("utf8") + b"\n")
+        reply = list()
+        while True:
+            chunk = client.recv(64 * 1024)
+            if not chunk:
+                break
+            reply.append(chunk)
+    except OSError:
+        # A socket left by a daemon that died, or one that hangs: scan like there's none.
+        return None
+    finally:
+        client.close()
+
+    return b"".join(reply)
+
+
+def fsmonitor_query(repo, index):
+    """Ask the daemon which paths may differ from what the last status found. Return (token, paths), paths being None when everything has to be scanned. None when no daemon is running.
+
+    index.fsmonitor is the (token, paths) recorded by the last status: every path not among them, nor changed since token, was then either tracked and unchanged, or neither tracked nor there.
+    """
+    state = index.fsmonitor
+    reply = fsmonitor_request(repo, "since " + (state[0] if state else ""))
+    if reply is None:
+        return None
+
+    token, kind, *paths = reply.decode("utf8").split("\x00")
+    if kind != "changes" or state is None:
+        return token, None
+    return token, set(paths).union(state[1])
+
+
+def fsmonitor_selects(paths, name):
+    """Check if name, or a directory holding it, is one of paths."""
+    while name:
+        if name in paths:
+            return True
+        name = os.path.dirname(name)
+    return False
+
+
+def worktree_scan(repo, index, paths=None, with_untracked=True):
+    """Compare the worktree to index by stat. Return (dirty, untracked): dirty being (position, entry, stat) in index order for the entries whose file changed, stat being None for those deleted, and untracked the files the index doesn't have, if asked for.
+
+    Only paths, as given by fsmonitor_query, are looked at, unless it's None and the whole worktree is walked.
+    """
+    names = index_names(index)
+    cone = sparse_read(repo)
+
+    if paths is None and with_untracked:
+        return worktree_scan_all(repo, index, names, cone)
+
+    dirty = list()
+    for i, name in enumerate(names):
+        # A sparse directory entry has nothing in the worktree to compare.
+        if name.endswith("/") or (
+            paths is not None and not fsmonitor_selects(paths, name)
+        ):
+            continue
+
+        entry = index.entries[i]
+        try:
+            stat = os.stat(os.path.join(repo.worktree, name))
+        except FileNotFoundError:
+            dirty.append((i, entry, None))
+            continue
+        if index_entry_changed(entry, stat):
+            dirty.append((i, entry, stat))
+
+    if not with_untracked:
+        return dirty, list()
+
+    tracked = set(names)
+    untracked = sorted(
+        p
+        for p in paths
+        if p not in tracked
+        and sparse_includes(cone, p)
+        and os.path.isfile(os.path.join(repo.worktree, p))
+    )
+    return dirty, untracked
+
+
+def worktree_scan_all(repo, index, names, cone):
+    """worktree_scan of the whole worktree. The walk comes in path order: merged with the names, sorted, one pass over the two finds the files changed, deleted and untracked."""
+    order = sorted(range(len(names)), key=names.__getitem__)
+
+    dirty = list()
+    untracked = list()
+    j = 0
+    for path, stat in worktree_walk(repo, cone, set(names)):
+        if stat is False:
+            untracked.append(path)
+            continue
+
+        # A tracked file: the names before it aren't in the worktree anymore.
+        while names[order[j]] != path:
+            deleted = order[j]
+            # A sparse directory entry has nothing in the worktree to compare.
+            if not names[deleted].endswith("/"):
+                dirty.append((deleted, index.entries[deleted], None))
+            j += 1
+
+        i = order[j]
+        j += 1
+        entry = index.entries[i]
+        if index_entry_changed(entry, stat):
+            dirty.append((i, entry, stat))
+
+    for deleted in order[j:]:
+        if not names[deleted].endswith("/"):
+            dirty.append((deleted, index.entries[deleted], None))
+
+    dirty.sort(key=lambda d: d[0])
+    return dirty, untracked
+
+
+def fsmonitor_save(repo, index, token, paths, refreshed):
+    """Record (token, paths) in the index for the next status, along with the entries refreshed, (position, stat) of those whose content was found unchanged. Unless the index is locked or has changed since it was read: it's only a cache."""
+    if index.checksum is None:
+        return
+    if (
+        not refreshed
+        and index.fsmonitor is not None
+        and set(index.fsmonitor[1]) == set(paths)
+    ):
+        return
+
+    try:
+        lock = LockFile(repo_file(repo, "index"), retries=0)
+    except Exception:
+        return
+
+    with lock:
+        with open(repo_file(repo, "index"), "rb") as f:
+            f.seek(-20, os.SEEK_END)
+            if f.read(20).hex() != index.checksum:
+                return
+
+        for i, stat in refreshed:
+            index.entries[i] = index_entry_restat(index.entries[i], stat)
+        index.fsmonitor = (token, sorted(paths))
+        index_write(repo, index, lock)
+
+
+def fsmonitor_start(repo):
+    """Start the daemon of repo in the background, and wait until it answers."""
+    import subprocess
+
+    if fsmonitor_request(repo, "since") is not None:
+        raise Exception("The fsmonitor daemon is already running")
+
+    proc = subprocess.Popen(
+        vrz_command("fsmonitor", "run"),
+        cwd=repo.worktree,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+    deadline = time.monotonic() + FSMONITOR_TIMEOUT
+    while time.monotonic() < deadline:
+        if fsmonitor_request(repo, "since") is not None:
+            return
+        if proc.poll() is not None:
+            raise Exception(
+                f"The fsmonitor daemon exited with status {proc.returncode}"
+            )
+        time.sleep(0.05)
+    raise Exception("The fsmonitor daemon didn't start")
+
+
+def fsmonitor_run(repo):
+    """Run the daemon of repo in the foreground."""
+    path = fsmonitor_socket(repo)
+    if os.path.exists(path):
+        if fsmonitor_request(repo, "since") is not None:
+            raise Exception("The fsmonitor daemon is already running")
+        # Left by a daemon that died.
+        os.unlink(path)
+
+    FsmonitorDaemon(repo).serve(path)
+
+
+def fsmonitor_stop(repo):
+    """Stop the daemon of repo. Return False when none was running."""
+    return fsmonitor_request(repo, "quit") is not None
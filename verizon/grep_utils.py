@@ -0,0 +1,214 @@
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+# sre_parse is re._parser since Python 3.11, the old name only left to warn. The stubs mypy reads know the old one only.
+try:
+    from re import _parser as sre_parse  # type: ignore[attr-defined]
+except ImportError:
+    import sre_parse
+
+from classes import VerizonRepository
+from class_utils import object_find, object_read, object_read_raw
+from diff_utils import index_entry_changed, is_binary
+from other_utils import pathspec_match
+
+# Below this many blobs to search, starting worker processes costs more than it saves.
+GREP_PARALLEL_MIN_BLOBS = 64
+
+# The search settings, set in every worker process by grep_init.
+grep_repo = None
+grep_regex = None
+grep_literal = None
+grep_max_count = None
+grep_files_only = False
+
+
+def regex_literal(pattern, flags=0):
+    """The longest run of plain characters every match of pattern contains, as bytes, or None. A blob without it can't match, and looking for it is a memchr instead of running the regex."""
+    try:
+        # The flags compiled in, inline ones like (?i) included.
+        if re.compile(pattern, flags).flags & re.IGNORECASE:
+            return None
+        parsed = sre_parse.parse(pattern, flags)
+    except re.error:
+        return None
+
+    best = list()
+    run = list()
+    for op, value in parsed:
+        if op == sre_parse.LITERAL:
+            run.append(value)
+            if len(run) > len(best):
+                best = list(run)
+        else:
+            # Alternations, repeats and classes can't be counted on.
+            run = list()
+
+    if not best:
+        return None
+    return "".join(map(chr, best)).encode("utf8")
+
+
+def grep_init(worktree, pattern, flags, max_count, files_only):
+    global grep_repo, grep_regex, grep_literal, grep_max_count, grep_files_only
+    grep_repo = VerizonRepository(worktree)
+    grep_regex = re.compile(pattern.encode("utf8"), flags | re.MULTILINE)
+    grep_literal = regex_literal(pattern, flags)
+    grep_max_count = max_count
+    grep_files_only = files_only
+
+
+def grep_data(data):
+    """Return (binary, [(line number, line)]) of the lines of data matching, stopping at the first one for files_only and at max_count."""
+    if grep_literal is not None and grep_literal not in data:
+        return False, list()
+
+    binary = is_binary(data)
+    limit = 1 if grep_files_only or binary else grep_max_count
+
+    ret = list()
+    pos = 0
+    lineno = 1
+    counted = 0
+
+    while limit is None or len(ret) < limit:
+        m = grep_regex.search(data, pos)
+        if m is None:
+            break
+
+        start = data.rfind(b"\n", 0, m.start()) + 1
+        end = data.find(b"\n", m.start())
+        if end == -1:
+            end = len(data)
+
+        # A match across lines only tells that its first line is worth a look.
+        if m.end() <= end or grep_regex.search(data, start, end):
+            lineno += data.count(b"\n", counted, start)
+            counted = start
+            ret.append((lineno, data[start:end]))
+
+        pos = end + 1
+        if pos > len(data):
+            break
+
+    return binary, ret
+
+
+def grep_task(task):
+    """Search one blob, by sha, or one worktree file, by path."""
+    kind, name = task
+    if kind == "file":
+        with open(name, "rb") as f:
+            data = f.read()
+    else:
+        data = object_read_raw(grep_repo, name)[1]
+    return grep_data(data)
+
+
+def grep_tree_blobs(repo, tree_sha, pathspec=None, prefix=""):
+    """Yield (path, sha) of every blob below tree_sha selected by pathspec, in path order, not reading the subtrees pathspec rules out."""
+    items = list()
+    for leaf in object_read(repo, tree_sha).items:
+        path = prefix + leaf.path
+        if leaf.mode.startswith(b"04"):
+            if pathspec_match(pathspec, path, partial=True):
+                items.append((path + "/", leaf.sha, True))
+        elif not leaf.mode.startswith(b"16") and pathspec_match(pathspec, path):
+            items.append((path, leaf.sha, False))
+
+    for path, sha, is_tree in sorted(items):
+        if is_tree:
+            yield from grep_tree_blobs(repo, sha, pathspec, path)
+        else:
+            yield path, sha
+
+
+def grep_sources(repo, index=None, ref=None, cached=False, pathspec=None):
+    """Return [(path, key, task)] in path order. Paths with the same content share a key and a task, so each blob is searched once."""
+    ret = list()
+
+    if ref is not None:
+        for path, sha in grep_tree_blobs(
+            repo, object_find(repo, ref, fmt=b"tree"), pathspec
+        ):
+            ret.append((path, sha, ("blob", sha)))
+        return ret
+
+    for entry in index.entries:
+        if entry.name.endswith("/"):
+            # A directory out of the sparse checkout, searched from its tree.
+            if pathspec_match(pathspec, entry.name.rstrip("/"), partial=True):
+                for path, sha in grep_tree_blobs(repo, entry.sha, pathspec, entry.name):
+                    ret.append((path, sha, ("blob", sha)))
+            continue
+
+        if not pathspec_match(pathspec, entry.name):
+            continue
+
+        if cached:
+            ret.append((entry.name, entry.sha, ("blob", entry.sha)))
+            continue
+
+        full_path = os.path.join(repo.worktree, entry.name)
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            continue
+
+        # An unchanged file is its blob, shared with any identical file. A changed one is searched on its own.
+        if index_entry_changed(entry, stat):
+            ret.append((entry.name, full_path, ("file", full_path)))
+        else:
+            ret.append((entry.name, entry.sha, ("file", full_path)))
+
+    ret.sort(key=lambda s: s[0])
+    return ret
+
+
+def grep(
+    repo,
+    pattern,
+    index=None,
+    ref=None,
+    cached=False,
+    pathspec=None,
+    ignore_case=False,
+    max_count=None,
+    files_only=False,
+    jobs=None,
+):
+    """Yield (path, binary, [(line number, line)]) for every file with a match, in path order, as the results come in from a pool of worker processes."""
+    flags = re.IGNORECASE if ignore_case else 0
+    settings = (repo.worktree, pattern, flags, max_count, files_only)
+
+    sources = grep_sources(repo, index, ref, cached, pathspec)
+
+    tasks = dict()
+    for _, key, task in sources:
+        tasks.setdefault(key, task)
+
+    if len(tasks) < GREP_PARALLEL_MIN_BLOBS or jobs == 1:
+        grep_init(*settings)
+        results = dict()
+        for path, key, _ in sources:
+            if key not in results:
+                results[key] = grep_task(tasks[key])
+            binary, matches = results[key]
+            if matches:
+                yield path, binary, matches
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=grep_init, initargs=settings
+    ) as pool:
+        # Submitted in path order, so the first results needed are the first computed.
+        futures = {key: pool.submit(grep_task, task) for key, task in tasks.items()}
+        try:
+            for path, key, _ in sources:
+                binary, matches = futures[key].result()
+                if matches:
+                    yield path, binary, matches
+        finally:
+            for future in futures.values():
+                future.cancel()
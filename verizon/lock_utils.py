@@ -0,0 +1,66 @@
+import os
+import random
+import time
+
+# A lock held by another process is waited for this many times, the wait doubling from LOCK_BACKOFF up to LOCK_BACKOFF_MAX seconds.
+LOCK_RETRIES = 12
+LOCK_BACKOFF = 0.005
+LOCK_BACKOFF_MAX = 0.5
+
+
+class LockFile:
+    """Hold path.lock while path is updated, as git does. The new content is written to the lock file, and committing renames it over path in one step: readers see the old content or the new one, never half of it, and a writer holding the lock can't lose another's update.
+
+    with LockFile(path) as lock:
+        lock.write(data)
+        lock.commit()
+
+    Leaving the block without committing releases the lock and leaves path as it was."""
+
+    def __init__(self, path, retries=LOCK_RETRIES) -> None:
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.fd = None
+
+        backoff = LOCK_BACKOFF
+        for attempt in range(retries + 1):
+            try:
+                self.fd = os.open(
+                    self.lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666
+                )
+                return
+            except FileExistsError:
+                if attempt == retries:
+                    break
+            # Jittered, so waiting processes don't all try again at once.
+            time.sleep(backoff * random.uniform(0.5, 1.5))
+            backoff = min(backoff * 2, LOCK_BACKOFF_MAX)
+
+        raise Exception(
+            f"Unable to lock {path}: {self.lock_path} exists, another process is updating it"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view) :]
+
+    def commit(self):
+        """Replace path with what was written, and release the lock."""
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.lock_path, self.path)
+
+    def release(self):
+        """Drop the lock without touching path, unless it's been committed already."""
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
+        os.unlink(self.lock_path)
@@ -0,0 +1,180 @@
+import heapq
+
+from classes import VerizonCommitTable
+from class_utils import object_read_raw
+from commit_graph_utils import commit_graph_read
+from utils import file_stamp, repo_path
+
+# Paint flags of a merge-base walk.
+PARENT1 = 1
+PARENT2 = 2
+STALE = 4
+RESULT = 8
+
+
+def commit_header_parse(raw):
+    """Return (parents, commit time) from the raw data of a commit. Only the header is looked at, the message is never decoded."""
+    end = raw.find(b"\n\n")
+    if end < 0:
+        end = len(raw)
+
+    parents = list()
+    time = 0
+    for line in raw[:end].split(b"\n"):
+        key, _, value = line.partition(b" ")
+        if key == b"parent":
+            parents.append(value.decode("ascii"))
+        elif key == b"committer":
+            try:
+                time = int(value.rsplit(b" ", 2)[1])
+            except (IndexError, ValueError):
+                time = 0
+
+    return parents, time
+
+
+def commit_table_load(repo):
+    """Build a commit table, seeded with the whole commit-graph when the repository has one."""
+    table = VerizonCommitTable()
+    graph = commit_graph_read(repo)
+
+    if graph:
+        for pos in range(graph.count):
+            _, parents, generation, time = graph.commit(pos)
+            table.append(graph.oid(pos), tuple(parents), generation, time)
+
+    return table
+
+
+def commit_table_cached(repo):
+    """The commit table of repo, built once for each commit-graph it has, then shared by every walk: commits never change, those read on top of the graph stay valid."""
+    stamp = file_stamp(repo_path(repo, "objects", "info", "commit-graph"))
+    found = repo.commit_table
+    if found is None or found[0] != stamp:
+        found = repo.commit_table = (stamp, commit_table_load(repo))
+    return found[1]
+
+
+def commit_table_index(repo, table, sha):
+    """Return the position of sha in the table, reading the commit if it isn't there yet."""
+    pos = table.pos.get(sha)
+    if pos is not None:
+        return pos
+
+    raw = object_read_raw(repo, sha)
+    if raw is None or raw[0] != b"commit":
+        raise Exception(f"Not a commit : {sha}")
+
+    parents, time = commit_header_parse(raw[1])
+    return table.append(sha, parents, VerizonCommitTable.generation_infinity, time)
+
+
+def commit_table_parents(repo, table, pos):
+    parents = table.parents[pos]
+    if parents and isinstance(parents[0], str):
+        parents = tuple(commit_table_index(repo, table, p) for p in parents)
+        table.parents[pos] = parents
+    return parents
+
+
+def paint_down_to_common(repo, table, one, twos):
+    """Paint everything reachable from one and from twos, walking in generation order, and return the positions reached from both sides. This is git's paint_down_to_common."""
+    flags = bytearray(len(table))
+
+    def push(queue, pos):
+        # Highest generation first, newest first among equals.
+        heapq.heappush(queue, (-table.generation[pos], -table.time[pos], pos))
+
+    queue = list()
+    flags[one] |= PARENT1
+    push(queue, one)
+    for two in twos:
+        flags[two] |= PARENT2
+        push(queue, two)
+
+    result = list()
+    while any(not flags[pos] & STALE for _, _, pos in queue):
+        _, _, pos = heapq.heappop(queue)
+
+        mark = flags[pos] & (PARENT1 | PARENT2 | STALE)
+        if mark == PARENT1 | PARENT2:
+            if not flags[pos] & RESULT:
+                flags[pos] |= RESULT
+                result.append(pos)
+            mark |= STALE
+
+        parents = commit_table_parents(repo, table, pos)
+        if len(flags) < len(table):
+            flags.extend(bytes(len(table) - len(flags)))
+
+        for parent in parents:
+            if flags[parent] & mark == mark:
+                continue
+            flags[parent] |= mark
+            push(queue, parent)
+
+    return [pos for pos in result if not flags[pos] & STALE]
+
+
+def remove_redundant(repo, table, candidates):
+    """Drop the candidates which are ancestors of another candidate."""
+    ret = list()
+    for i, pos in enumerate(candidates):
+        others = [other for j, other in enumerate(candidates) if j != i]
+        if not any(is_ancestor_pos(repo, table, pos, other) for other in others):
+            ret.append(pos)
+    return ret
+
+
+def is_ancestor_pos(repo, table, ancestor, pos):
+    """Walk back from pos, never below the generation of ancestor, which can't be reached from there."""
+    cutoff = table.generation[ancestor]
+    if cutoff == VerizonCommitTable.generation_infinity:
+        cutoff = 0
+
+    seen = set([pos])
+    stack = [pos]
+    while stack:
+        cur = stack.pop()
+        if cur == ancestor:
+            return True
+        for parent in commit_table_parents(repo, table, cur):
+            if parent not in seen and table.generation[parent] >= cutoff:
+                seen.add(parent)
+                stack.append(parent)
+
+    return False
+
+
+def merge_base(repo, one, twos, find_all=False, table=None):
+    """Return the best common ancestors of the commit one and the commits twos, as shas. Only the first is returned unless find_all is set."""
+    if table is None:
+        table = commit_table_cached(repo)
+
+    one = commit_table_index(repo, table, one)
+    twos = [commit_table_index(repo, table, two) for two in twos]
+
+    if one in twos:
+        return [table.oids[one]]
+
+    result = paint_down_to_common(repo, table, one, twos)
+    if len(result) > 1:
+        result = remove_redundant(repo, table, result)
+
+    result.sort(key=lambda pos: table.time[pos], reverse=True)
+    if not find_all:
+        result = result[:1]
+
+    return [table.oids[pos] for pos in result]
+
+
+def is_ancestor(repo, ancestor, sha, table=None):
+    if table is None:
+        table = commit_table_cached(repo)
+
+    return is_ancestor_pos(
+        repo,
+        table,
+        commit_table_index(repo, table, ancestor),
+        commit_table_index(repo, table, sha),
+    )
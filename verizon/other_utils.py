@@ -5,14 +5,16 @@ import sys
 from fnmatch import fnmatch
 
 from class_utils import (
+    index_names,
     index_read,
     index_write,
     object_find,
     object_hash,
     object_read,
+    object_read_stream,
     object_write,
 )
-from verizon.classes import (
+from classes import (
     VerizonCommit,
     VerizonIgnore,
     VerizonIndexEntry,
@@ -20,12 +22,25 @@ from verizon.classes import (
     VerizonTree,
     VerizonTreeLeaf,
 )
-from verizon.utils import repo_dir, repo_file
+from utils import repo_dir, repo_file
+from fsmonitor_utils import fsmonitor_query, worktree_scan
+from lock_utils import LockFile
+from tree_paths_utils import TREE_MODE, tree_paths, tree_paths_iter
+from sparse_utils import (
+    SPARSE_OUT,
+    sparse_dir_state,
+    sparse_excluded_dir,
+    sparse_includes,
+    sparse_read,
+    sparse_write,
+)
 
 
 def cat_file(repo, obj, fmt=None):
-    obj = object_read(repo, object_find(repo, obj, fmt=fmt))
-    sys.stdout.buffer.write(obj.serialize())
+    # Written as it's inflated, a big blob is never held whole.
+    _, _, chunks = object_read_stream(repo, object_find(repo, obj, fmt=fmt))
+    for chunk in chunks:
+        sys.stdout.buffer.write(chunk)
 
 
 # Key Value List with Message
@@ -78,7 +93,7 @@ def kvlm_serialize(kvlm):
             val = [val]
 
         for v in val:
-            ret += k + b" " + (v.replace(b"\n ")) + b"\n"
+            ret += k + b" " + (v.replace(b"\n", b"\n ")) + b"\n"
 
     ret += b"\n" + kvlm[None] + b"\n"
 
@@ -119,42 +134,53 @@ def log_graphviz(repo, sha, seen):
 
 def ls_tree(repo, ref, recursive=None, prefix=""):
     sha = object_find(repo, ref, fmt=b"tree")
-    obj = object_read(repo, sha)
 
-    for item in obj.items:
-        if len(item.mode) == 5:
-            type = item.mode[0:1]
-        else:
-            type = item.mode[0:2]
+    if recursive:
+        # Every path below the tree at once, from the cache of flattened trees.
+        items = (
+            (path, mode, sha)
+            for path, mode, sha in tree_paths_iter(tree_paths(repo, sha))
+            if mode != TREE_MODE
+        )
+    else:
+        items = (
+            (item.path, int(item.mode, 8), item.sha)
+            for item in object_read(repo, sha).items
+        )
 
-        match type:
-            case b"04":
+    for path, mode, sha in items:
+        match mode >> 12:
+            case 0o04:
                 type = "tree"
-            case b"10":
+            case 0o10:
                 type = "blob"  # a regular file
-            case b"12":
+            case 0o12:
                 type = "blob"  # a symlink
-            case b"16":
+            case 0o16:
                 type = "commit"
             case _:
-                raise Exception(f"Weird Tree Leaf Mode {item.mode}")
+                raise Exception(f"Weird Tree Leaf Mode {mode:o}")
 
-        if not (recursive and type == "tree"):  # that means that this is a leaf.
-            print(
-                f"{'0'*(6-len(item.mode)) + item.mode.decode('ascii')} {type} {item.sha}\t{os.path.join(prefix, item.path)}"
-            )
-        else:
-            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
+        print(f"{mode:06o} {type} {sha}\t{os.path.join(prefix, path)}")
 
 
-def tree_checkout(repo, tree, path):
+def tree_checkout(repo, tree, path, cone=None, prefix=""):
     for item in tree.items:
+        rel_path = os.path.join(prefix, item.path)
+
+        # Directories outside of a sparse checkout are never read.
+        if item.mode.startswith(b"04"):
+            if sparse_dir_state(cone, rel_path) == SPARSE_OUT:
+                continue
+        elif not sparse_includes(cone, rel_path):
+            continue
+
         obj = object_read(repo, item.sha)
         dest = os.path.join(path, item.path)
 
         if obj.fmt == b"tree":
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
+            tree_checkout(repo, obj, dest, cone, rel_path)
 
         elif obj.fmt == b"blob":
             # TODO: Support for symlinks. Mode 12*
@@ -183,6 +209,9 @@ def ref_list(repo, path=None):
     ret = collections.OrderedDict()
 
     for f in sorted(os.listdir(path)):
+        # A ref being updated, see refs_update.
+        if f.endswith(".lock"):
+            continue
         can = os.path.join(path, f)
 
         if os.path.isdir(can):
@@ -234,8 +263,40 @@ def tag_create(repo, name, ref, create_tag_object=False):
 
 
 def ref_create(repo, ref_name, sha):
-    with open(repo_file(repo, "refs/" + ref_name), "w") as fp:
-        fp.write(sha + "\n")
+    """Point refs/ref_name at sha, unless another process moves it meanwhile."""
+    ref = "refs/" + ref_name
+    refs_update(repo, [(ref, ref_resolve(repo, ref), sha)])
+
+
+def refs_update(repo, updates):
+    """Apply (ref, old, new) updates, ref being a full name like refs/heads/main, all of them or none.
+
+    Every ref is locked through a LockFile and checked to still be at old (None for a ref which must not exist yet) before any is touched. A new of None deletes the ref.
+    """
+    locks = list()
+    try:
+        for ref, old, new in updates:
+            path = repo_file(repo, *ref.split("/"), mkdir=True)
+            lock = LockFile(path)
+            locks.append(lock)
+
+            current = ref_resolve(repo, ref) if os.path.isfile(path) else None
+            if current != old:
+                raise Exception(f"Ref {ref} is at {current}, expected {old}")
+
+            if new is not None:
+                lock.write((new + "\n").encode("ascii"))
+
+        for lock, (_, _, new) in zip(locks, updates):
+            if new is None:
+                os.unlink(lock.path)
+                lock.release()
+            else:
+                lock.commit()
+
+    finally:
+        for lock in locks:
+            lock.release()
 
 
 def vrzignore_parse1(raw):
@@ -265,29 +326,35 @@ def vrzignore_parse(lines):
     return ret
 
 
-def vrzignore_read(repo):
-    ret = VerizonIgnore(absolute=list(), scoped=dict())
-
-    repo_file = os.path.join(repo.vrzdir, "info/exclude")
-    if os.path.exists(repo_file):
-        with open(repo_file, "r") as f:
-            ret.absolute.append(vrzignore_parse(f.readlines()))
-
-    # Global Configuration
+def vrzignore_files(repo):
+    """The ignore files outside the worktree: the repository's info/exclude, then the global one."""
     if "XDG_CONFIG_HOME" in os.environ:
         config_home = os.environ["XDG_CONFIG_HOME"]
     else:
         config_home = os.path.expanduser("~/.config")
-    global_file = os.path.join(config_home, "vrz/ignore")
 
-    if os.path.exists(global_file):
-        with open(global_file, "r") as f:
-            ret.absolute.append(vrzignore_parse(f.readlines()))
+    return [
+        os.path.join(repo.vrzdir, "info/exclude"),
+        os.path.join(config_home, "vrz/ignore"),
+    ]
 
-    index = index_read(repo)
 
-    for entry in index.entries:
-        if entry.name == ".vrzignore" or entry.name.endswith("/.vrzignore"):
+def vrzignore_read(repo, index=None):
+    """The ignore rules of repo. The .vrzignore files are found in index, read when not given."""
+    ret = VerizonIgnore(absolute=list(), scoped=dict())
+
+    for path in vrzignore_files(repo):
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                ret.absolute.append(vrzignore_parse(f.readlines()))
+
+    if index is None:
+        index = index_read(repo)
+
+    # Only the .vrzignore entries are decoded.
+    for i, name in enumerate(index_names(index)):
+        if name == ".vrzignore" or name.endswith("/.vrzignore"):
+            entry = index.entries[i]
             dir_name = os.path.dirname(entry.name)
             contents = object_read(repo, entry.sha)
             lines = contents.blobdata.decode("utf8").splitlines()
@@ -351,26 +418,78 @@ def branch_get_active(repo):
     return False
 
 
-def tree_to_dict(repo, ref, prefix=""):
+def tree_to_dict(repo, ref, prefix="", sparse=None):
+    """Flatten a tree to a dict of paths to blob shas. Subtrees named in sparse, with a trailing /, are kept as a single entry instead, like a sparse index does."""
     ret = dict()
     tree_sha = object_find(repo, ref, fmt=b"tree")
-    tree = object_read(repo, tree_sha)
-
-    for leaf in tree.items:
-        full_path = os.path.join(prefix, leaf.path)
 
-        is_subtree = leaf.mode.startswith(b"04")
+    skipped = None
+    for path, mode, sha in tree_paths_iter(tree_paths(repo, tree_sha)):
+        if skipped is not None and path.startswith(skipped):
+            continue
+        full_path = os.path.join(prefix, path)
 
-        if is_subtree:
-            ret.update(tree_to_dict(repo, leaf.sha, full_path))
-        else:
-            ret[full_path] = leaf.sha
+        if mode != TREE_MODE:
+            ret[full_path] = sha
+        elif sparse and full_path + "/" in sparse:
+            ret[full_path + "/"] = sha
+            skipped = path + "/"
 
     return ret
 
 
-def rm(repo, paths, delete=True, skip_missing=False):
-    index = index_read(repo)
+def pathspec_match(pathspec, path, partial=False):
+    """Check if path is selected by the pathspec. With partial, also accept directories that lead to a selected path, so a tree walk knows it has to descend."""
+    if not pathspec:
+        return True
+
+    for spec in pathspec:
+        spec = spec.rstrip("/")
+        if path == spec or path.startswith(spec + "/"):
+            return True
+        if partial and spec.startswith(path + "/"):
+            return True
+
+    return False
+
+
+def tree_diff(repo, old, new, prefix="", pathspec=None):
+    """Yield (path, old_sha, new_sha) for every blob that differs between the trees old and new, either of which can be None. Subtrees with the same sha are equal, so they are skipped without being read."""
+    if old == new:
+        return
+
+    old_items = dict()
+    new_items = dict()
+    if old:
+        old_items = {leaf.path: leaf for leaf in object_read(repo, old).items}
+    if new:
+        new_items = {leaf.path: leaf for leaf in object_read(repo, new).items}
+
+    for name in sorted(old_items.keys() | new_items.keys()):
+        full_path = os.path.join(prefix, name)
+        if not pathspec_match(pathspec, full_path, partial=True):
+            continue
+
+        a = old_items.get(name)
+        b = new_items.get(name)
+
+        if a and b and a.sha == b.sha and a.mode == b.mode:
+            continue
+
+        a_tree = a.sha if a and a.mode.startswith(b"04") else None
+        b_tree = b.sha if b and b.mode.startswith(b"04") else None
+        a_blob = a.sha if a and not a_tree else None
+        b_blob = b.sha if b and not b_tree else None
+
+        if a_tree or b_tree:
+            yield from tree_diff(repo, a_tree, b_tree, full_path, pathspec)
+
+        if (a_blob or b_blob) and pathspec_match(pathspec, full_path):
+            yield (full_path, a_blob, b_blob)
+
+
+def index_remove(repo, index, paths, skip_missing=False):
+    """Remove paths from index. Return the full paths of the files removed."""
     worktree = repo.worktree + os.sep
 
     abspaths = list()
@@ -381,32 +500,110 @@ def rm(repo, paths, delete=True, skip_missing=False):
         else:
             raise Exception(f"Cannot remove paths outside of the worktree: {paths}")
 
-    kept_entries = list()
+    removed = list()
     remove = list()
 
-    for e in index.entries:
+    for i, e in enumerate(index.entries):
         full_path = os.path.join(repo.worktree, e.name)
 
         if full_path in abspaths:
+            removed.append(i)
             remove.append(full_path)
             abspaths.remove(full_path)
-        else:
-            kept_entries.append(e)
     if len(abspaths) > 0 and not skip_missing:
         raise Exception(f"Cannot remove paths not in the index : {abspaths}")
 
-    if delete:
-        for path in remove:
-            os.unlink(path)
+    # Deleted in place, so the entries of a split index still tell which shared ones are left.
+    for i in reversed(removed):
+        del index.entries[i]
+
+    # A file left in the worktree is now untracked, without the fsmonitor daemon seeing any change.
+    if index.fsmonitor is not None:
+        token, monitored = index.fsmonitor
+        index.fsmonitor = (
+            token,
+            monitored + [os.path.relpath(p, repo.worktree) for p in remove],
+        )
+    return remove
 
-    index.entries = kept_entries
-    index_write(repo, index)
 
+def rm(repo, paths, delete=True, skip_missing=False):
+    with LockFile(repo_file(repo, "index")) as lock:
+        index = index_read(repo)
+        remove = index_remove(repo, index, paths, skip_missing)
+
+        if delete:
+            for path in remove:
+                os.unlink(path)
+
+        index_write(repo, index, lock)
+
+
+def pathspec_normalize(repo, paths):
+    """The pathspec of paths given relative to the current directory: relative to the worktree, and empty, which selects everything, when one of them is the worktree itself."""
+    pathspec = [
+        os.path.relpath(os.path.abspath(p), repo.worktree) for p in paths or list()
+    ]
+    for spec in pathspec:
+        if spec == ".." or spec.startswith(".." + os.sep):
+            raise Exception(f"Paths outside of the worktree: {paths}")
+    if "." in pathspec:
+        return list()
+    return pathspec
+
+
+def add_update(repo, paths=None):
+    """Stage the changes of the tracked files under paths, all of them by default: modified files are hashed again, deleted ones removed from the index. With the fsmonitor daemon running, only the files changed since the last status are looked at."""
+    pathspec = pathspec_normalize(repo, paths)
+
+    with LockFile(repo_file(repo, "index")) as lock:
+        index = index_read(repo)
+        found = fsmonitor_query(repo, index)
+        token, changed = found if found is not None else (None, None)
+        dirty, _ = worktree_scan(repo, index, changed, with_untracked=False)
+
+        deleted = list()
+        for i, entry, stat in dirty:
+            if not pathspec_match(pathspec, entry.name):
+                continue
+            if stat is None:
+                deleted.append(i)
+                continue
+
+            with open(os.path.join(repo.worktree, entry.name), "rb") as fd:
+                sha = object_hash(fd, b"blob", repo)
+            index.entries[i] = index_entry_from_stat(entry.name, sha, stat)
+
+        for i in reversed(deleted):
+            del index.entries[i]
+
+        # What the last status recorded still holds, plus what changed since.
+        if changed is not None:
+            index.fsmonitor = (token, sorted(changed))
+        index_write(repo, index, lock)
+
+
+def index_entry_from_stat(relpath, sha, stat):
+    return VerizonIndexEntry(
+        ctime=(int(stat.st_ctime), stat.st_ctime_ns % 10**9),
+        mtime=(int(stat.st_mtime), stat.st_mtime_ns % 10**9),
+        dev=stat.st_dev,
+        ino=stat.st_ino,
+        mode_type=0b1000,
+        mode_perms=0o644,
+        uid=stat.st_uid,
+        gid=stat.st_gid,
+        fsize=stat.st_size,
+        sha=sha,
+        flag_assume_valid=False,
+        flag_stage=False,
+        name=relpath,
+    )
 
-def add(repo, paths, delete=True, skip_missing=False):
-    rm(repo, paths, delete=False, skip_missing=True)
 
+def add(repo, paths, delete=True, skip_missing=False):
     worktree = repo.worktree + os.sep
+    cone = sparse_read(repo)
 
     clean_paths = list()
     for path in paths:
@@ -414,40 +611,22 @@ def add(repo, paths, delete=True, skip_missing=False):
         if not (abspath.startswith(worktree) and os.path.isfile(abspath)):
             raise Exception(f"Not a file, or outside the worktree: {paths}")
         relpath = os.path.relpath(abspath, repo.worktree)
+        if not sparse_includes(cone, relpath):
+            raise Exception(f"Path is outside of the sparse checkout: {relpath}")
         clean_paths.append((abspath, relpath))
 
-    index = index_read(repo)
-
-    for abspath, relpath in clean_paths:
-        with open(abspath, "rb") as fd:
-            sha = object_hash(fd, b"blob", repo)
-
-        stat = os.stat(abspath)
-
-        ctime_s = int(stat.st_ctime)
-        ctime_ns = stat.st_ctime_ns * 10**9
-        mtime_s = int(stat.st_mtime)
-        mtime_ns = stat.st_mtime_ns * 10**9
-
-        entry = VerizonIndexEntry(
-            ctime=(ctime_s, ctime_ns),
-            mtime=(mtime_s, mtime_ns),
-            dev=stat.st_dev,
-            ino=stat.st_ino,
-            mode_type=0b1000,
-            mode_perms=0o644,
-            uid=stat.st_uid,
-            gid=stat.st_gid,
-            fsize=stat.st_size,
-            sha=sha,
-            flag_assume_valid=False,
-            flag_stage=False,
-            name=relpath,
-        )
+    # The index is locked from read to write, an add running at the same time waits instead of losing this one.
+    with LockFile(repo_file(repo, "index")) as lock:
+        index = index_read(repo)
+        index_remove(repo, index, paths, skip_missing=True)
+
+        for abspath, relpath in clean_paths:
+            with open(abspath, "rb") as fd:
+                sha = object_hash(fd, b"blob", repo)
 
-        index.entries.append(entry)
+            index.entries.append(index_entry_from_stat(relpath, sha, os.stat(abspath)))
 
-    index_write(repo, index)
+        index_write(repo, index, lock)
 
 
 def vrzconfig_read():
@@ -472,7 +651,8 @@ def tree_from_index(repo, index):
     contents[""] = list()
 
     for entry in index.entries:
-        dirname = os.path.dirname(entry.name)
+        # Sparse directory entries end with a /.
+        dirname = os.path.dirname(entry.name.rstrip("/"))
         key = dirname
         while key != "":
             if key not in contents:
@@ -493,7 +673,9 @@ def tree_from_index(repo, index):
                     entry.mode_type, entry.mode_perms
                 ).encode("ascii")
                 leaf = VerizonTreeLeaf(
-                    mode=leaf_mode, path=os.path.basename(entry.name), sha=entry.sha
+                    mode=leaf_mode,
+                    path=os.path.basename(entry.name.rstrip("/")),
+                    binsha=entry.binsha,
                 )
 
             else:
@@ -537,3 +719,106 @@ def commit_create(repo, tree, parent, author, timestamp, message):
     commit.kvlm[None] = message.encode("utf8")
 
     return object_write(commit, repo)
+
+
+def sparse_dir_entry(path, sha):
+    """An index entry standing for a whole directory left out of a sparse checkout."""
+    return VerizonIndexEntry(
+        ctime=(0, 0),
+        mtime=(0, 0),
+        dev=0,
+        ino=0,
+        mode_type=0b0100,
+        mode_perms=0,
+        uid=0,
+        gid=0,
+        fsize=0,
+        sha=sha,
+        flag_assume_valid=False,
+        flag_stage=False,
+        name=path + "/",
+    )
+
+
+def sparse_checkout_apply(repo, cone):
+    """Make the worktree and the index follow a new sparse cone (None for a full checkout): files leaving the cone are deleted and their directories collapsed to one index entry, files entering it are written from HEAD."""
+    with LockFile(repo_file(repo, "index")) as lock:
+        index = index_read(repo)
+        head = ref_resolve(repo, "HEAD")
+
+        files = {e.name: e for e in index.entries if not e.name.endswith("/")}
+        old_dirs = {e.name for e in index.entries if e.name.endswith("/")}
+
+        if head:
+            head_files = tree_to_dict(repo, "HEAD", sparse=old_dirs)
+        else:
+            head_files = dict()
+
+        entries = list()
+        collapsed = set()
+
+        for name, entry in files.items():
+            if sparse_includes(cone, name):
+                entries.append(entry)
+                continue
+
+            # A directory is only collapsed if the index has nothing staged in it.
+            if head_files.get(name) != entry.sha:
+                raise Exception(
+                    f"Cannot leave {name} out of the sparse checkout, it has staged changes"
+                )
+
+            collapsed.add(sparse_excluded_dir(cone, name))
+            full_path = os.path.join(repo.worktree, name)
+            if os.path.exists(full_path):
+                os.unlink(full_path)
+                try:
+                    os.removedirs(os.path.dirname(full_path))
+                except OSError:
+                    # Not empty, untracked files are left alone.
+                    pass
+
+        # Directories whose entries change: they, or what leads to them, are all the walk below has to read.
+        touched = collapsed | {d.rstrip("/") for d in old_dirs}
+
+        def leads_to(path):
+            return any(d == path or d.startswith(path + "/") for d in touched)
+
+        def walk(tree_sha, prefix, expanding):
+            for leaf in object_read(repo, tree_sha).items:
+                rel_path = os.path.join(prefix, leaf.path)
+
+                if leaf.mode.startswith(b"04"):
+                    # Everything below a directory which was collapsed has to be re-entered in the index.
+                    inside = expanding or rel_path + "/" in old_dirs
+                    if not (inside or leads_to(rel_path)):
+                        continue
+
+                    if sparse_dir_state(cone, rel_path) == SPARSE_OUT:
+                        entries.append(sparse_dir_entry(rel_path, leaf.sha))
+                    else:
+                        walk(leaf.sha, rel_path, inside)
+
+                elif expanding and rel_path not in files:
+                    full_path = os.path.join(repo.worktree, rel_path)
+                    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                    with open(full_path, "wb") as f:
+                        f.write(object_read(repo, leaf.sha).blobdata)
+                    entries.append(
+                        index_entry_from_stat(rel_path, leaf.sha, os.stat(full_path))
+                    )
+
+        if head:
+            walk(object_find(repo, "HEAD", fmt=b"tree"), "", False)
+
+        if cone is None:
+            path = repo_file(repo, "info", "sparse-checkout")
+            if path and os.path.exists(path):
+                os.unlink(path)
+        else:
+            sparse_write(repo, cone)
+
+        entries.sort(key=lambda e: e.name)
+        index.entries = entries
+        index.fsmonitor = None
+        index_write(repo, index, lock)
@@ -0,0 +1,427 @@
+import hashlib
+import os
+import struct
+import zlib
+
+from classes import VerizonPackIndex
+from class_utils import (
+    PACK_TYPE_NUMBERS,
+    PACK_TYPES,
+    REPO_LOAD_LOCK,
+    object_exists,
+    object_read,
+    object_read_raw,
+    object_set_refresh,
+    object_set_write,
+    object_sets,
+    object_stores,
+    packs_load,
+)
+from bitmap_utils import (
+    bitmap_count,
+    bitmap_objects_missing,
+    bitmap_path,
+    bitmap_write,
+)
+from commit_graph_utils import commit_parents, ref_tips
+from other_utils import ref_resolve
+from utils import repo_dir
+
+
+def pack_entry_header(fmt, size):
+    """The header of a pack entry: the type and the size, as a little-endian varint, like git."""
+    c = (PACK_TYPE_NUMBERS[fmt] << 4) | (size & 0b1111)
+    size >>= 4
+
+    ret = bytearray()
+    while size:
+        ret.append(c | 0x80)
+        c = size & 0x7F
+        size >>= 7
+    ret.append(c)
+
+    return bytes(ret)
+
+
+def pack_write(repo, shas, out, entries=None):
+    """Stream the objects shas as a pack into out, one object at a time. Return the pack's checksum. (sha, offset, fmt) of every object is appended to entries, if given."""
+    checksum = hashlib.sha1()
+    offset = 0
+
+    def write(data):
+        nonlocal offset
+        checksum.update(data)
+        out.write(data)
+        offset += len(data)
+
+    write(b"PACK" + struct.pack(">II", 2, len(shas)))
+
+    for sha in shas:
+        fmt, data = object_read_raw(repo, sha)
+        if entries is not None:
+            entries.append((sha, offset, fmt))
+        write(pack_entry_header(fmt, len(data)))
+        write(zlib.compress(data))
+
+    out.write(checksum.digest())
+    return checksum.hexdigest()
+
+
+class PackStreamReader:
+    """Reads a pack from a stream which can't seek, like a pipe, keeping count of the offset and of the checksum."""
+
+    def __init__(self, stream, copy=None) -> None:
+        self.stream = stream
+        self.copy = copy
+        self.buffer = b""
+        self.offset = 0
+        self.checksum = hashlib.sha1()
+        # Whatever is there already, instead of waiting for a full chunk from a pipe whose writer waits for us.
+        self.stream_read = getattr(stream, "read1", stream.read)
+
+    def fill(self, n):
+        while len(self.buffer) < n:
+            chunk = self.stream_read(max(n - len(self.buffer), 65536))
+            if not chunk:
+                raise Exception("Truncated pack")
+            self.buffer += chunk
+
+    def consume(self, n):
+        data = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        self.offset += n
+        self.checksum.update(data)
+        if self.copy:
+            self.copy.write(data)
+        return data
+
+    def read(self, n):
+        self.fill(n)
+        return self.consume(n)
+
+    def inflate(self):
+        """Inflate the zlib stream the reader is on, leaving whatever follows it in the buffer."""
+        z = zlib.decompressobj()
+        data = list()
+        while True:
+            if not self.buffer:
+                self.fill(1)
+            chunk = self.buffer
+            data.append(z.decompress(chunk))
+            used = len(chunk) - len(z.unused_data)
+            self.consume(used)
+            if z.eof:
+                return b"".join(data)
+
+
+def pack_read(stream, copy=None):
+    """Yield (offset, fmt, data) for every object of the pack read from stream. Whatever is read is also written to copy, if given. The checksum is verified at the end."""
+    reader = PackStreamReader(stream, copy)
+
+    signature, version, count = struct.unpack(">4sII", reader.read(12))
+    if signature != b"PACK" or version != 2:
+        raise Exception("Not a pack")
+
+    for _ in range(count):
+        offset = reader.offset
+
+        c = reader.read(1)[0]
+        type_num = (c >> 4) & 0b111
+        size = c & 0b1111
+        shift = 4
+        while c & 0x80:
+            c = reader.read(1)[0]
+            size |= (c & 0x7F) << shift
+            shift += 7
+
+        if type_num not in PACK_TYPES:
+            raise Exception(f"Unsupported pack entry type {type_num}")
+
+        data = reader.inflate()
+        if len(data) != size:
+            raise Exception("Malformed pack entry: bad length")
+
+        yield offset, PACK_TYPES[type_num], data
+
+    expected = reader.checksum.digest()
+    reader.fill(20)
+    if reader.buffer[:20] != expected:
+        raise Exception("Pack checksum mismatch")
+    if copy:
+        copy.write(expected)
+
+
+def object_hash_raw(fmt, data):
+    return hashlib.sha1(
+        fmt + b" " + str(len(data)).encode() + b"\x00" + data
+    ).hexdigest()
+
+
+def pack_index_write(path, entries, pack_checksum):
+    """Write the index of a pack from its (sha, offset) entries."""
+    entries = sorted(entries)
+
+    fanout = [0] * 256
+    for sha, _ in entries:
+        fanout[int(sha[0:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    data = b"".join(
+        [
+            VerizonPackIndex.header.pack(b"VIDX", 1, len(entries)),
+            struct.pack(">256I", *fanout),
+            b"".join(bytes.fromhex(sha) for sha, _ in entries),
+            struct.pack(f">{len(entries)}Q", *(offset for _, offset in entries)),
+            bytes.fromhex(pack_checksum),
+        ]
+    )
+
+    with open(path + ".tmp", "wb") as f:
+        f.write(data + hashlib.sha1(data).digest())
+    os.replace(path + ".tmp", path)
+
+
+def pack_store(repo, stream):
+    """Read a pack from stream into the object store of repo, with its index. Return the shas it held."""
+    pack_dir = repo_dir(repo, "objects", "pack", mkdir=True)
+    tmp_path = os.path.join(pack_dir, f"tmp-{os.getpid()}.pack")
+
+    entries = list()
+    try:
+        with open(tmp_path, "wb") as f:
+            for offset, fmt, data in pack_read(stream, copy=f):
+                entries.append((object_hash_raw(fmt, data), offset))
+
+        with open(tmp_path, "rb") as f:
+            f.seek(-20, os.SEEK_END)
+            checksum = f.read(20).hex()
+
+        if not entries:
+            os.unlink(tmp_path)
+            return list()
+
+        # The index goes in first, a pack without its index would be invisible anyway.
+        name = os.path.join(pack_dir, f"pack-{checksum}")
+        pack_index_write(name + ".idx.tmp", entries, checksum)
+        os.replace(tmp_path, name + ".pack")
+        os.replace(name + ".idx.tmp", name + ".idx")
+
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+    # The next read has to see the new pack.
+    repo.packs = None
+
+    return [sha for sha, _ in entries]
+
+
+def commit_walk(repo, tips, stop=None):
+    """Yield the commits reachable from tips, without going past the ones in stop."""
+    if stop is None:
+        stop = set()
+
+    seen = set()
+    stack = [sha for sha in tips if sha not in stop]
+    while stack:
+        sha = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+
+        commit = object_read(repo, sha)
+        if commit is None:
+            raise Exception(f"Missing object {sha}")
+        yield sha, commit
+
+        for p in commit_parents(commit):
+            if p not in seen and p not in stop:
+                stack.append(p)
+
+
+def tree_walk_objects(repo, tree_sha, seen):
+    """Yield the shas of tree_sha and of everything below it not already in seen, adding them to seen."""
+    if tree_sha in seen:
+        return
+    seen.add(tree_sha)
+    yield tree_sha
+
+    tree = object_read(repo, tree_sha)
+    if tree is None:
+        raise Exception(f"Missing object {tree_sha}")
+
+    for leaf in tree.items:
+        if leaf.mode.startswith(b"04"):
+            yield from tree_walk_objects(repo, leaf.sha, seen)
+        elif leaf.mode.startswith(b"16"):
+            # Submodule commits live in another repository.
+            continue
+        elif leaf.sha not in seen:
+            seen.add(leaf.sha)
+            yield leaf.sha
+
+
+def objects_missing(repo, wants, haves):
+    """Return the shas of every object reachable from wants but not from haves, the objects haves lack.
+
+    With reachability bitmaps, it's two bitmaps and an AND NOT. Without, every commit reachable from haves is walked, but only the trees of the boundary commits, those the new commits build on, are, like git does. Haves this repository doesn't have are ignored.
+    """
+    haves = [sha for sha in haves if object_exists(repo, sha)]
+    ret = bitmap_objects_missing(repo, wants, haves)
+    if ret is not None:
+        return ret
+
+    ret = list()
+    seen = set()
+
+    # Annotated tags are sent along with what they point to.
+    commits = list()
+    for sha in wants:
+        obj = object_read(repo, sha)
+        while obj is not None and obj.fmt == b"tag":
+            if sha not in seen:
+                seen.add(sha)
+                ret.append(sha)
+            sha = obj.kvlm[b"object"].decode("ascii")
+            obj = object_read(repo, sha)
+        if obj is None:
+            raise Exception(f"Missing object {sha}")
+        commits.append(sha)
+
+    have_commits = set(sha for sha, _ in commit_walk(repo, haves))
+
+    new_commits = list(commit_walk(repo, commits, stop=have_commits))
+    boundary = set()
+    for _, commit in new_commits:
+        boundary.update(p for p in commit_parents(commit) if p in have_commits)
+
+    # Everything below the boundary trees is already there.
+    excluded = set()
+    for sha in boundary:
+        tree = object_read(repo, sha).kvlm[b"tree"].decode("ascii")
+        for _ in tree_walk_objects(repo, tree, excluded):
+            pass
+
+    seen |= excluded
+    for sha, commit in new_commits:
+        ret.append(sha)
+        ret.extend(tree_walk_objects(repo, commit.kvlm[b"tree"].decode("ascii"), seen))
+
+    return ret
+
+
+def repack(repo, delete=False, write_bitmap=False):
+    """Pack every object reachable from the refs and HEAD into a single new pack. With delete, the loose objects and the packs it makes redundant are removed. Return the number of objects packed."""
+    tips = ref_tips(repo)
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        tips.append(head)
+
+    shas = objects_missing(repo, tips, list())
+    if not shas:
+        return 0
+
+    pack_dir = repo_dir(repo, "objects", "pack", mkdir=True)
+    tmp_path = os.path.join(pack_dir, f"tmp-{os.getpid()}.pack")
+
+    entries = list()
+    try:
+        with open(tmp_path, "wb") as f:
+            checksum = pack_write(repo, shas, f, entries)
+
+        name = os.path.join(pack_dir, f"pack-{checksum}")
+        pack_index_write(
+            name + ".idx.tmp", [(sha, offset) for sha, offset, _ in entries], checksum
+        )
+        os.replace(tmp_path, name + ".pack")
+        os.replace(name + ".idx.tmp", name + ".idx")
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+    repo.packs = None
+    pack = next(p for p in packs_load(repo) if p.pack_path == name + ".pack")
+
+    if write_bitmap:
+        commits = list()
+        for sha in tips:
+            obj = object_read(repo, sha)
+            while obj.fmt == b"tag":
+                sha = obj.kvlm[b"object"].decode("ascii")
+                obj = object_read(repo, sha)
+            commits.append(sha)
+        bitmap_write(repo, pack, entries, commits)
+
+    if delete:
+        packed = set(shas)
+        own = object_stores(repo)[0]
+
+        for old in packs_load(repo):
+            if old is pack or not old.pack_path.startswith(own):
+                continue
+            if all(old.sha(i) in packed for i in range(old.count)):
+                # The index goes first, a pack without one is never read.
+                os.unlink(old.pack_path[: -len(".pack")] + ".idx")
+                os.unlink(old.pack_path)
+                if os.path.exists(bitmap_path(old)):
+                    os.unlink(bitmap_path(old))
+
+        objset = object_sets(repo)[own]
+        # What was logged since the set was read, this repack's own writes included, is either packed or kept: none of it is logged again for the new set.
+        with REPO_LOAD_LOCK:
+            object_set_refresh(own, objset)
+        kept = list()
+        for sha in objset.shas():
+            if sha in packed:
+                path = os.path.join(own, sha[0:2], sha[2:])
+                if os.path.exists(path):
+                    os.unlink(path)
+            else:
+                kept.append(sha)
+        object_set_write(own, kept, objset.log_size)
+
+        repo.packs = None
+        repo.object_sets = None
+
+    return len(shas)
+
+
+def objects_count(repo):
+    """Count the objects of the own store of repo, loose and packed, and their size on disk, like git count-objects."""
+    own = object_stores(repo)[0]
+    ret = {"count": 0, "size": 0, "in-pack": 0, "packs": 0, "size-pack": 0}
+
+    for sha in object_sets(repo)[own].shas():
+        try:
+            ret["size"] += os.stat(os.path.join(own, sha[0:2], sha[2:])).st_size
+            ret["count"] += 1
+        except FileNotFoundError:
+            pass
+
+    for pack in packs_load(repo):
+        if not pack.pack_path.startswith(own):
+            continue
+        ret["packs"] += 1
+        ret["in-pack"] += pack.count
+        ret["size-pack"] += os.path.getsize(pack.pack_path)
+        ret["size-pack"] += os.path.getsize(pack.pack_path[: -len(".pack")] + ".idx")
+
+    return ret
+
+
+def objects_count_reachable(repo):
+    """Count the objects reachable from the refs and HEAD by type, from the bitmaps when there are some."""
+    tips = ref_tips(repo)
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        tips.append(head)
+
+    ret = bitmap_count(repo, tips)
+    if ret is not None:
+        return ret
+
+    ret = {"commit": 0, "tree": 0, "blob": 0, "tag": 0}
+    for sha in objects_missing(repo, tips, list()):
+        ret[object_read_raw(repo, sha)[0].decode("ascii")] += 1
+    return ret
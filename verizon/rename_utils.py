@@ -0,0 +1,171 @@
+import heapq
+import zlib
+
+from classes import VerizonDiffPair
+from diff_utils import blob_data, is_binary
+
+# A sketch keeps the smallest hashes of a blob's lines. Comparing two sketches estimates how many lines the blobs share, without reading either blob again.
+SKETCH_SIZE = 64
+
+# Binary content has no lines, it's cut in chunks of this size instead.
+BINARY_CHUNK_SIZE = 64
+
+# Like git's -M, a pair is a rename from 50% of similarity on.
+RENAME_THRESHOLD = 0.5
+
+# A hash in the sketches of more than this share of the sources, and of more than RENAME_COMMON_MIN_SOURCES of them, is a line most files have: it doesn't make a source a candidate.
+RENAME_COMMON_PERCENT = 10
+RENAME_COMMON_MIN_SOURCES = 8
+
+
+def sketch_compute(data):
+    """Return (sketch, number of distinct hashes) for some content."""
+    if is_binary(data):
+        parts = (
+            data[i : i + BINARY_CHUNK_SIZE]
+            for i in range(0, len(data), BINARY_CHUNK_SIZE)
+        )
+    else:
+        # Blank lines are in most files: kept, their hashes would be in most sketches, the empty line's being the smallest there is.
+        parts = (line for line in data.splitlines() if line.strip())
+
+    hashes = set(map(zlib.crc32, parts))
+    return frozenset(heapq.nsmallest(SKETCH_SIZE, hashes)), len(hashes)
+
+
+def sketch_similarity(a, b):
+    """Estimate the Jaccard similarity of the contents behind two sketches. Only the smallest hashes of the union are looked at, that's a bottom-k estimate."""
+    a_sketch, a_count = a
+    b_sketch, b_count = b
+
+    if not a_count and not b_count:
+        return 1.0
+
+    union = heapq.nsmallest(SKETCH_SIZE, a_sketch | b_sketch)
+    both = sum(1 for h in union if h in a_sketch and h in b_sketch)
+    return both / len(union)
+
+
+def size_similar(a, b, threshold):
+    # Two contents can't share more than the smaller one, checked before anything else.
+    small, big = sorted((a[1], b[1]))
+    return big == 0 or small / big >= threshold
+
+
+def detect_renames(repo, pairs, copies=False, threshold=RENAME_THRESHOLD):
+    """Turn the deleted and added files of pairs into renames (and copies, when asked) and return the new list of pairs.
+
+    Files with the same sha are matched first, through a dict. Then each remaining file is sketched once, and an inverted index of the sketch hashes gives for every added file the deleted ones sharing any hash with it, so unrelated pairs are never compared. Hashes most sources share are left out of it, see RENAME_COMMON_PERCENT.
+    """
+    pairs = list(pairs)
+    deleted = [p for p in pairs if p.status == "deleted"]
+    added = [p for p in pairs if p.status == "added"]
+    if not added or not (deleted or copies):
+        return pairs
+
+    # Copies can come from modified files too, renames only from deleted ones.
+    sources = list(deleted)
+    if copies:
+        sources += [p for p in pairs if p.status == "modified"]
+
+    used = set()
+    found = dict()
+
+    # Exact renames.
+    by_sha = dict()
+    for i, source in enumerate(sources):
+        by_sha.setdefault(source.old_sha, list()).append(i)
+
+    remaining = list()
+    for target in added:
+        candidates = by_sha.get(target.new_sha, list())
+        pick = next(
+            (i for i in candidates if i not in used and sources[i].status == "deleted"),
+            None,
+        )
+        is_rename = pick is not None
+
+        if pick is None and copies and candidates:
+            pick = candidates[0]
+
+        if pick is None:
+            remaining.append(target)
+            continue
+
+        found[id(target)] = (sources[pick], 1.0, is_rename)
+        if is_rename:
+            used.add(pick)
+
+    # Inexact renames.
+    if remaining:
+        source_sketches = dict()
+        index = dict()
+        for i, source in enumerate(sources):
+            if i in used:
+                continue
+            source_sketches[i] = sketch_compute(blob_data(repo, source.old_sha))
+            for h in source_sketches[i][0]:
+                index.setdefault(h, list()).append(i)
+
+        common = max(
+            RENAME_COMMON_MIN_SOURCES,
+            len(source_sketches) * RENAME_COMMON_PERCENT // 100,
+        )
+        index = {
+            h: found_in for h, found_in in index.items() if len(found_in) <= common
+        }
+
+        scored = list()
+        for target in remaining:
+            if target.new_data is not None:
+                sketch = sketch_compute(target.new_data)
+            else:
+                sketch = sketch_compute(blob_data(repo, target.new_sha))
+            hits = set()
+            for h in sketch[0]:
+                hits.update(index.get(h, ()))
+
+            for i in hits:
+                if not size_similar(source_sketches[i], sketch, threshold):
+                    continue
+                # An estimate never reports different content as identical.
+                score = min(sketch_similarity(source_sketches[i], sketch), 0.99)
+                if score >= threshold:
+                    scored.append((score, i, id(target)))
+
+        # Best scores first, every file taking part at most once in a rename.
+        scored.sort(key=lambda s: -s[0])
+        for score, i, target in scored:
+            if target in found:
+                continue
+            is_rename = sources[i].status == "deleted" and i not in used
+            if not (is_rename or copies):
+                continue
+            found[target] = (sources[i], score, is_rename)
+            if is_rename:
+                used.add(i)
+
+    ret = list()
+    consumed = set(id(sources[i]) for i in used)
+    for pair in pairs:
+        if id(pair) in consumed:
+            continue
+
+        if id(pair) not in found:
+            ret.append(pair)
+            continue
+
+        source, score, is_rename = found[id(pair)]
+        ret.append(
+            VerizonDiffPair(
+                source.old_path,
+                pair.new_path,
+                source.old_sha,
+                pair.new_sha,
+                new_data=pair.new_data,
+                status="renamed" if is_rename else "copied",
+                score=score,
+            )
+        )
+
+    return ret
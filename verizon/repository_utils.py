@@ -0,0 +1,218 @@
+import configparser
+import heapq
+import os
+import re
+
+from classes import VerizonObjectCache, VerizonRepository
+from class_utils import (
+    index_names,
+    index_read,
+    object_build,
+    object_find,
+    object_read_raw,
+)
+from commit_graph_utils import commit_parents, commit_time
+from other_utils import check_ignore, pathspec_match, vrzignore_files, vrzignore_read
+from utils import file_stamp, repo_find, repo_path
+
+SHA_RE = re.compile(r"[0-9A-Fa-f]{40}")
+
+
+class VerizonCachedRepository(VerizonRepository):
+    """A repository for processes calling into Verizon many times. The index, refs, config and ignore rules are read once, then again only when their files change, and objects are read through a VerizonObjectCache. So are the packs and object sets, when the object store changes.
+
+    with VerizonCachedRepository(path) as repo:
+        for sha, commit in repo.walk_commits("HEAD"):
+            ...
+
+    The index and ignore rules are shared between callers: read an index of your own with index_read to change it. Every function taking a repo takes this one too.
+    """
+
+    def __init__(self, path=".", cache=None) -> None:
+        worktree = repo_find(path).worktree
+        config_stamp = file_stamp(os.path.join(worktree, ".vrz", "config"))
+        super().__init__(worktree)
+
+        self.cache = cache if cache is not None else VerizonObjectCache()
+        # Key to (stamps of the files it was read from, value), see cached.
+        self.stamps = {"config": ((config_stamp,), self.conf)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Drop everything read, the mapped index and packs included."""
+        self.stamps.clear()
+        self.packs = None
+        self.object_sets = None
+        self.tree_paths = None
+        self.commit_table = None
+
+    def cached(self, key, paths, load):
+        """The value load returned for key, read again when any of paths has changed since."""
+        # Stamped before loading: a change while loading is seen by the next call.
+        stamps = tuple(map(file_stamp, paths))
+        found = self.stamps.get(key)
+        if found is not None and found[0] == stamps:
+            return found[1]
+
+        value = load()
+        self.stamps[key] = (stamps, value)
+        return value
+
+    def config(self):
+        path = repo_path(self, "config")
+
+        def load():
+            conf = configparser.ConfigParser()
+            conf.read([path])
+            return conf
+
+        self.conf = self.cached("config", [path], load)
+        return self.conf
+
+    def objects(self):
+        """Drop the packs and object sets read, once the object store has changed since: a repack or a fetch, by this process or another. Called by the methods reading objects, functions called with this repository directly see the store as of the last of them."""
+
+        def load():
+            self.packs = None
+            self.object_sets = None
+
+        paths = [
+            repo_path(self, "objects", "pack"),
+            repo_path(self, "objects", "info", "object-set"),
+        ]
+        self.cached("objects", paths, load)
+
+    def index(self):
+        return self.cached(
+            "index", [repo_path(self, "index")], lambda: index_read(self)
+        )
+
+    def ignore(self):
+        paths = vrzignore_files(self) + [repo_path(self, "index")]
+        return self.cached("ignore", paths, lambda: vrzignore_read(self, self.index()))
+
+    def ignored(self, path):
+        """Check if path, relative to the worktree, is ignored."""
+        return check_ignore(self.ignore(), path)
+
+    def ref(self, ref):
+        """The sha ref points to, following symbolic refs, or None."""
+        path = repo_path(self, ref)
+
+        def load():
+            if not os.path.isfile(path):
+                return None
+            with open(path, "r") as f:
+                return f.read()[:-1]
+
+        data = self.cached(("ref", ref), [path], load)
+        if data is not None and data.startswith("ref: "):
+            return self.ref(data[5:])
+        return data
+
+    def refs(self, prefix="refs"):
+        """Yield (name, sha) of every ref below prefix, in name order."""
+        path = repo_path(self, prefix)
+        if not os.path.isdir(path):
+            return
+
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            # A ref being updated, see refs_update.
+            if entry.name.endswith(".lock"):
+                continue
+            name = prefix + "/" + entry.name
+            if entry.is_dir():
+                yield from self.refs(name)
+            else:
+                yield name, self.ref(name)
+
+    def read_raw(self, sha):
+        """Return (fmt, data) of an object, or None."""
+        raw = self.cache.get(sha)
+        if raw is None:
+            self.objects()
+            raw = object_read_raw(self, sha)
+            if raw is not None:
+                self.cache.put(sha, *raw)
+        return raw
+
+    def read(self, sha):
+        """Return the object sha, or None. Objects are built anew on every call, they're the caller's to change."""
+        raw = self.read_raw(sha)
+        if raw is None:
+            return None
+        return object_build(sha, *raw)
+
+    def resolve(self, name, fmt=None, follow=True):
+        """The sha of a name, like object_find. HEAD, full refs, branches, tags and full shas are resolved from the cache, anything else by object_find."""
+        if name == "HEAD" or name.startswith("refs/"):
+            sha = self.ref(name)
+        elif SHA_RE.fullmatch(name):
+            sha = name.lower()
+        else:
+            found = set([self.ref("refs/tags/" + name), self.ref("refs/heads/" + name)])
+            found.discard(None)
+            sha = found.pop() if len(found) == 1 else None
+
+        if sha is None:
+            self.objects()
+            return object_find(self, name, fmt, follow)
+
+        while fmt is not None:
+            obj = self.read(sha)
+            if obj is None:
+                raise Exception(f"Missing object {sha}")
+            if obj.fmt == fmt:
+                break
+            if not follow:
+                return None
+
+            if obj.fmt == b"tag":
+                sha = obj.kvlm[b"object"].decode("ascii")
+            elif obj.fmt == b"commit":
+                sha = obj.kvlm[b"tree"].decode("ascii")
+            else:
+                return None
+
+        return sha
+
+    def iter_index(self, pathspec=None):
+        """Yield the entries of the index selected by pathspec, decoding only those."""
+        index = self.index()
+        for i, name in enumerate(index_names(index)):
+            if pathspec_match(pathspec, name):
+                yield index.entries[i]
+
+    def walk_tree(self, name, pathspec=None, prefix=""):
+        """Yield (path, leaf) for every file below the tree of name, a tree-ish, selected by pathspec. Subtrees pathspec rules out aren't read."""
+        sha = self.resolve(name, fmt=b"tree") if prefix == "" else name
+
+        for leaf in self.read(sha).items:
+            path = prefix + leaf.path
+            if leaf.mode.startswith(b"04"):
+                if pathspec_match(pathspec, path, partial=True):
+                    yield from self.walk_tree(leaf.sha, pathspec, path + "/")
+            elif pathspec_match(pathspec, path):
+                yield path, leaf
+
+    def walk_commits(self, name):
+        """Yield (sha, commit) for every commit reachable from name, newest first."""
+        sha = self.resolve(name, fmt=b"commit")
+        commit = self.read(sha)
+
+        seen = set([sha])
+        queue = [(-commit_time(commit), sha, commit)]
+        while queue:
+            _, sha, commit = heapq.heappop(queue)
+            yield sha, commit
+
+            for parent in commit_parents(commit):
+                if parent not in seen:
+                    seen.add(parent)
+                    obj = self.read(parent)
+                    heapq.heappush(queue, (-commit_time(obj), parent, obj))
@@ -0,0 +1,449 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from classes import VerizonObjectCache, VerizonRepository
+from class_utils import object_exists, object_read_stream
+from clone_utils import refs_flatten
+from other_utils import ref_list, ref_resolve
+from pack_utils import objects_missing, pack_write
+from utils import file_stamp
+
+# Objects up to this size are kept in the shared cache once served, bigger ones are streamed every time.
+SERVER_CACHE_MAX_OBJECT_SIZE = 1024 * 1024
+
+SERVER_CHUNK_SIZE = 64 * 1024
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+SHA_RE = re.compile(r"^[0-9a-f]{40}$")
+
+# What a repository is opened again for when it changes: the packs and loose objects of its own store, and its alternates. Packs and object sets are read once per opening.
+SERVER_STAMPS = [
+    ("objects", "pack"),
+    ("objects", "info", "alternates"),
+    ("objects", "info", "object-set"),
+]
+
+
+class QueueWriter:
+    """A file-like object for a worker thread, handing what's written to the event loop by chunks. A full queue blocks the writer, so a slow client slows down the pack generation instead of filling memory. Once nothing reads the queue any more, cancel stops the writer."""
+
+    def __init__(self, queue, loop) -> None:
+        self.queue = queue
+        self.loop = loop
+        self.buffer: list[bytes] = list()
+        self.buffered = 0
+        self.cancelled = False
+        self.pending = None  # the put the writer waits on.
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        with self.lock:
+            if self.cancelled:
+                raise ConnectionAbortedError("The pack is no longer read")
+            self.pending = asyncio.run_coroutine_threadsafe(
+                self.queue.put(item), self.loop
+            )
+        try:
+            self.pending.result()
+        except CancelledError:
+            raise ConnectionAbortedError("The pack is no longer read")
+
+    def cancel(self):
+        """Make the put waiting, and every one after it, raise ConnectionAbortedError. Called from the event loop."""
+        with self.lock:
+            self.cancelled = True
+            if self.pending is not None:
+                self.pending.cancel()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= SERVER_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.put(b"".join(self.buffer))
+            self.buffer = list()
+            self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.put(None)
+
+
+async def http_request_read(reader):
+    """Read a request's line and headers. Return (method, target, headers), None at the end of the connection."""
+    line = await reader.readline()
+    if not line:
+        return None
+
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise Exception("Malformed request line")
+
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    return method, target, headers
+
+
+def http_head(status, headers):
+    head = [f"HTTP/1.1 {status} {HTTP_REASONS[status]}"]
+    head += [f"{k}: {v}" for k, v in headers.items()]
+    return ("\r\n".join(head) + "\r\n\r\n").encode("latin-1")
+
+
+async def http_respond(writer, status, body, content_type="text/plain"):
+    writer.write(
+        http_head(
+            status, {"Content-Type": content_type, "Content-Length": str(len(body))}
+        )
+        + body
+    )
+    await writer.drain()
+
+
+def server_refs(repo):
+    lines = list()
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        lines.append(f"{head} HEAD\n")
+    for name, sha in refs_flatten(ref_list(repo)).items():
+        if sha:
+            lines.append(f"{sha} refs/{name}\n")
+    return "".join(lines).encode("utf8")
+
+
+async def server_object(writer, repo, sha, cache, pool):
+    """Send an object's content, from the cache or inflated chunk by chunk in the pool."""
+    loop = asyncio.get_running_loop()
+
+    cached = cache.get(sha)
+    if cached is not None:
+        fmt, data = cached
+        writer.write(
+            http_head(
+                200,
+                {
+                    "Content-Type": "application/octet-stream",
+                    "Content-Length": str(len(data)),
+                    "X-Object-Type": fmt.decode("ascii"),
+                },
+            )
+            + data
+        )
+        await writer.drain()
+        return
+
+    opened = await loop.run_in_executor(
+        pool, object_read_stream, repo, sha, SERVER_CHUNK_SIZE
+    )
+    if opened is None:
+        await http_respond(writer, 404, b"No such object\n")
+        return
+
+    fmt, size, chunks = opened
+    writer.write(
+        http_head(
+            200,
+            {
+                "Content-Type": "application/octet-stream",
+                "Content-Length": str(size),
+                "X-Object-Type": fmt.decode("ascii"),
+            },
+        )
+    )
+
+    keep = list() if size <= SERVER_CACHE_MAX_OBJECT_SIZE else None
+    while True:
+        try:
+            chunk = await loop.run_in_executor(pool, next, chunks, None)
+        except Exception as e:
+            # The headers are out, the client can only learn from a cut connection.
+            raise ConnectionAbortedError(str(e))
+        if chunk is None:
+            break
+        if keep is not None:
+            keep.append(chunk)
+        writer.write(chunk)
+        await writer.drain()
+
+    if keep is not None:
+        cache.put(sha, fmt, b"".join(keep))
+
+
+async def server_pack(writer, repo, wants, haves, pool):
+    """Send the objects reachable from wants and not from haves as a pack, with chunked encoding since its size isn't known up front."""
+    loop = asyncio.get_running_loop()
+
+    def missing():
+        if not all(object_exists(repo, sha) for sha in wants):
+            return None
+        return objects_missing(repo, wants, haves)
+
+    shas = await loop.run_in_executor(pool, missing)
+    if shas is None:
+        await http_respond(writer, 404, b"No such object\n")
+        return
+
+    queue = asyncio.Queue(maxsize=8)
+    out = QueueWriter(queue, loop)
+
+    def generate():
+        try:
+            pack_write(repo, shas, out)
+        finally:
+            out.close()
+
+    writer.write(
+        http_head(
+            200,
+            {
+                "Content-Type": "application/x-verizon-pack",
+                "Transfer-Encoding": "chunked",
+            },
+        )
+    )
+
+    task = loop.run_in_executor(pool, generate)
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            writer.write(b"%x\r\n" % len(chunk) + chunk + b"\r\n")
+            await writer.drain()
+    except BaseException:
+        # The client went away: stop the worker, or it waits on the full queue forever and the pool has one less.
+        out.cancel()
+        # Its error is retrieved, for it not to be logged: there's no one left to tell.
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        raise
+
+    try:
+        await task
+    except Exception as e:
+        raise ConnectionAbortedError(str(e))
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+class ServerRepositories:
+    """The repositories a server serves, by name. One is opened again when its object store changes, for the packs and loose objects other processes write or delete to show."""
+
+    def __init__(self, paths) -> None:
+        self.paths = {name: os.path.realpath(path) for name, path in paths.items()}
+        self.opened: dict[
+            str, tuple
+        ] = dict()  # name to (stamps of SERVER_STAMPS, repository).
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def get(self, name):
+        path = self.paths.get(name)
+        if path is None:
+            return None
+
+        stamps = tuple(
+            file_stamp(os.path.join(path, ".vrz", *p)) for p in SERVER_STAMPS
+        )
+        found = self.opened.get(name)
+        if found is not None and found[0] == stamps:
+            return found[1]
+
+        repo = VerizonRepository(path)
+        self.opened[name] = (stamps, repo)
+        return repo
+
+
+async def server_route(writer, method, target, repos, cache, pool, limit):
+    loop = asyncio.get_running_loop()
+
+    if method != "GET":
+        await http_respond(writer, 405, b"Only GET is supported\n")
+        return
+
+    url = urlsplit(target)
+    parts = [p for p in url.path.split("/") if p]
+
+    if not parts:
+        await http_respond(
+            writer, 200, "".join(f"{name}\n" for name in repos).encode("utf8")
+        )
+        return
+
+    repo = repos.get(parts[0])
+    if repo is None:
+        await http_respond(writer, 404, b"No such repository\n")
+        return
+
+    if parts[1:] == ["refs"]:
+        body = await loop.run_in_executor(pool, server_refs, repo)
+        await http_respond(writer, 200, body)
+
+    elif len(parts) == 3 and parts[1] == "objects" and SHA_RE.match(parts[2]):
+        async with limit:
+            await server_object(writer, repo, parts[2], cache, pool)
+
+    elif parts[1:] == ["pack"]:
+        query = parse_qs(url.query)
+        wants = query.get("want", list())
+        haves = query.get("have", list())
+        if not wants or not all(SHA_RE.match(sha) for sha in wants + haves):
+            await http_respond(
+                writer, 400, b"Expected want=<sha> and have=<sha> parameters\n"
+            )
+            return
+        async with limit:
+            await server_pack(writer, repo, wants, haves, pool)
+
+    else:
+        await http_respond(writer, 404, b"Not found\n")
+
+
+async def server_start(
+    repos, host="127.0.0.1", port=8000, concurrency=64, workers=None
+):
+    """Start serving repos, a dict of name to path, over HTTP. Every request runs on the event loop, and every blocking read, inflate and hash in a pool of workers threads, at most concurrency objects or packs being sent at once.
+
+    GET /                      the repositories' names
+    GET /<name>/refs           "<sha> <ref>" per line
+    GET /<name>/objects/<sha>  an object's content, its type in X-Object-Type
+    GET /<name>/pack?want=<sha>&have=<sha>
+                               a pack of what's reachable from the wants and not from the haves
+    """
+    repos = ServerRepositories(repos)
+    cache = VerizonObjectCache()
+    pool = ThreadPoolExecutor(max_workers=workers)
+    limit = asyncio.Semaphore(concurrency)
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await http_request_read(reader)
+                if request is None:
+                    break
+                method, target, headers = request
+
+                try:
+                    await server_route(
+                        writer, method, target, repos, cache, pool, limit
+                    )
+                except ConnectionError:
+                    raise
+                except Exception as e:
+                    await http_respond(writer, 500, f"{e}\n".encode("utf8"))
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def http_response_read(reader):
+    """Read a response on a kept-alive connection. Return (status, headers, body)."""
+    status = int((await reader.readline()).split(b" ")[1])
+
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding") == "chunked":
+        body = list()
+        while True:
+            size = int(await reader.readline(), 16)
+            chunk = await reader.readexactly(size + 2)
+            if not size:
+                break
+            body.append(chunk[:-2])
+        return status, headers, b"".join(body)
+
+    return status, headers, await reader.readexactly(int(headers["content-length"]))
+
+
+async def load_test(host, port, paths, requests=1000, connections=32):
+    """Send requests GETs of paths, round robin, over connections kept-alive connections. Return the latencies in seconds and the total time."""
+    latencies = list()
+    failures = 0
+    next_request = 0
+
+    async def client():
+        nonlocal next_request, failures
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while next_request < requests:
+                path = paths[next_request % len(paths)]
+                next_request += 1
+
+                start = time.perf_counter()
+                writer.write(
+                    f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode("latin-1")
+                )
+                await writer.drain()
+                status, _, _ = await http_response_read(reader)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    failures += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(connections)))
+    return latencies, failures, time.perf_counter() - start
+
+
+async def serve_load_test(repos, requests, connections, concurrency, workers):
+    """Serve repos on an ephemeral localhost port, fetch the refs, every object reachable from the first repository's HEAD and a full pack of it, and print the throughput and latencies."""
+    server = await server_start(repos, "127.0.0.1", 0, concurrency, workers)
+    port = server.sockets[0].getsockname()[1]
+
+    name, path = next(iter(repos.items()))
+    repo = VerizonRepository(os.path.realpath(path))
+    head = ref_resolve(repo, "HEAD")
+    if not head:
+        raise Exception(f"{name} has no commit to load test with")
+
+    shas = objects_missing(repo, [head], list())
+    paths = [f"/{name}/objects/{sha}" for sha in shas]
+    paths += [f"/{name}/refs", f"/{name}/pack?want={head}"]
+
+    async with server:
+        latencies, failures, elapsed = await load_test(
+            "127.0.0.1", port, paths, requests, connections
+        )
+
+    latencies.sort()
+    print(f"{len(latencies)} requests over {connections} connections in {elapsed:.2f}s")
+    print(f"{len(latencies) / elapsed:.0f} requests/s, {failures} failed")
+    for p in (50, 90, 99):
+        at = min(len(latencies) - 1, len(latencies) * p // 100)
+        print(f"p{p}: {latencies[at] * 1000:.2f}ms")
+    print(f"max: {latencies[-1] * 1000:.2f}ms")
@@ -0,0 +1,69 @@
+import os
+
+from utils import repo_file
+
+# What a directory is to the sparse cone.
+SPARSE_IN = "in"  # everything below it is checked out.
+SPARSE_OUT = "out"  # nothing below it is, it doesn't even need to be read.
+SPARSE_PARTIAL = (
+    "partial"  # it leads to a cone directory, only its own files are checked out.
+)
+
+
+def sparse_read(repo):
+    """Return the cone directories from .vrz/info/sparse-checkout, or None when the whole tree is checked out."""
+    path = repo_file(repo, "info", "sparse-checkout")
+    if not path or not os.path.isfile(path):
+        return None
+
+    cone = list()
+    with open(path, "r") as f:
+        for line in f.readlines():
+            line = line.strip()
+            if not line or line[0] == "#":
+                continue
+            if line.strip("/"):
+                cone.append(line.strip("/"))
+
+    return cone
+
+
+def sparse_write(repo, cone):
+    with open(repo_file(repo, "info", "sparse-checkout", mkdir=True), "w") as f:
+        for d in cone:
+            f.write(d.strip("/") + "/\n")
+
+
+def sparse_dir_state(cone, path):
+    """Place a directory, relative to the worktree, in the cone. Like git's cone mode, a directory is fully checked out if it's below a cone directory, and the files directly inside the root or inside a directory leading to one are checked out too."""
+    if cone is None:
+        return SPARSE_IN
+    if path == "":
+        return SPARSE_PARTIAL
+
+    for d in cone:
+        if path == d or path.startswith(d + "/"):
+            return SPARSE_IN
+
+    for d in cone:
+        if d.startswith(path + "/"):
+            return SPARSE_PARTIAL
+
+    return SPARSE_OUT
+
+
+def sparse_includes(cone, path):
+    """Check if a file, relative to the worktree, is checked out."""
+    if cone is None:
+        return True
+    return sparse_dir_state(cone, os.path.dirname(path)) != SPARSE_OUT
+
+
+def sparse_excluded_dir(cone, path):
+    """Return the outermost excluded directory holding path, or None if path is in the cone."""
+    parts = path.split("/")
+    for i in range(1, len(parts)):
+        d = "/".join(parts[:i])
+        if sparse_dir_state(cone, d) == SPARSE_OUT:
+            return d
+    return None
@@ -0,0 +1,429 @@
+import heapq
+import os
+import subprocess
+import threading
+
+from classes import VerizonRepository
+from class_utils import object_exists, object_read
+from clone_utils import refs_flatten
+from commit_graph_utils import commit_parents, commit_time
+from merge_base_utils import is_ancestor
+from other_utils import branch_get_active, ref_list, ref_resolve, refs_update
+from pack_utils import objects_missing, pack_store, pack_write
+from utils import repo_file, vrz_command
+
+ZERO_SHA = "0" * 40
+
+# Haves are sent by batches, each answered before the next one is sent.
+HAVE_BATCH_SIZE = 32
+
+
+def pkt_write(out, line=None):
+    """Write a pkt-line, the length in 4 hex digits then the line, or a flush packet for None."""
+    if line is None:
+        out.write(b"0000")
+    else:
+        data = line.encode("utf8") + b"\n"
+        out.write(b"%04x" % (len(data) + 4) + data)
+
+
+def pkt_read(inp):
+    """Read a pkt-line, None for a flush packet."""
+    head = inp.read(4)
+    if len(head) < 4:
+        raise Exception("Connection closed by the other end")
+
+    size = int(head, 16)
+    if size == 0:
+        return None
+    return inp.read(size - 4).decode("utf8").rstrip("\n")
+
+
+def pkt_read_until_flush(inp):
+    ret = list()
+    line = pkt_read(inp)
+    while line is not None:
+        ret.append(line)
+        line = pkt_read(inp)
+    return ret
+
+
+def refs_advertise(repo, out, head=True):
+    """Send every ref of repo as "<sha> <ref>", then a flush."""
+    if head:
+        sha = ref_resolve(repo, "HEAD")
+        if sha:
+            pkt_write(out, f"{sha} HEAD")
+
+    for name, sha in refs_flatten(ref_list(repo)).items():
+        if sha:
+            pkt_write(out, f"{sha} refs/{name}")
+    pkt_write(out)
+    out.flush()
+
+
+def refs_advertised(inp):
+    ret = dict()
+    for line in pkt_read_until_flush(inp):
+        sha, ref = line.split(" ", 1)
+        ret[ref] = sha
+    return ret
+
+
+def upload_pack(repo, inp, out):
+    """The serving end of a fetch: advertise the refs, take the wants, answer the haves, then send the objects the client lacks as a pack."""
+    refs_advertise(repo, out)
+
+    wants = [line.split(" ")[1] for line in pkt_read_until_flush(inp)]
+    if not wants:
+        return
+
+    for sha in wants:
+        if not object_exists(repo, sha):
+            raise Exception(f"Not our object {sha}")
+
+    common = list()
+    while True:
+        lines = pkt_read_until_flush(inp)
+        done = lines and lines[-1] == "done"
+        for line in lines:
+            if not line.startswith("have "):
+                continue
+            sha = line.split(" ")[1]
+            if object_exists(repo, sha):
+                common.append(sha)
+                pkt_write(out, f"ACK {sha}")
+        pkt_write(out)
+        out.flush()
+
+        if done:
+            break
+
+    pack_write(repo, objects_missing(repo, wants, common), out)
+    out.flush()
+
+
+def receive_pack(repo, inp, out):
+    """The serving end of a push: advertise the refs, take the "<old> <new> <ref>" commands and the pack, then update the refs, all of them or none."""
+    refs_advertise(repo, out, head=False)
+
+    commands = [line.split(" ") for line in pkt_read_until_flush(inp)]
+    if not commands:
+        return
+
+    if any(new != ZERO_SHA for _, new, _ in commands):
+        pack_store(repo, inp)
+
+    # Nothing is pointed at objects which didn't all make it.
+    tips = [sha for sha in refs_flatten(ref_list(repo)).values() if sha]
+    error = None
+    try:
+        # Moving the checked out branch would leave the worktree and the index behind it, like git's receive.denyCurrentBranch.
+        branch = branch_get_active(repo)
+        if branch and any(ref == "refs/heads/" + branch for _, _, ref in commands):
+            raise Exception(f"branch {branch} is currently checked out")
+
+        news = [new for _, new, _ in commands if new != ZERO_SHA]
+        for sha in objects_missing(repo, news, tips):
+            if not object_exists(repo, sha):
+                raise Exception(f"missing object {sha}")
+
+        refs_update(
+            repo,
+            [
+                (
+                    ref,
+                    None if old == ZERO_SHA else old,
+                    None if new == ZERO_SHA else new,
+                )
+                for old, new, ref in commands
+            ],
+        )
+    except Exception as e:
+        error = str(e)
+
+    for _, _, ref in commands:
+        pkt_write(out, f"ng {ref} {error}" if error else f"ok {ref}")
+    pkt_write(out)
+    out.flush()
+
+
+def local_connect(path, service):
+    """Run the service for the repository at path in a thread, talking to it through pipes."""
+    remote = VerizonRepository(os.path.realpath(path))
+
+    to_server_r, to_server_w = os.pipe()
+    to_client_r, to_client_w = os.pipe()
+
+    server_inp = os.fdopen(to_server_r, "rb")
+    server_out = os.fdopen(to_client_w, "wb")
+    errors = list()
+
+    def serve():
+        try:
+            SERVICES[service](remote, server_inp, server_out)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # The client sees the end of the stream instead of waiting forever.
+            server_out.close()
+            server_inp.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+
+    def close():
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    return os.fdopen(to_client_r, "rb"), os.fdopen(to_server_w, "wb"), close
+
+
+def pipe_connect(path, service):
+    """Run the service in another process, `vrz upload-pack <path>` and the like, talking over its stdin and stdout."""
+    proc = subprocess.Popen(
+        vrz_command(service, path),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+
+    def close():
+        if proc.wait() != 0:
+            raise Exception(f"{service} exited with status {proc.returncode}")
+
+    return proc.stdout, proc.stdin, close
+
+
+# Transports by url scheme, paths without one being local.
+TRANSPORTS = {
+    "file": local_connect,
+    "pipe": pipe_connect,
+}
+
+SERVICES = {
+    "upload-pack": upload_pack,
+    "receive-pack": receive_pack,
+}
+
+
+def remote_url(repo, remote):
+    """The url of a remote from the config, the remote itself if it's no configured remote."""
+    section = f'remote "{remote}"'
+    if repo.conf.has_section(section):
+        return repo.conf.get(section, "url")
+    return remote
+
+
+def transport_connect(url, service):
+    """Return (input, output, close) connected to the service at url."""
+    scheme, sep, path = url.partition(":")
+    if sep and scheme in TRANSPORTS:
+        return TRANSPORTS[scheme](path.removeprefix("//"), service)
+    return local_connect(url, service)
+
+
+def commit_peel(repo, sha):
+    """The commit sha points to, through tags, or None."""
+    obj = object_read(repo, sha) if object_exists(repo, sha) else None
+    while obj is not None and obj.fmt == b"tag":
+        sha = obj.kvlm[b"object"].decode("ascii")
+        obj = object_read(repo, sha) if object_exists(repo, sha) else None
+    if obj is None or obj.fmt != b"commit":
+        return None
+    return sha
+
+
+def local_tips(repo):
+    tips = [sha for sha in refs_flatten(ref_list(repo)).values() if sha]
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        tips.append(head)
+    return tips
+
+
+def negotiate(repo, inp, out, known):
+    """Send haves, newest commits first, until every local line of history is known to be in common with the remote.
+
+    An acknowledged commit makes its ancestors common too, so they are never sent: a fetch of a few new commits takes a few round trips however old the history is.
+    """
+    common = set()
+    seen = set()
+    queue = list()
+    pending = 0  # commits in the queue not known to be common.
+
+    def push(sha):
+        nonlocal pending
+        sha = commit_peel(repo, sha)
+        if sha is None or sha in seen:
+            return
+        seen.add(sha)
+        commit = object_read(repo, sha)
+        heapq.heappush(queue, (-commit_time(commit), sha, commit_parents(commit)))
+        pending += 1
+
+    # What the remote advertised and we have is common already.
+    for sha in known:
+        sha = commit_peel(repo, sha)
+        if sha:
+            common.add(sha)
+    for sha in local_tips(repo) + list(common):
+        push(sha)
+
+    parents_of = dict()
+    haves = list(common)
+    while queue and pending:
+        while queue and len(haves) < HAVE_BATCH_SIZE:
+            _, sha, parents = heapq.heappop(queue)
+            parents_of[sha] = parents
+            if sha not in common:
+                pending -= 1
+                haves.append(sha)
+            else:
+                common.update(parents)
+                pending -= 1
+
+            for parent in parents:
+                push(parent)
+
+        for sha in haves:
+            pkt_write(out, f"have {sha}")
+        pkt_write(out)
+        out.flush()
+        haves = list()
+
+        for line in pkt_read_until_flush(inp):
+            sha = line.split(" ")[1]
+            common.add(sha)
+            common.update(parents_of.get(sha, ()))
+
+        pending = sum(1 for _, sha, _ in queue if sha not in common)
+
+    pkt_write(out, "done")
+    pkt_write(out)
+    out.flush()
+    pkt_read_until_flush(inp)
+
+
+def fetch(repo, remote):
+    """Fetch the branches and tags of remote, which is a configured remote or a url. Branches land in refs/remotes/<remote>/, tags are only created, never moved. Return the updated refs."""
+    inp, out, close = transport_connect(remote_url(repo, remote), "upload-pack")
+    try:
+        refs = refs_advertised(inp)
+        refs = {
+            ref: sha
+            for ref, sha in refs.items()
+            if ref.startswith("refs/heads/") or ref.startswith("refs/tags/")
+        }
+
+        wants = sorted(
+            set(sha for sha in refs.values() if not object_exists(repo, sha))
+        )
+        for sha in wants:
+            pkt_write(out, f"want {sha}")
+        pkt_write(out)
+        out.flush()
+
+        if wants:
+            negotiate(
+                repo,
+                inp,
+                out,
+                [sha for sha in refs.values() if object_exists(repo, sha)],
+            )
+            pack_store(repo, inp)
+    finally:
+        out.close()
+        inp.close()
+        close()
+
+    # Only a configured remote gets remote-tracking refs, a bare url leaves its branches in FETCH_HEAD, like in git.
+    tracking = repo.conf.has_section(f'remote "{remote}"')
+    if not tracking:
+        with open(repo_file(repo, "FETCH_HEAD"), "w") as f:
+            for ref, sha in refs.items():
+                if ref.startswith("refs/heads/"):
+                    f.write(
+                        f"{sha}\t\tbranch '{ref[len('refs/heads/'):]}' of {remote}\n"
+                    )
+
+    updates = list()
+    for ref, sha in refs.items():
+        if ref.startswith("refs/heads/"):
+            if not tracking:
+                continue
+            local = f"refs/remotes/{remote}/" + ref[len("refs/heads/") :]
+        elif ref_resolve(repo, ref) is None:
+            local = ref
+        else:
+            continue
+
+        old = ref_resolve(repo, local)
+        if old != sha:
+            updates.append((local, old, sha))
+
+    refs_update(repo, updates)
+    return updates
+
+
+def push(repo, remote, branches, force=False):
+    """Push the branches to the ones of the same name on remote. A branch which doesn't fast-forward is refused, unless forced. Return (ref, status) per branch."""
+    inp, out, close = transport_connect(remote_url(repo, remote), "receive-pack")
+    ret = list()
+    try:
+        refs = refs_advertised(inp)
+
+        commands = list()
+        for branch in branches:
+            ref = "refs/heads/" + branch
+            new = ref_resolve(repo, ref)
+            if new is None:
+                raise Exception(f"No such branch : {branch}")
+
+            old = refs.get(ref, ZERO_SHA)
+            if old == new:
+                ret.append((ref, "up to date"))
+                continue
+
+            if old != ZERO_SHA and not force:
+                if not object_exists(repo, old) or not is_ancestor(repo, old, new):
+                    ret.append((ref, "rejected, non-fast-forward: fetch first"))
+                    continue
+
+            commands.append((old, new, ref))
+
+        for old, new, ref in commands:
+            pkt_write(out, f"{old} {new} {ref}")
+        pkt_write(out)
+        out.flush()
+
+        if commands:
+            # The remote has everything its refs reach, only what's past them is sent.
+            haves = [sha for sha in refs.values() if object_exists(repo, sha)]
+            pack_write(
+                repo, objects_missing(repo, [new for _, new, _ in commands], haves), out
+            )
+            out.flush()
+
+            for line in pkt_read_until_flush(inp):
+                status, ref, *reason = line.split(" ", 2)
+                ret.append(
+                    (ref, "ok" if status == "ok" else "rejected, " + " ".join(reason))
+                )
+    finally:
+        out.close()
+        inp.close()
+        close()
+
+    # The remote-tracking refs follow what the remote accepted.
+    pushed = {ref: new for _, new, ref in commands}
+    tracking = repo.conf.has_section(f'remote "{remote}"')
+    updates = list()
+    for ref, status in ret:
+        if status != "ok" or not tracking:
+            continue
+        local = f"refs/remotes/{remote}/" + ref[len("refs/heads/") :]
+        updates.append((local, ref_resolve(repo, local), pushed[ref]))
+    refs_update(repo, updates)
+
+    return ret
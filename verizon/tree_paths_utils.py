@@ -0,0 +1,169 @@
+import hashlib
+import os
+import struct
+
+from classes import VerizonObjectCache
+from class_utils import object_read
+from utils import repo_path
+
+# A listing is a header, the modes of its entries, their shas, then their paths, each NUL terminated, and the SHA-1 of all that. Columns, so that reading it, or a subtree's into its parent's, is a few operations on whole buffers.
+TREE_PATHS_HEADER = struct.Struct(">4sII")
+
+TREE_PATHS_VERSION = 1
+
+TREE_MODE = 0o040000
+
+# The listings held in memory by a process, the least recently used dropped past this many bytes.
+TREE_PATHS_MAX_MEMORY = 64 * 1024 * 1024
+
+# Listings of at least this many entries are also kept on disk: smaller ones cost less to build than a file does.
+TREE_PATHS_MIN_ENTRIES = 512
+
+# Past this many bytes on disk, the least recently used listings are removed.
+TREE_PATHS_MAX_DISK = 256 * 1024 * 1024
+
+
+def tree_paths_dir(repo):
+    return repo_path(repo, "objects", "info", "tree-paths")
+
+
+def tree_paths_columns(data):
+    """Return (count, modes, shas, paths) of a listing, each column as bytes."""
+    _, _, count = TREE_PATHS_HEADER.unpack_from(data)
+    at = TREE_PATHS_HEADER.size
+    modes = data[at : at + 4 * count]
+    at += 4 * count
+    shas = data[at : at + 20 * count]
+    at += 20 * count
+    return count, modes, shas, data[at:-20]
+
+
+def tree_paths_iter(data):
+    """Return an iterator of (path, mode, sha) over every entry of a listing, in path order, trees before what's below them."""
+    count, modes, shas, paths = tree_paths_columns(data)
+    shas = shas.hex()
+    return zip(
+        paths.decode("utf8").split("\x00"),
+        struct.unpack(f">{count}I", modes),
+        (shas[i : i + 40] for i in range(0, 40 * count, 40)),
+    )
+
+
+def tree_paths_build(repo, sha):
+    """The listing of tree sha, from its own entries and the listings of its subtrees."""
+    count = 0
+    modes = list()
+    shas = list()
+    paths = list()
+    for leaf in object_read(repo, sha).items:
+        path = leaf.path.encode("utf8")
+        mode = int(leaf.mode, 8)
+        modes.append(struct.pack(">I", mode))
+        shas.append(leaf.binsha)
+        paths.append(path + b"\x00")
+        count += 1
+
+        if mode != TREE_MODE:
+            continue
+
+        # Subtrees shared with other trees are listed once, and their listing reused.
+        sub_count, sub_modes, sub_shas, sub_paths = tree_paths_columns(
+            tree_paths(repo, leaf.sha)
+        )
+        if sub_count:
+            prefix = path + b"/"
+            modes.append(sub_modes)
+            shas.append(sub_shas)
+            paths.append(
+                prefix + sub_paths[:-1].replace(b"\x00", b"\x00" + prefix) + b"\x00"
+            )
+            count += sub_count
+
+    data = b"".join(
+        [TREE_PATHS_HEADER.pack(b"VTRP", TREE_PATHS_VERSION, count)]
+        + modes
+        + shas
+        + paths
+    )
+    return data + hashlib.sha1(data).digest()
+
+
+def tree_paths_load(path):
+    """The listing stored at path, or None when there's none or it's damaged."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+
+    if (
+        len(data) < TREE_PATHS_HEADER.size + 20
+        or TREE_PATHS_HEADER.unpack_from(data)[:2] != (b"VTRP", TREE_PATHS_VERSION)
+        or hashlib.sha1(data[:-20]).digest() != data[-20:]
+    ):
+        return None
+
+    # Its mtime is when it was last used, for tree_paths_evict.
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return data
+
+
+def tree_paths_store(repo, sha, data):
+    path = os.path.join(tree_paths_dir(repo), sha)
+    # Another process may be storing the same tree.
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(tree_paths_dir(repo), exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        # Only a cache: a read-only repository just goes without.
+        return
+    tree_paths_evict(repo)
+
+
+def tree_paths_evict(repo):
+    """Remove the least recently used listings until they fit in TREE_PATHS_MAX_DISK."""
+    files = list()
+    total = 0
+    with os.scandir(tree_paths_dir(repo)) as it:
+        for e in it:
+            if len(e.name) != 40:
+                continue
+            stat = e.stat()
+            files.append((stat.st_mtime, e.path, stat.st_size))
+            total += stat.st_size
+
+    files.sort()
+    for _, path, size in files:
+        if total <= TREE_PATHS_MAX_DISK:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def tree_paths(repo, sha):
+    """The flattened listing of tree sha: every path below it, trees included, with its mode and sha, sorted, as read by tree_paths_iter. Trees never change, so a listing built once is kept as long as there's room: in memory for the process, and on disk for the big ones."""
+    if repo.tree_paths is None:
+        repo.tree_paths = VerizonObjectCache(TREE_PATHS_MAX_MEMORY)
+
+    cached = repo.tree_paths.get(sha)
+    if cached is not None:
+        return cached[1]
+
+    path = os.path.join(tree_paths_dir(repo), sha)
+    data = tree_paths_load(path)
+    if data is None:
+        data = tree_paths_build(repo, sha)
+        if TREE_PATHS_HEADER.unpack_from(data)[2] >= TREE_PATHS_MIN_ENTRIES:
+            tree_paths_store(repo, sha, data)
+
+    repo.tree_paths.put(sha, b"tree", data)
+    return data
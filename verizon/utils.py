@@ -1,32 +1,49 @@
 import os
+import sys
 import configparser
-from typing import Tuple
 from classes import VerizonRepository
 
 
-def repo_dir(repo: VerizonRepository, *path, mkdir=False):
-    path = repo_path(repo, *path)
+def repo_dir(repo: VerizonRepository, *path: str, mkdir=False):
+    dir_path = repo_path(repo, *path)
 
-    if os.path.exists(path):
-        if os.path.isdir(path):
-            return path
-        raise Exception(f"Not a directory : {path}")
+    if os.path.exists(dir_path):
+        if os.path.isdir(dir_path):
+            return dir_path
+        raise Exception(f"Not a directory : {dir_path}")
 
     if mkdir:
-        os.mkdir(path)
-        return path
+        os.makedirs(dir_path)
+        return dir_path
     return None
 
 
-def repo_path(repo: VerizonRepository, *path: Tuple[str]):
+def repo_path(repo: VerizonRepository, *path: str):
     return os.path.join(repo.vrzdir, *path)
 
 
+def vrz_command(*args):
+    """The command line running `vrz args` in another process, with this interpreter and this copy of Verizon."""
+    return [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+    ] + list(args)
+
+
 def repo_file(repo, *path, mkdir=False):
     if repo_dir(repo, *path[:-1], mkdir=mkdir):
         return repo_path(repo, *path)
 
 
+def file_stamp(path):
+    """What changes when the file at path does: its mtime, size and inode, or None when it's missing. Files replaced through a rename get a new inode, so a change within the mtime resolution shows too."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
 def repo_default_config():
     ret = configparser.ConfigParser()
     ret.add_section("core")
@@ -74,11 +91,15 @@ def repo_create(path):
     return repo
 
 
+# What repo_find opens a repository with. A process running many commands sets its own, to reuse what they read, see CmdServer.
+repo_open = VerizonRepository
+
+
 def repo_find(path=".", required=True):
     path = os.path.realpath(path)
 
     if os.path.isdir(os.path.join(path, ".vrz")):
-        return VerizonRepository(path)
+        return repo_open(path)
 
     # If we haven't retured till now, we recurse in parent.
     parent = os.path.realpath(os.path.join(path, ".."))
@@ -0,0 +1,85 @@
+import os
+
+from sparse_utils import SPARSE_OUT, sparse_dir_state
+
+# Reading a directory and stating its files is all syscalls, which release the GIL: threads overlap them, which is what counts on network and overlay filesystems.
+WORKTREE_SCAN_THREADS = 16
+
+
+def worktree_read_dir(pool, worktree, rel, cone, tracked):
+    """Read the directory rel of the worktree. Return its entries in path order, as (sort key, path, stat, read): read being the read of a subdirectory, already submitted to pool, and None for a file. Only the files in tracked are stated, the stat of the others is False."""
+    try:
+        it = os.scandir(os.path.join(worktree, rel))
+    except OSError:
+        # Skipped like os.walk does: gone since its parent was read, or not readable.
+        return list()
+
+    entries = list()
+    dirs = list()
+    with it:
+        for e in it:
+            name = e.name
+            if e.is_dir(follow_symlinks=False):
+                dirs.append(name)
+                continue
+
+            path = rel + name
+            if tracked is not None and path not in tracked:
+                entries.append((name, path, False, None))
+                continue
+
+            try:
+                stat = e.stat()
+            except FileNotFoundError:
+                try:
+                    # A dangling symlink, or a file deleted since scandir saw it.
+                    stat = e.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+            entries.append((name, path, stat, None))
+
+    # Submitted in path order, so the first directories needed are the first read.
+    dirs.sort()
+    for name in dirs:
+        path = rel + name
+        # .vrz is only skipped at the top: a repository further down is just files. Directories outside of a sparse checkout are never read.
+        if path == ".vrz" or (
+            cone is not None and sparse_dir_state(cone, path) == SPARSE_OUT
+        ):
+            continue
+        read = pool.submit(worktree_read_dir, pool, worktree, path + "/", cone, tracked)
+        # Sorted with a final /, for the walk to come out in the order of full paths, as the index is.
+        entries.append((name + "/", path, None, read))
+
+    entries.sort()
+    return entries
+
+
+def worktree_walk(repo, cone=None, tracked=None, threads=WORKTREE_SCAN_THREADS):
+    """Yield (path, stat) of every file of the worktree, in path order, leaving out .vrz and the directories outside of cone. When tracked is given, only the files in it are stated: the others have nothing to be compared to, their stat is False.
+
+    Every directory is submitted to a pool of threads as soon as its parent has been read, while the files already read are yielded.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    pool = ThreadPoolExecutor(max_workers=threads)
+    try:
+        stack = [
+            iter(
+                pool.submit(
+                    worktree_read_dir, pool, repo.worktree, "", cone, tracked
+                ).result()
+            )
+        ]
+        while stack:
+            for _, path, stat, read in stack[-1]:
+                if read is None:
+                    yield path, stat
+                else:
+                    stack.append(iter(read.result()))
+                    break
+            else:
+                stack.pop()
+    finally:
+        # Nothing waits on the reads not needed anymore, when the caller stops early.
+        pool.shutdown(wait=False, cancel_futures=True)